@@ -37,14 +37,14 @@ mkdir obiroi_cns_$DATE/syn
 # let the user know that the directory structure has been created
 echo "Directory structure created"
 
-## STEP 2: Copy Data to the directory
+## STEP 2: Link Data to the directory
 
-# Copy the data from subdirectory to the current directory ./
+# Link the data into the current directory ./ (the manifest maps the links back to the data)
 
-cp $DATA_DIRECTORY/$ID ./
+poetry run python ../scripts/staging.py -d $DATA_DIRECTORY -i "$ID" -m obiroi_cns_$DATE/staging_manifest.json --keep_names
 
-# let the user know that the data has been copied
-echo "Data copied to the current directory"
+# let the user know that the data has been linked
+echo "Data linked to the current directory"
 
 ## STEP 3: Run the registration
 
@@ -79,10 +79,10 @@ echo "Affine template copied to the current directory"
 
 # check if there is a diff folder in the resampled_data directory
 if [ -d "../resampled_data/whole_brain/diff" ]; then
-    # Copy the diff data from ../resampled_data/diff to the current directory ./
-    cp ../resampled_data/whole_brain/diff/$ID ./
-    # let the user know that the diff data has been copied
-    echo "Diff data copied to the current directory"
+    # Link the diff data instead of the data (copying would write through the links into the data)
+    poetry run python ../scripts/staging.py -d ../resampled_data/whole_brain/diff -i "$ID" -m obiroi_cns_$DATE/staging_manifest.json --keep_names
+    # let the user know that the diff data has been linked
+    echo "Diff data linked to the current directory"
 fi
 
 # Let the user know that the syn registration is starting
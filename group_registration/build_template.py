@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+# template building pipeline (stage, affine template, copy diff, SyN template, collect, quality, publish) as a resumable stage DAG
+# runs the same ANTs commands with the same parameters as the run_*_template_builder_*.sh scripts
+
+import os
+import re
+import sys
+import glob
+import time
+import json
+import shutil
+import argparse
+import subprocess
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'verification'))
+from verification_cache import VerificationCache
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import staging
+from stage_dag import StageDAG
+from template_convergence import ConvergenceMonitor
+import template_iteration
+import progressive_template
+import template_quality
+from work_stealing import WorkStealingExecutor
+from retention import Retention, RetentionWatcher, POLICIES
+
+# template construction scripts and their parameters ({threads}, {iterations}, {syn_steps} and {affine_template} are filled in)
+BUILDERS = {
+    'mtc': {
+        'script': './ANTs/Scripts/antsMultivariateTemplateConstruction.sh',
+        'affine': '-d 3 -n 1 -c 2 -j {threads} -i {iterations} -k 1 -w 1 -m 1x0x0 -t GR -s MI -r 1 -o affine_',
+        'syn': '-d 3 -n 1 -c 2 -j {threads} -i {iterations} -k 1 -w 1 -m {syn_steps} -t GR -s CC -r 0 -o complete_ -z {affine_template}',
+        'template': '{}template0.nii.gz',
+        'affine_outputs': ['affine_*', 'intermediate*', 'rigid', 'ANTs_*'],
+        'syn_outputs': ['complete_*', 'intermediate*', 'ANTs_*'],
+        'affine_iterations': 4,
+        'sanitize': True,
+        'tag': '_mtc',
+    },
+    'btp': {
+        'script': './ANTs/Scripts/buildtemplateparallel.sh',
+        'affine': '-d 3 -i {iterations} -m 1x0x0 -t GR -s MI -r 1 -c 2 -j {threads} -o affine_',
+        'syn': '-d 3 -i {iterations} -m {syn_steps} -t GR -s CC -z {affine_template} -c 2 -j {threads} -o complete_',
+        'template': '{}template.nii.gz',
+        'affine_outputs': ['affine_*', 'rigid', '*.cfg', 'GR*'],
+        'syn_outputs': ['complete_*', '*.cfg', 'GR*'],
+        'affine_iterations': 4,
+        'sanitize': True,
+        'tag': '_btp',
+    },
+    'mtc2': {
+        'script': './ANTs/Scripts/antsMultivariateTemplateConstruction2.sh',
+        'affine': '-d 3 -b 1 -c 2 -j {threads} -i {iterations} -k 1 -f 4x2x1 -s 2x1x0vox -q 1x0x0 -t Affine -m MI -r 1 -o affine_',
+        'syn': '-d 3 -b 1 -c 2 -j {threads} -i {iterations} -k 1 -f 8x4x2x1 -s 4x2x1x0vox -q {syn_steps} -t SyN -m CC -r 0 -o complete_ -z {affine_template}',
+        'template': '{}template0.nii.gz',
+        'affine_outputs': ['affine_*', 'intermediate*', 'rigid', 'ANTs_*'],
+        'syn_outputs': ['complete_*', 'intermediate*', 'ANTs_*'],
+        'affine_iterations': 4,
+        'sanitize': False,
+        'tag': '',
+    },
+    'btp_RA': {
+        'script': './ANTs/Scripts/buildtemplateparallel.sh',
+        'affine': '-d 3 -i {iterations} -m 200x100x50x0 -t RA -s MI -r 1 -c 2 -j {threads} -o affine_',
+        'syn': '-d 3 -i {iterations} -m {syn_steps} -t GR -s CC -z {affine_template} -c 2 -j {threads} -o complete_',
+        'template': '{}template.nii.gz',
+        'affine_outputs': ['affine_*', 'rigid_*', '*.cfg', 'RA*'],
+        'syn_outputs': ['complete_*', '*.cfg', 'GR*'],
+        'affine_iterations': 2,
+        'sanitize': True,
+        'tag': '',
+    },
+}
+
+REGIONS = {
+    'whole_brain': {'data_dir': '../resampled_data/whole_brain', 'id': 'synA647_*.nrrd', 'threads': 40, 'name': 'cns'},
+    'antennal_lobe': {'data_dir': '../resampled_data/antennal_lobe', 'id': 'Brain*.nrrd', 'threads': 12, 'name': 'al'},
+}
+
+# the whole brain mtc build uses fewer iterations at the second level of the SyN registrations
+SYN_STEPS = {('mtc', 'whole_brain'): '60x120x40x20'}
+DEFAULT_SYN_STEPS = '60x180x40x20'
+
+STAGES = ['stage', 'affine_template', 'copy_diff', 'syn_template', 'collect', 'quality', 'publish']
+# an incremental build starts from the template of a finished run instead of building the affine and SyN templates
+INCREMENTAL_STAGES = ['stage', 'warm_start', 'register_new', 'refine', 'collect', 'quality', 'publish']
+
+STATE_DIR = '.build_state'
+GROUP_REGISTRATION_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# executors of the SyN registrations: the template construction script (-c 2 -j threads, one thread per subject)
+# or the work-stealing executor of the iterations run from python (idle cores go to the remaining subjects)
+EXECUTORS = ['ants', 'stealing']
+
+
+def make_config(builder, region, data_dir=None, id=None, threads=None, affine_iterations=None, syn_iterations=6, syn_steps=None, run_name=None,
+                early_stopping=False, ncc_tolerance=1e-3, rms_tolerance=1e-2, displacement_tolerance=0.1, min_iterations=2,
+                base_run=None, refine_iterations=2, schedule=None, strata_file=None, strata_column='Egocentric Leaning', seed=0, executor='ants',
+                cache_dir='../cache', retention='all', preview_shrink=4):
+    """
+    Returns the parameters of a build (the defaults are those of the corresponding bash script).
+    With early_stopping, the templates are built one iteration at a time and the iterations stop once the template
+    has converged (see template_convergence.ConvergenceMonitor), the iteration numbers are then the maximum numbers of iterations.
+    With a base_run (a finished run directory), the build is incremental: the subjects that are not in the base run are registered
+    to its template and refine_iterations SyN iterations (mtc parameters) over all subjects update the template.
+    With a schedule (see progressive_template.parse_schedule), the SyN template is built coarse-to-fine on growing subsets
+    of the subjects (random, or stratified by the strata_column of the strata_file metadata), one iteration per entry.
+    With the stealing executor, the SyN iterations are run from python and the registrations share the threads
+    with a work-stealing queue (see work_stealing.WorkStealingExecutor).
+    The affine stage is cached in cache_dir (None to disable the cache) by the content of the images and its parameters,
+    so builds that only differ in their SyN stage reuse the affine template and affine transforms of a previous build.
+    The retention policy (see retention.POLICIES) thins out the per-iteration files while the templates are built.
+    """
+    assert base_run is None or schedule is None, 'Incremental builds cannot be progressive'
+    assert executor in EXECUTORS, 'Unknown executor {} (executors: {})'.format(executor, ', '.join(EXECUTORS))
+    assert builder in BUILDERS, 'Unknown builder {} (builders: {})'.format(builder, ', '.join(BUILDERS))
+    assert region in REGIONS, 'Unknown region {} (regions: {})'.format(region, ', '.join(REGIONS))
+    # the iterations run from python use the parameters and file names of antsMultivariateTemplateConstruction.sh
+    assert builder == 'mtc' or (base_run is None and schedule is None and executor == 'ants'), \
+        'Incremental, progressive and work-stealing builds only support the mtc builder (not {})'.format(builder)
+    if run_name is None:
+        tag = BUILDERS[builder]['tag'] + ('_inc' if base_run is not None else '') + ('_prog' if schedule is not None else '')
+        run_name = 'obiroi_{}{}_{}'.format(REGIONS[region]['name'], tag, datetime.now().strftime('%Y%m%d_%H%M'))
+    return {
+        'builder': builder,
+        'region': region,
+        'data_dir': data_dir if data_dir is not None else REGIONS[region]['data_dir'],
+        'id': id if id is not None else REGIONS[region]['id'],
+        'threads': threads if threads is not None else REGIONS[region]['threads'],
+        'affine_iterations': affine_iterations if affine_iterations is not None else BUILDERS[builder]['affine_iterations'],
+        'syn_iterations': syn_iterations,
+        'syn_steps': syn_steps if syn_steps is not None else SYN_STEPS.get((builder, region), DEFAULT_SYN_STEPS),
+        'run_name': run_name,
+        'early_stopping': early_stopping,
+        'ncc_tolerance': ncc_tolerance,
+        'rms_tolerance': rms_tolerance,
+        'displacement_tolerance': displacement_tolerance,
+        'min_iterations': min_iterations,
+        'base_run': base_run,
+        'refine_iterations': refine_iterations,
+        'schedule': schedule,
+        'strata_file': strata_file,
+        'strata_column': strata_column,
+        'seed': seed,
+        'executor': executor,
+        'cache_dir': cache_dir,
+        'retention': retention,
+        'preview_shrink': preview_shrink,
+    }
+
+
+def local(path):
+    """
+    Returns a path relative to the group_registration directory relative to the working directory (builds can run in another directory).
+    """
+    return os.path.relpath(os.path.join(GROUP_REGISTRATION_DIR, path)) if path is not None else None
+
+
+def shell(command, dry_run, log=None, append=False):
+    """
+    Runs a command with bash (the output is also written to the log files (stdout, stderr) if given).
+    """
+    if log is not None:
+        tee = 'tee -a' if append else 'tee'
+        command = '{} > >({} {}) 2> >({} {} >&2)'.format(command, tee, log[0], tee, log[1])
+    print(command)
+    if dry_run:
+        return
+    status = subprocess.call(command, shell=True, executable='/bin/bash')
+    assert status == 0, 'Command failed with exit status {}: {}'.format(status, command)
+
+
+def move(patterns, destination, dry_run):
+    """
+    Moves all files matching the glob patterns to the destination directory (patterns without matches are ignored).
+    """
+    for pattern in patterns:
+        if dry_run:
+            print('mv {} {}'.format(pattern, destination))
+            continue
+        for f in sorted(glob.glob(pattern)):
+            target = os.path.join(destination, os.path.basename(f))
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            print('mv {} {}'.format(f, destination))
+            shutil.move(f, target)
+
+
+def copy(source, destination, dry_run):
+    print('cp {} {}'.format(source, destination))
+    if not dry_run:
+        shutil.copy(source, destination)
+
+
+def build_pipeline(config):
+    """
+    Returns the stage DAG of a build. The paths of the config are relative to the group_registration directory,
+    the build runs in the working directory.
+    """
+    builder = BUILDERS[config['builder']]
+    script, data_dir, results_dir = local(builder['script']), local(config['data_dir']), local(os.path.join('..', 'results'))
+    run_dir = config['run_name']
+    affine_template = builder['template'].format('affine_')
+    complete_template = builder['template'].format('complete_')
+    parameters = {'threads': config['threads'], 'syn_steps': config['syn_steps'], 'affine_template': affine_template}
+    dag = StageDAG(os.path.join(STATE_DIR, config['run_name']))
+    manifest_file = os.path.join(run_dir, staging.MANIFEST)
+
+    def retention(directories, monitor=None, directory='syn'):
+        return Retention(config['retention'], directories, preview_dir=os.path.join(run_dir, directory, 'previews'),
+                         preview_shrink=config['preview_shrink'], monitor=monitor)
+
+    def construct(name, directory, prefix, iterations, dry_run):
+        # runs the affine or syn template construction, one iteration at a time with early stopping
+        log = ('stdout-{}-template.txt'.format(name), 'stderr-{}-template.txt'.format(name))
+        if not config['early_stopping']:
+            arguments = builder[name].format(iterations=iterations, **parameters)
+            if dry_run or config['retention'] == 'all':
+                shell('{} {} {}'.format(script, arguments, config['id']), dry_run, log=log)
+                return
+            # the iterations are thinned out while the script runs, their template change is logged before
+            log_file = os.path.join(run_dir, directory, 'convergence.csv')
+            if os.path.isfile(log_file):
+                os.remove(log_file)
+            monitor = ConvergenceMonitor(log_file, config['ncc_tolerance'], config['rms_tolerance'], config['displacement_tolerance'], config['min_iterations'])
+            with RetentionWatcher(retention(['.'], monitor, directory)):
+                shell('{} {} {}'.format(script, arguments, config['id']), dry_run, log=log)
+            return
+        template = builder['template'].format(prefix)
+        # the shape update warp of the last iteration (<prefix>template0warp.nii.gz or <prefix>templatewarp.nii.gz)
+        warp = template.replace('.nii.gz', 'warp.nii.gz')
+        # the next iteration starts from a copy of the template (the scripts copy the -z template to their output template)
+        previous = 'previous_' + template
+        convergence_dir = os.path.join(run_dir, directory, 'convergence')
+        log_file = os.path.join(run_dir, directory, 'convergence.csv')
+        if not dry_run:
+            os.makedirs(convergence_dir, exist_ok=True)
+            if os.path.isfile(log_file):
+                os.remove(log_file)
+        monitor = ConvergenceMonitor(log_file, config['ncc_tolerance'], config['rms_tolerance'], config['displacement_tolerance'], config['min_iterations'])
+        snapshots = retention([os.path.join(run_dir, directory)], directory=directory)
+        for iteration in range(iterations):
+            arguments = builder[name].format(iterations=1, **parameters)
+            if iteration > 0:
+                # continue from the previous template without a new rigid initialization
+                arguments = re.sub(r' -z \S+', '', arguments).replace('-r 1', '-r 0') + ' -z ' + previous
+            start = time.time()
+            shell('{} {} {}'.format(script, arguments, config['id']), dry_run, log=log, append=iteration > 0)
+            if dry_run:
+                print('... {} iterations at most, until the template has converged'.format(iterations))
+                break
+            shutil.copy(template, os.path.join(convergence_dir, 'iteration{}_{}'.format(iteration, template)))
+            shutil.copy(template, previous)
+            converged = monitor.update(iteration, template, warp, time.time() - start)
+            snapshots.apply()
+            if converged:
+                print('{} template converged after {} of {} iterations'.format(name, iteration + 1, iterations))
+                break
+        if not dry_run:
+            snapshots.apply(final=True)
+        if os.path.isfile(previous):
+            os.remove(previous)
+
+    def executor():
+        # the stats of every registration step (threads, wall and CPU time, peak memory) are appended to syn/jobs.csv
+        if config['executor'] != 'stealing':
+            return None
+        return WorkStealingExecutor(config['threads'], log='stdout-syn-template.txt', stats_file=os.path.join(run_dir, 'syn', 'jobs.csv'))
+
+    def iterate(images, iterations, initial_affines=None, reference=None):
+        # SyN iterations run from python on complete_template (with early stopping), the registrations start from the
+        # last affine transforms of the subjects if initial affine transforms are given
+        convergence_dir = os.path.join(run_dir, 'syn', 'convergence')
+        os.makedirs(convergence_dir, exist_ok=True)
+        log_file = os.path.join(run_dir, 'syn', 'convergence.csv')
+        if os.path.isfile(log_file):
+            os.remove(log_file)
+        monitor = ConvergenceMonitor(log_file, config['ncc_tolerance'], config['rms_tolerance'], config['displacement_tolerance'], config['min_iterations'],
+                                     reference=reference)
+        snapshots = retention([os.path.join(run_dir, 'syn')])
+        for iteration in range(iterations):
+            start = time.time()
+            print('SyN iteration {} of {} ({} subjects)'.format(iteration + 1, iterations, len(images)))
+            files = template_iteration.register_subjects(complete_template, images, config['syn_steps'], initial_affines=initial_affines,
+                                                         n_jobs=config['threads'], log='stdout-syn-template.txt',
+                                                         executor=executor(), stats_labels={'iteration': iteration})
+            warp = template_iteration.shape_update(complete_template, files, log='stdout-syn-template.txt')
+            shutil.copy(complete_template, os.path.join(convergence_dir, 'iteration{}_{}'.format(iteration, complete_template)))
+            converged = monitor.update(iteration, complete_template, warp, time.time() - start)
+            snapshots.apply()
+            if config['early_stopping'] and converged:
+                print('template converged after {} of {} iterations'.format(iteration + 1, iterations))
+                break
+            if initial_affines is not None:
+                initial_affines = {image: f['affine'] for image, f in zip(images, files)}
+        snapshots.apply(final=True)
+
+    def stage(dry_run):
+        for directory in [os.path.join(run_dir, 'affine'), os.path.join(run_dir, 'syn')]:
+            print('mkdir -p {}'.format(directory))
+            if not dry_run:
+                os.makedirs(directory, exist_ok=True)
+        # the images are linked under their IDs (see staging.stage_images), the manifest maps the IDs back to the images
+        if dry_run:
+            print('ln -s {} ./'.format(os.path.join(data_dir, config['id'])))
+            return
+        staging.stage_images(sorted(glob.glob(os.path.join(data_dir, config['id']))), manifest_file, '.', builder['sanitize'])
+
+    def affine(dry_run):
+        def compute(entry):
+            construct('affine', 'affine', 'affine_', config['affine_iterations'], dry_run)
+            move(builder['affine_outputs'] + ['stdout-affine-template.txt', 'stderr-affine-template.txt'], os.path.join(run_dir, 'affine'), dry_run)
+            if entry is not None and not dry_run:
+                shutil.copytree(os.path.join(run_dir, 'affine'), os.path.join(entry, 'affine'))
+
+        if config['cache_dir'] is None or dry_run:
+            # a dry run neither creates the cache nor hashes the images
+            if dry_run and config['cache_dir'] is not None:
+                print('# the affine stage is copied from {} if it is cached'.format(local(config['cache_dir'])))
+            compute(None)
+        else:
+            cache = VerificationCache(local(config['cache_dir']))
+            # the number of threads does not change the result, the names of the staged images are part of the outputs
+            files = sorted(glob.glob(os.path.join(data_dir, config['id'])))
+            # the retention policy decides which intermediate templates and previews the cached affine directory holds
+            params = {'script': builder['script'], 'arguments': builder['affine'].format(iterations=config['affine_iterations'], **dict(parameters, threads=0)),
+                      'images': staged_images(), 'early_stopping': [config[k] for k in ['ncc_tolerance', 'rms_tolerance', 'displacement_tolerance', 'min_iterations']] if config['early_stopping'] else None,
+                      'retention': [config['retention'], config['preview_shrink'] if config['retention'] == 'preview' else None]}
+            entry = cache.entry('affine_template', files, **params)
+            if cache.is_complete(entry):
+                print('cp -r {} {}'.format(os.path.join(entry, 'affine'), run_dir))
+                shutil.copytree(os.path.join(entry, 'affine'), os.path.join(run_dir, 'affine'), dirs_exist_ok=True)
+            else:
+                cache.cached('affine_template', files, compute, **params)
+        copy(os.path.join(run_dir, 'affine', affine_template), affine_template, dry_run)
+        copy(os.path.join(run_dir, 'affine', affine_template), os.path.join(run_dir, affine_template), dry_run)
+
+    def copy_diff(dry_run):
+        diff_dir = os.path.join(data_dir, 'diff')
+        if not os.path.isdir(diff_dir):
+            print('no diff data in {}'.format(diff_dir))
+            return
+        # the links of the images that have diff data are replaced (copying would write through the links into the data)
+        if dry_run:
+            print('ln -s {} ./'.format(os.path.join(diff_dir, config['id'])))
+            return
+        staging.stage_images(sorted(glob.glob(os.path.join(diff_dir, config['id']))), manifest_file, '.', builder['sanitize'])
+
+    def syn(dry_run):
+        if config['schedule'] is not None:
+            progressive(dry_run)
+        elif config['executor'] == 'stealing':
+            python_syn(dry_run)
+        else:
+            construct('syn', 'syn', 'complete_', config['syn_iterations'], dry_run)
+
+    def python_syn(dry_run):
+        # the GR iterations of antsMultivariateTemplateConstruction.sh (-r 0, every registration starts from scratch)
+        images = sorted(glob.glob(config['id'])) if not dry_run else [config['id']]
+        copy(affine_template, complete_template, dry_run)
+        if dry_run:
+            for index, image in enumerate(images):
+                print('\n'.join(template_iteration.registration_commands(complete_template, image, index, config['syn_steps'], n_threads=None)))
+            print('... on a work-stealing queue of {} cores, then the shape update of {}, {} iterations'.format(
+                config['threads'], complete_template, config['syn_iterations']))
+            return
+        iterate(images, config['syn_iterations'], reference=affine_template)
+
+    def progressive(dry_run):
+        levels = progressive_template.parse_schedule(config['schedule'])
+        if dry_run:
+            for fraction, shrink in levels:
+                print('register {:.0%} of the subjects to the template downsampled {}x ({}), then update the template'.format(
+                    fraction, shrink, progressive_template.level_steps(config['syn_steps'], shrink)))
+            return
+        strata = progressive_template.read_strata(config['strata_file'], config['strata_column']) if config['strata_file'] is not None else None
+        log_file = os.path.join(run_dir, 'syn', 'convergence.csv')
+        if os.path.isfile(log_file):
+            os.remove(log_file)
+        monitor = ConvergenceMonitor(log_file, config['ncc_tolerance'], config['rms_tolerance'], config['displacement_tolerance'], config['min_iterations'])
+        progressive_template.build_progressive(
+            affine_template, sorted(glob.glob(config['id'])), config['schedule'], config['syn_steps'], complete_template,
+            os.path.join(run_dir, 'syn', 'progressive'), monitor, template_iteration.find_affines(os.path.join(run_dir, 'affine'), 'affine_'),
+            n_jobs=config['threads'], strata=strata, seed=config['seed'], early_stopping=config['early_stopping'], log='stdout-syn-template.txt',
+            executor=executor())
+
+    def staged_images():
+        # names of the images in the working directory once they are staged
+        files = sorted(glob.glob(os.path.join(data_dir, config['id'])))
+        return [staging.safe_id(f) if builder['sanitize'] else os.path.basename(f) for f in files]
+
+    def base_template():
+        for name in ['complete_template0.nii.gz', 'complete_template.nii.gz']:
+            if os.path.isfile(os.path.join(config['base_run'], name)):
+                return os.path.join(config['base_run'], name)
+        raise AssertionError('No complete template in {}'.format(config['base_run']))
+
+    def incremental_subjects():
+        # subjects of the base run (with their affine transforms) and new subjects
+        base_affines = template_iteration.find_affines(os.path.join(config['base_run'], 'syn'))
+        images = staged_images()
+        existing = {image: base_affines[image] for image in images if image in base_affines}
+        return images, existing, [image for image in images if image not in existing]
+
+    def warm_start(dry_run):
+        images, existing, new = incremental_subjects()
+        print('{} subjects of {}, {} new subjects: {}'.format(len(existing), config['base_run'], len(new), ', '.join(new)))
+        copy(base_template(), complete_template, dry_run)
+        copy(base_template(), os.path.join(run_dir, 'base_' + complete_template), dry_run)
+
+    def register_new(dry_run):
+        images, existing, new = incremental_subjects()
+        new_dir = os.path.join(run_dir, 'new')
+        if dry_run:
+            for index, image in enumerate(new):
+                print('\n'.join(template_iteration.registration_commands(complete_template, image, index, config['syn_steps'], 'new_', new_dir)))
+            return
+        os.makedirs(new_dir, exist_ok=True)
+        print('Registering {} new subjects to {}'.format(len(new), base_template()))
+        template_iteration.register_subjects(complete_template, new, config['syn_steps'], 'new_', new_dir, n_jobs=config['threads'],
+                                             log='stdout-syn-template.txt', executor=executor(), stats_labels={'iteration': 'new'})
+
+    def refine(dry_run):
+        images, existing, new = incremental_subjects()
+        # the first iteration starts from the affine transforms of the base run and of the registrations of the new subjects
+        initial_affines = dict(existing)
+        initial_affines.update(template_iteration.find_affines(os.path.join(run_dir, 'new'), 'new_'))
+        if dry_run:
+            for index, image in enumerate(images):
+                print('\n'.join(template_iteration.registration_commands(complete_template, image, index, config['syn_steps'], initial_affine=initial_affines.get(image))))
+            print('... then the shape update of {}, {} iterations at most'.format(complete_template, config['refine_iterations']))
+            return
+        iterate(images, config['refine_iterations'], initial_affines, reference=base_template())
+
+    def collect(dry_run):
+        move(builder['syn_outputs'] + ['stdout-syn-template.txt', 'stderr-syn-template.txt'], os.path.join(run_dir, 'syn'), dry_run)
+        copy(os.path.join(run_dir, 'syn', complete_template), os.path.join(run_dir, complete_template), dry_run)
+
+    def quality(dry_run):
+        # sharpness, intensity entropy and mean NCC of the subjects warped to the template, to rank builds and sweeps
+        print('python template_quality.py -r {} -n {}'.format(run_dir, config['threads']))
+        if not dry_run:
+            measures = template_quality.assess(run_dir, n_jobs=config['threads'])
+            print('sharpness {:.4g}, entropy {:.3f} bits, mean NCC {} ({} subjects)'.format(
+                measures['sharpness'], measures['entropy'], measures['mean_ncc'], measures['n_subjects']))
+
+    def publish(dry_run):
+        results = os.path.join(results_dir, config['run_name'])
+        assert dry_run or not os.path.exists(results), '{} already exists'.format(results)
+        for pattern in [affine_template, '*.nrrd', 'temp*']:
+            print('rm -rf {}'.format(pattern))
+            # temp* would also match the python modules of the pipeline (template_iteration.py, ...)
+            for f in [f for f in glob.glob(pattern) if not f.endswith('.py')] if not dry_run else []:
+                shutil.rmtree(f) if os.path.isdir(f) else os.remove(f)
+        print('mv {} {}'.format(run_dir, results))
+        if not dry_run:
+            os.makedirs(os.path.dirname(results), exist_ok=True)
+            shutil.move(run_dir, results)
+
+    dag.add('stage', stage, inputs=[os.path.join(data_dir, config['id'])], outputs=[config['id'], manifest_file, os.path.join(run_dir, 'syn')],
+            description='link the data into the working directory')
+    if config['base_run'] is None:
+        dag.add('affine_template', affine, after=['stage'], outputs=[affine_template, os.path.join(run_dir, affine_template)],
+                description='{} iterations of affine template construction'.format(config['affine_iterations']))
+        dag.add('copy_diff', copy_diff, after=['affine_template'], description='link the diff data instead of the data if there is any')
+        dag.add('syn_template', syn, after=['copy_diff'], inputs=[affine_template], outputs=[complete_template],
+                description='{} iterations of SyN template construction ({}, {} executor)'.format(config['syn_iterations'], config['syn_steps'], config['executor']) if config['schedule'] is None
+                else 'progressive SyN template construction ({}, {})'.format(config['schedule'], config['syn_steps']))
+    else:
+        dag.add('warm_start', warm_start, after=['stage'], inputs=[os.path.join(config['base_run'], 'syn')], outputs=[complete_template],
+                description='start from the template of {}'.format(config['base_run']))
+        dag.add('register_new', register_new, after=['warm_start'], outputs=[os.path.join(run_dir, 'new')],
+                description='register the subjects that are not in {} to its template'.format(config['base_run']))
+        dag.add('refine', refine, after=['register_new'], outputs=[complete_template, os.path.join(run_dir, 'syn', 'convergence.csv')],
+                description='{} SyN iterations over all subjects ({})'.format(config['refine_iterations'], config['syn_steps']))
+    dag.add('collect', collect, after=['refine' if config['base_run'] is not None else 'syn_template'], outputs=[os.path.join(run_dir, complete_template)],
+            description='move the SyN results to {}'.format(os.path.join(run_dir, 'syn')))
+    dag.add('quality', quality, after=['collect'], inputs=[os.path.join(run_dir, complete_template)], outputs=[os.path.join(run_dir, template_quality.QUALITY_FILE)],
+            description='measure the quality of the template')
+    dag.add('publish', publish, after=['quality'], outputs=[os.path.join(results_dir, config['run_name'], complete_template)],
+            description='clean up and move {} to ../results'.format(run_dir))
+    return dag
+
+
+def save_config(config):
+    os.makedirs(os.path.join(STATE_DIR, config['run_name']), exist_ok=True)
+    with open(os.path.join(STATE_DIR, config['run_name'], 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def load_config(run_name):
+    config_file = os.path.join(STATE_DIR, run_name, 'config.json')
+    assert os.path.isfile(config_file), 'No build state for {} in {}'.format(run_name, STATE_DIR)
+    with open(config_file, 'r') as f:
+        saved = json.load(f)
+    # parameters that were added after the run was started keep their defaults
+    config = make_config(saved['builder'], saved['region'], run_name=saved['run_name'])
+    config.update(saved)
+    return config
+
+
+if __name__ == '__main__':
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description='Build a template with the ANTs template construction scripts (resumable, one stage at a time)')
+    parser.add_argument('-b', '--builder', type=str, help='Template construction script, incremental, progressive and --executor stealing builds only support mtc (default: mtc)', default='mtc', choices=list(BUILDERS))
+    parser.add_argument('-r', '--region', type=str, help='Region of the template (default: whole_brain)', default='whole_brain', choices=list(REGIONS))
+    parser.add_argument('-d', '--data_dir', type=str, help='Directory with the images (default: ../resampled_data/<region>)', default=None, nargs='?')
+    parser.add_argument('-i', '--id', type=str, help='Identifier (with wildcards) of the images (default: synA647_*.nrrd or Brain*.nrrd)', default=None, nargs='?')
+    parser.add_argument('-t', '--threads', type=int, help='Number of threads (default: 40 or 12, or those of the resumed run)', default=None, nargs='?')
+    parser.add_argument('--affine_iterations', type=int, help='Number of affine template iterations (default: 4, 2 for btp_RA)', default=None, nargs='?')
+    parser.add_argument('--syn_iterations', type=int, help='Number of SyN template iterations (default: 6)', default=6, nargs='?')
+    parser.add_argument('--syn_steps', type=str, help='Iterations at every level of the SyN registrations (default: 60x180x40x20, 60x120x40x20 for the whole brain mtc)', default=None, nargs='?')
+    parser.add_argument('--early_stopping', action='store_true', help='Build the templates one iteration at a time and stop once they have converged')
+    parser.add_argument('--ncc_tolerance', type=float, help='Convergence when 1 - NCC between successive templates is below (default: 1e-3)', default=1e-3, nargs='?')
+    parser.add_argument('--rms_tolerance', type=float, help='Convergence when the relative RMS intensity change is below (default: 1e-2)', default=1e-2, nargs='?')
+    parser.add_argument('--displacement_tolerance', type=float, help='Convergence when the mean shape update displacement (voxels) is below (default: 0.1)', default=0.1, nargs='?')
+    parser.add_argument('--min_iterations', type=int, help='Minimum number of iterations with early stopping (default: 2)', default=2, nargs='?')
+    parser.add_argument('--incremental', type=str, help='Finished run (e.g. ../results/obiroi_cns_mtc_20240101_1200) to update with the new subjects of the data directory (default: build from scratch)', default=None, nargs='?')
+    parser.add_argument('--refine_iterations', type=int, help='Number of SyN iterations over all subjects of an incremental build (default: 2)', default=2, nargs='?')
+    parser.add_argument('--progressive', action='store_true', help='Build the SyN template coarse-to-fine on growing subsets of the subjects')
+    parser.add_argument('--schedule', type=str, help='Fraction of the subjects and downsampling factor of every progressive iteration (default: {})'.format(progressive_template.DEFAULT_SCHEDULE), default=progressive_template.DEFAULT_SCHEDULE, nargs='?')
+    parser.add_argument('--strata_file', type=str, help='Metadata CSV to stratify the progressive subsets by (default: random subsets)', default=None, nargs='?')
+    parser.add_argument('--strata_column', type=str, help='Column of the metadata to stratify by (default: Egocentric Leaning)', default='Egocentric Leaning', nargs='?')
+    parser.add_argument('--seed', type=int, help='Seed of the progressive subsets (default: 0)', default=0, nargs='?')
+    parser.add_argument('--executor', type=str, help='Executor of the SyN registrations: the template construction script or a work-stealing queue run from python (default: ants)', default='ants', choices=EXECUTORS)
+    parser.add_argument('-c', '--cache_dir', type=str, help='Cache of the affine stage shared by the builds (default: ../cache)', default='../cache', nargs='?')
+    parser.add_argument('--no_cache', action='store_true', help='Always run the affine stage')
+    parser.add_argument('--retention', type=str, help='Per-iteration files to keep: all, the final iteration, the templates of every iteration or previews of every iteration (default: all)', default='all', choices=POLICIES)
+    parser.add_argument('--preview_shrink', type=int, help='Downsampling factor of the previews of the preview retention (default: 4)', default=4, nargs='?')
+    parser.add_argument('-n', '--run_name', type=str, help='Name of the run (default: obiroi_<region>_<builder>_<date>)', default=None, nargs='?')
+    parser.add_argument('-w', '--work_dir', type=str, help='Directory to run the build in, relative to group_registration (default: group_registration)', default=None, nargs='?')
+    parser.add_argument('--resume', type=str, help='Name of a run to resume (e.g. obiroi_cns_mtc_20240101_1200), its parameters are reused (default: start a new run)', default=None, nargs='?')
+    parser.add_argument('--from_stage', type=str, help='Run again from this stage on (default: first incomplete stage)', default=None, choices=sorted(set(STAGES + INCREMENTAL_STAGES)))
+    parser.add_argument('--to_stage', type=str, help='Stop after this stage (default: publish)', default=None, choices=sorted(set(STAGES + INCREMENTAL_STAGES)))
+    parser.add_argument('--dry_run', action='store_true', help='Only print the commands of the stages that would run')
+    parser.add_argument('--status', action='store_true', help='Only print which stages of the run are complete')
+    args = parser.parse_args()
+
+    # the ANTs scripts and all paths are relative to the group_registration directory
+    if args.incremental is not None:
+        args.incremental = os.path.abspath(args.incremental)
+    if args.strata_file is not None:
+        args.strata_file = os.path.abspath(args.strata_file)
+    os.chdir(GROUP_REGISTRATION_DIR)
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+        os.chdir(args.work_dir)
+
+    if args.resume is not None:
+        config = load_config(args.resume)
+        # the number of threads does not change the results
+        if args.threads is not None:
+            config['threads'] = args.threads
+    else:
+        config = make_config(args.builder, args.region, args.data_dir, args.id, args.threads, args.affine_iterations, args.syn_iterations, args.syn_steps, args.run_name,
+                             early_stopping=args.early_stopping, ncc_tolerance=args.ncc_tolerance, rms_tolerance=args.rms_tolerance,
+                             displacement_tolerance=args.displacement_tolerance, min_iterations=args.min_iterations,
+                             base_run=args.incremental, refine_iterations=args.refine_iterations,
+                             schedule=args.schedule if args.progressive else None, strata_file=args.strata_file, strata_column=args.strata_column, seed=args.seed,
+                             executor=args.executor, cache_dir=None if args.no_cache else args.cache_dir,
+                             retention=args.retention, preview_shrink=args.preview_shrink)
+    print('Run {}: {}'.format(config['run_name'], json.dumps(config)))
+    dag = build_pipeline(config)
+
+    if args.status:
+        for stage, status in dag.status().items():
+            print('{:>16}: {}'.format(stage, status))
+        sys.exit(0)
+
+    if not args.dry_run:
+        save_config(config)
+    dag.run(from_stage=args.from_stage, to_stage=args.to_stage, dry_run=args.dry_run)
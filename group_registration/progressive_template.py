@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# coarse-to-fine SyN template construction: early iterations register a subset of the subjects to a downsampled template,
+# later iterations add subjects and resolution up to all subjects at the working resolution
+
+import os
+import csv
+import time
+import shutil
+import numpy as np
+import nibabel as nib
+
+import template_iteration
+from template_convergence import read_volume
+
+# fraction of the subjects and downsampling factor of every iteration (the last iterations use every subject at full resolution)
+DEFAULT_SCHEDULE = '0.25:4,0.5:4,0.5:2,1:2,1:1,1:1'
+
+
+def parse_schedule(schedule):
+    """
+    Parses a schedule 'fraction:shrink,fraction:shrink,...' (one entry per iteration, shrink a power of 2)
+    into a list of (fraction of the subjects, downsampling factor).
+    """
+    levels = []
+    for entry in schedule.split(','):
+        fraction, shrink = entry.split(':')
+        fraction, shrink = float(fraction), int(shrink)
+        assert 0 < fraction <= 1, 'Fractions of subjects must be in (0, 1] ({})'.format(entry)
+        assert shrink >= 1 and shrink & (shrink - 1) == 0, 'Downsampling factors must be powers of 2 ({})'.format(entry)
+        levels.append((fraction, shrink))
+    assert levels[-1] == (1, 1), 'Schedules must end with all subjects at full resolution (1:1)'
+    return levels
+
+
+def level_steps(syn_steps, shrink):
+    """
+    Returns the registration iterations of a downsampled level: the images are already shrunk, so the finest
+    log2(shrink) levels of the schedule are dropped (e.g. 60x120x40x20 at shrink 4 is 60x120).
+    """
+    steps = syn_steps.split('x')
+    n_dropped = int(np.log2(shrink))
+    return 'x'.join(steps[:max(1, len(steps) - n_dropped)])
+
+
+def read_strata(metadata_file, column):
+    """
+    Returns the stratum (value of the column) of every clean name (without extension) of a metadata CSV.
+    """
+    with open(metadata_file, 'r') as f:
+        return {os.path.splitext(row['Clean Name'])[0]: row[column] for row in csv.DictReader(f)}
+
+
+def stratum(image, strata):
+    # the longest clean name that the image name (e.g. <clean name>_resampled_0_8x0_8x0_8.nrrd) starts with
+    name = os.path.splitext(os.path.basename(image))[0]
+    matches = [clean for clean in strata if name == clean or name.startswith(clean + '_')]
+    return strata[max(matches, key=len)] if len(matches) > 0 else None
+
+
+def subject_order(images, strata=None, seed=0):
+    """
+    Returns the images in a random order in which every prefix is a subset of the subjects. With strata, every prefix
+    holds the strata in proportion to their sizes (the k-th of n subjects of a stratum is placed at (k + 0.5) / n).
+    """
+    rng = np.random.default_rng(seed)
+    images = [images[i] for i in rng.permutation(len(images))]
+    if strata is None:
+        return images
+    groups = {}
+    for image in images:
+        groups.setdefault(stratum(image, strata), []).append(image)
+    position = {image: ((k + 0.5) / len(group), rng.random()) for group in groups.values() for k, image in enumerate(group)}
+    return sorted(images, key=lambda image: position[image])
+
+
+def voxel_size(image):
+    return np.array(nib.load(image).header.get_zooms()[:3], dtype=np.float64)
+
+
+def resample(image, output, spacing, smooth, log=None):
+    """
+    Resamples an image to a spacing with ResampleImageBySpacing (smoothing first when downsampling).
+    """
+    template_iteration.run('ResampleImageBySpacing 3 {} {} {} {} {} {} 0 0'.format(image, output, *spacing, 1 if smooth else 0), log)
+
+
+def resample_to(image, output, reference, log=None):
+    """
+    Resamples an image onto the grid of a reference image (identity transform, linear interpolation).
+    """
+    template_iteration.run('antsApplyTransforms -d 3 -i {} -o {} -r {} -t identity'.format(image, output, reference), log)
+
+
+def build_progressive(initial_template, images, schedule, syn_steps, output_template, level_root, monitor, initial_affines=None,
+                      n_jobs=1, strata=None, seed=0, early_stopping=False, log=None, executor=None):
+    """
+    Builds the SyN template with one iteration per schedule entry (fraction of the subjects, downsampling factor).
+    Downsampled levels work in level_root/shrink<factor> (downsampled images, template and registrations),
+    the full resolution level works in the directory of output_template so its files are named like those of
+    antsMultivariateTemplateConstruction.sh. Every registration starts from the last affine transform of its subject
+    (initial_affines, e.g. from the affine template stage, for the first one). The cost (seconds, CPU seconds of the
+    ANTs processes) and the template change of every iteration are logged by the ConvergenceMonitor.
+    The registrations run on the executor if given (see template_iteration.register_subjects).
+    """
+    levels = parse_schedule(schedule)
+    order = subject_order(images, strata, seed)
+    affines = dict(initial_affines) if initial_affines is not None else {}
+    full_spacing = voxel_size(initial_template)
+    current, current_shrink = initial_template, None
+    for iteration, (fraction, shrink) in enumerate(levels):
+        start, cpu_start = time.time(), os.times()
+        subjects = order[:max(1, int(round(fraction * len(order))))]
+        if shrink == 1:
+            directory, template = os.path.dirname(output_template) or '.', output_template
+        else:
+            directory = os.path.join(level_root, 'shrink{}'.format(shrink))
+            template = os.path.join(directory, os.path.basename(output_template))
+        os.makedirs(directory, exist_ok=True)
+        # move the template to the grid of the level (the full resolution level goes back to the grid of the initial
+        # template, resampling by spacing can be off by a voxel from it)
+        if shrink != current_shrink:
+            if current != template and shrink == 1:
+                resample_to(current, template, initial_template, log=log)
+            elif current != template:
+                resample(current, template, full_spacing * shrink, smooth=current_shrink is None or shrink > current_shrink, log=log)
+            # the template change of the first iteration of a level is measured against the resampled template
+            monitor.previous = read_volume(template)[0]
+        # downsampled images of the level (full resolution images are used as they are)
+        level_images = []
+        for image in subjects:
+            level_image = image if shrink == 1 else os.path.join(directory, os.path.basename(image))
+            if not os.path.isfile(level_image):
+                resample(image, level_image, full_spacing * shrink, smooth=True, log=log)
+            level_images.append(level_image)
+        steps = level_steps(syn_steps, shrink)
+        print('Progressive iteration {} of {}: {} of {} subjects, downsampled {}x ({})'.format(iteration + 1, len(levels), len(subjects), len(order), shrink, steps))
+        files = template_iteration.register_subjects(template, level_images, steps, directory=directory,
+                                                     initial_affines={os.path.basename(image): affines.get(os.path.basename(image)) for image in subjects},
+                                                     n_jobs=n_jobs, log=log, executor=executor, stats_labels={'iteration': iteration, 'shrink': shrink})
+        warp = template_iteration.shape_update(template, files, directory=directory, log=log)
+        # keep a copy of the affine transforms (the files are overwritten by the next registrations in the same directory)
+        affine_dir = os.path.join(level_root, 'affines')
+        os.makedirs(affine_dir, exist_ok=True)
+        for image, f in zip(subjects, files):
+            affines[os.path.basename(image)] = shutil.copy(f['affine'], os.path.join(affine_dir, os.path.basename(f['affine'])))
+        cpu_end = os.times()
+        converged = monitor.update(iteration, template, warp, time.time() - start,
+                                   cpu_seconds=(cpu_end.children_user - cpu_start.children_user) + (cpu_end.children_system - cpu_start.children_system),
+                                   subjects=len(subjects), shrink=shrink)
+        current, current_shrink = template, shrink
+        final_level = shrink == 1 and len(subjects) == len(order)
+        if early_stopping and final_level and converged:
+            print('template converged after {} of {} iterations'.format(iteration + 1, len(levels)))
+            break
+    return output_template
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# retention of the per-iteration artifacts of a template construction (intermediate templates, shape update warps and
+# the per-iteration backups of all subject warps), applied while the construction runs
+
+import os
+import re
+import glob
+import shutil
+import threading
+import numpy as np
+import nibabel as nib
+
+# all: keep everything (as the scripts do), final: keep the last iteration only,
+# templates: keep the template of every iteration but the warps of the last iteration only,
+# preview: keep a downsampled compressed preview of the template of every iteration and the last iteration
+POLICIES = ['all', 'final', 'templates', 'preview']
+
+TEMPLATE = re.compile(r'template\d*\.nii\.gz$')
+UPDATE_WARP = re.compile(r'(shapeUpdateWarp|template\d*warp)\.nii\.gz$')
+
+
+def iteration_artifacts(directories):
+    """
+    Returns the files of every iteration found in the directories: the intermediateTemplates of
+    antsMultivariateTemplateConstruction(2).sh ({transform}_iteration{i}_...), the backups of buildtemplateparallel.sh
+    and antsMultivariateTemplateConstruction.sh -b 1 ({transform}_iteration_{i}/) and the snapshots of the iterations run
+    one at a time (convergence/iteration{i}_...), as iteration -> {'templates': [...], 'warps': [...], 'directories': [...]}.
+    """
+    iterations = {}
+
+    def add(iteration, f):
+        artifacts = iterations.setdefault(iteration, {'templates': [], 'warps': [], 'directories': []})
+        artifacts['templates' if TEMPLATE.search(os.path.basename(f)) else 'warps'].append(f)
+
+    for directory in directories:
+        for f in glob.glob(os.path.join(directory, 'intermediateTemplates', '*_iteration*_*.nii.gz')):
+            match = re.match(r'[A-Za-z]+_iteration(\d+)_', os.path.basename(f))
+            if match is not None:
+                add(int(match.group(1)), f)
+        for f in glob.glob(os.path.join(directory, 'convergence', 'iteration*_*.nii.gz')):
+            add(int(re.match(r'iteration(\d+)_', os.path.basename(f)).group(1)), f)
+        for backup in glob.glob(os.path.join(directory, '*_iteration_*')):
+            match = re.match(r'[A-Za-z]+_iteration_(\d+)$', os.path.basename(backup))
+            if match is None or not os.path.isdir(backup):
+                continue
+            iteration = int(match.group(1))
+            for f in glob.glob(os.path.join(backup, '*')):
+                add(iteration, f)
+            iterations[iteration]['directories'].append(backup)
+    return iterations
+
+
+def write_preview(template, output, shrink=4, slab=8):
+    """
+    Writes a preview of a template: the mean of blocks of shrink^3 voxels (computed over slabs of the first axis),
+    saved as compressed 16 bit NIfTI.
+    """
+    image = nib.load(template)
+    shape = np.array(image.shape[:3]) // shrink * shrink
+    data = image.dataobj
+    slabs = []
+    for start in range(0, shape[0], shrink * slab):
+        stop = min(start + shrink * slab, shape[0])
+        block = np.asarray(data[start:stop, :shape[1], :shape[2]], dtype=np.float32)
+        slabs.append(block.reshape((stop - start) // shrink, shrink, shape[1] // shrink, shrink, shape[2] // shrink, shrink).mean(axis=(1, 3, 5)))
+    affine = image.affine.copy()
+    affine[:3, :3] *= shrink
+    # the corner of the first block, not the center of the first voxel
+    affine[:3, 3] += image.affine[:3, :3] @ np.full(3, (shrink - 1) / 2.)
+    preview = nib.Nifti1Image(np.concatenate(slabs), affine)
+    # nibabel scales the data to the 16 bit range when saving
+    preview.set_data_dtype(np.int16)
+    nib.save(preview, output)
+
+
+def remove(f):
+    if os.path.isdir(f):
+        shutil.rmtree(f)
+    elif os.path.exists(f):
+        os.remove(f)
+
+
+class Retention:
+    """
+    Applies a retention policy to the iterations of a template construction found in the directories. Only iterations
+    that are followed by a newer iteration are thinned out, so the files the construction is still writing are never touched.
+    Before the files of an iteration are removed, its template change is added to the monitor (a ConvergenceMonitor) if given,
+    so the convergence curve is kept whatever the policy.
+    """
+    def __init__(self, policy, directories, preview_dir=None, preview_shrink=4, monitor=None):
+        assert policy in POLICIES, 'Unknown retention policy {} (policies: {})'.format(policy, ', '.join(POLICIES))
+        self.policy = policy
+        self.directories = directories
+        self.preview_dir = preview_dir
+        self.preview_shrink = preview_shrink
+        self.monitor = monitor
+        self.monitored = set()
+        self.thinned = set()
+        self.lock = threading.Lock()
+
+    def apply(self, final=False):
+        """
+        Thins out every finished iteration (with final, the last iteration is considered finished and kept,
+        apart from a preview). Returns the number of bytes removed.
+        """
+        with self.lock:
+            iterations = iteration_artifacts(self.directories)
+            if len(iterations) == 0:
+                return 0
+            last = max(iterations)
+            removed = 0
+            for iteration in sorted(iterations):
+                if iteration == last and not final:
+                    break
+                artifacts = iterations[iteration]
+                if self.monitor is not None and iteration not in self.monitored:
+                    warps = [f for f in artifacts['warps'] if UPDATE_WARP.search(os.path.basename(f))]
+                    if len(artifacts['templates']) > 0:
+                        self.monitor.update(iteration, sorted(artifacts['templates'])[0], warps[0] if len(warps) > 0 else None)
+                    self.monitored.add(iteration)
+                if self.policy == 'preview' and len(artifacts['templates']) > 0 and iteration not in self.thinned:
+                    os.makedirs(self.preview_dir, exist_ok=True)
+                    write_preview(sorted(artifacts['templates'])[0], os.path.join(self.preview_dir, 'iteration{}_preview.nii.gz'.format(iteration)), self.preview_shrink)
+                if iteration == last or self.policy == 'all' or iteration in self.thinned:
+                    continue
+                targets = artifacts['warps'] if self.policy == 'templates' else artifacts['templates'] + artifacts['warps']
+                for f in targets:
+                    removed += os.path.getsize(f) if os.path.isfile(f) else 0
+                    remove(f)
+                for backup in artifacts['directories']:
+                    if os.path.isdir(backup) and len(os.listdir(backup)) == 0:
+                        os.rmdir(backup)
+                self.thinned.add(iteration)
+            if removed > 0:
+                print('retention ({}): removed {:.1f} MB of the iterations before iteration {}'.format(self.policy, removed / 1024.**2, last))
+            return removed
+
+
+class RetentionWatcher(threading.Thread):
+    """
+    Applies a retention policy every poll_seconds while a template construction script runs (use as a context manager
+    around the script, the last iteration is handled when the context exits).
+    """
+    def __init__(self, retention, poll_seconds=30):
+        super().__init__(daemon=True)
+        self.retention = retention
+        self.poll_seconds = poll_seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.poll_seconds):
+            self.retention.apply()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.join()
+        if exc_type is None:
+            self.retention.apply(final=True)
+        return False
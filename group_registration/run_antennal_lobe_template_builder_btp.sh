@@ -37,20 +37,15 @@ mkdir obiroi_al_btp_$DATE/syn
 # let the user know that the directory structure has been created
 echo "Directory structure created"
 
-## STEP 2: Copy Data to the directory
+## STEP 2: Link Data to the directory
 
-# Copy the data from subdirectory to the current directory ./
+# Link the data into the current directory ./ with every '.' except the one of the extension replaced by '_'
+# (the manifest maps the links back to the data)
 
-cp $DATA_DIRECTORY/$ID ./
+poetry run python ../scripts/staging.py -d $DATA_DIRECTORY -i "$ID" -m obiroi_al_btp_$DATE/staging_manifest.json
 
-# replace all '.' with '_' in the filenames 
-for f in *.nrrd; do mv "$f" `echo $f | tr '.' '_'`; done
-
-# change the last '_' to '.' (reversing the extension change)
-for f in *_nrrd; do mv "$f" "${f%_*}.nrrd"; done
-
-# let the user know that the data has been copied
-echo "Data copied to the current directory"
+# let the user know that the data has been linked
+echo "Data linked to the current directory"
 
 ## STEP 3: Run the registration
 
@@ -89,10 +84,10 @@ echo "Affine template copied to the current directory"
 
 # check if there is a diff folder in the resampled_data directory
 if [ -d "../resampled_data/antennal_lobe/diff" ]; then
-    # Copy the diff data from ../resampled_data/diff to the current directory ./
-    cp ../resampled_data/antennal_lobe/diff/$ID ./
-    # let the user know that the diff data has been copied
-    echo "Diff data copied to the current directory"
+    # Link the diff data instead of the data (copying would write through the links into the data)
+    poetry run python ../scripts/staging.py -d ../resampled_data/antennal_lobe/diff -i "$ID" -m obiroi_al_btp_$DATE/staging_manifest.json
+    # let the user know that the diff data has been linked
+    echo "Diff data linked to the current directory"
 fi
 
 # Let the user know that the syn registration is starting
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# stage DAG with completion markers, resume-from-stage and dry-run for the template building pipelines
+
+import os
+import glob
+import json
+import time
+
+
+class Stage:
+    """
+    One step of a pipeline: run(dry_run) does the work (and only prints what it would do if dry_run is set),
+    inputs and outputs are files or glob patterns that must exist before and after the stage runs.
+    """
+    def __init__(self, name, run, after=(), inputs=(), outputs=(), description=''):
+        self.name = name
+        self.run = run
+        self.after = list(after)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.description = description
+
+
+def missing_files(patterns):
+    """
+    Returns the files or glob patterns that do not match anything.
+    """
+    return [p for p in patterns if len(glob.glob(p)) == 0]
+
+
+class StageDAG:
+    """
+    Stages that run in dependency order. A stage is complete once its marker <state_dir>/<name>.done exists
+    (written after the stage succeeded and its outputs were found), so a rerun resumes after the last completed stage.
+    """
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.stages = {}
+
+    def add(self, name, run, after=(), inputs=(), outputs=(), description=''):
+        for dependency in after:
+            assert dependency in self.stages, 'Unknown stage {} (stages must be added after their dependencies)'.format(dependency)
+        self.stages[name] = Stage(name, run, after, inputs, outputs, description)
+        return self.stages[name]
+
+    def order(self):
+        # stages are added after their dependencies, so the insertion order is a topological order
+        return list(self.stages)
+
+    def descendants(self, name):
+        """
+        Returns the stage and all stages that depend on it (directly or indirectly), in order.
+        """
+        result = {name}
+        for stage in self.order():
+            if any(dependency in result for dependency in self.stages[stage].after):
+                result.add(stage)
+        return [stage for stage in self.order() if stage in result]
+
+    def marker(self, name):
+        return os.path.join(self.state_dir, name + '.done')
+
+    def is_complete(self, name):
+        return os.path.isfile(self.marker(name))
+
+    def invalidate(self, name):
+        """
+        Removes the markers of the stage and of all stages that depend on it, so they run again.
+        """
+        for stage in self.descendants(name):
+            if self.is_complete(stage):
+                os.remove(self.marker(stage))
+
+    def status(self):
+        return {name: 'complete' if self.is_complete(name) else 'pending' for name in self.order()}
+
+    def run(self, from_stage=None, to_stage=None, dry_run=False):
+        """
+        Runs all stages that are not complete yet (from_stage and its descendants always run, stages after to_stage never).
+        """
+        assert from_stage is None or from_stage in self.stages, 'Unknown stage {} (stages: {})'.format(from_stage, ', '.join(self.order()))
+        assert to_stage is None or to_stage in self.stages, 'Unknown stage {} (stages: {})'.format(to_stage, ', '.join(self.order()))
+        rerun = set(self.descendants(from_stage)) if from_stage is not None else set()
+        if not dry_run:
+            os.makedirs(self.state_dir, exist_ok=True)
+            if from_stage is not None:
+                self.invalidate(from_stage)
+        for name in self.order():
+            stage = self.stages[name]
+            if self.is_complete(name) and name not in rerun:
+                print('[{}] complete, skipping'.format(name))
+            else:
+                pending = [d for d in stage.after if not self.is_complete(d)]
+                print('[{}] {}{}'.format(name, 'would run' if dry_run else 'running', ' ({})'.format(stage.description) if stage.description else ''))
+                if not dry_run:
+                    assert len(pending) == 0, 'Stage {} depends on incomplete stages: {}'.format(name, ', '.join(pending))
+                    missing = missing_files(stage.inputs)
+                    assert len(missing) == 0, 'Stage {} is missing its inputs: {}'.format(name, ', '.join(missing))
+                start = time.time()
+                stage.run(dry_run)
+                if not dry_run:
+                    missing = missing_files(stage.outputs)
+                    assert len(missing) == 0, 'Stage {} did not produce its outputs: {}'.format(name, ', '.join(missing))
+                    with open(self.marker(name), 'w') as f:
+                        json.dump({'stage': name, 'finished': time.strftime('%Y-%m-%d %H:%M:%S'), 'seconds': time.time() - start,
+                                   'outputs': stage.outputs}, f, indent=2)
+            if name == to_stage:
+                break
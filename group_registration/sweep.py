@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# sweep over template building variants (a matrix of build_template.py parameters): the affine stages that variants
+# share run once, the builds are launched within one core budget and the templates of the variants are compared in one table
+# (the budget is split statically: a build keeps the threads it was launched with, cores freed by a finished build go
+# to the builds still waiting, not to the builds that are running)
+
+import os
+import re
+import sys
+import csv
+import json
+import glob
+import argparse
+import itertools
+import subprocess
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import build_template
+import template_quality
+from work_stealing import WorkStealingExecutor
+
+SWEEP_DIR = '.sweeps'
+# options of build_template.py that hold paths relative to the working directory (made absolute, the builds run in their own working directories)
+PATH_OPTIONS = ['incremental', 'strata_file']
+
+
+def read_matrix(matrix):
+    """
+    Returns the matrix of a sweep given as JSON or as a JSON file: build_template.py options (without the dashes) mapped
+    to a list of values to sweep over or to a single value shared by all variants.
+    """
+    if os.path.isfile(matrix):
+        with open(matrix, 'r') as f:
+            return json.load(f)
+    return json.loads(matrix)
+
+
+def variants(matrix):
+    """
+    Returns every combination of the values of the matrix as a dictionary of options.
+    """
+    keys = list(matrix)
+    values = [matrix[k] if isinstance(matrix[k], list) else [matrix[k]] for k in keys]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def variant_name(variant, matrix):
+    # the swept values make the name of a variant
+    swept = [k for k in matrix if isinstance(matrix[k], list) and len(matrix[k]) > 1]
+    name = '_'.join('{}-{}'.format(k, variant[k]) for k in swept) if len(swept) > 0 else 'default'
+    return re.sub(r'[^A-Za-z0-9_-]', '_', name)
+
+
+def affine_group(variant):
+    """
+    Returns what the affine stage of a variant depends on (variants with the same group share the cached affine stage),
+    None if the variant has no affine stage or does not use the cache. Fails on variants build_template.py would reject
+    (e.g. a builder other than mtc with incremental, progressive or work-stealing builds).
+    """
+    config = build_template.make_config(variant.get('builder', 'mtc'), variant.get('region', 'whole_brain'), variant.get('data_dir'), variant.get('id'),
+                                        affine_iterations=variant.get('affine_iterations'), run_name='sweep', base_run=variant.get('incremental'),
+                                        schedule='1:1' if variant.get('progressive', False) else None, executor=variant.get('executor', 'ants'))
+    if variant.get('incremental') is not None or variant.get('no_cache', False):
+        return None
+    early_stopping = [variant.get(k) for k in ['ncc_tolerance', 'rms_tolerance', 'displacement_tolerance', 'min_iterations']] if variant.get('early_stopping', False) else None
+    retention = [variant.get('retention', 'all'), variant.get('preview_shrink', 4) if variant.get('retention') == 'preview' else None]
+    return json.dumps([config['builder'], config['data_dir'], config['id'], config['affine_iterations'], early_stopping, retention, variant.get('cache_dir')])
+
+
+def command(variant, run_name, work_dir, to_stage=None, resume=False):
+    """
+    Returns the build_template.py command of a variant (its output goes to build.log). Its threads are the share of the
+    idle cores the executor gives it at launch and do not change while it runs.
+    """
+    arguments = ['--resume', run_name] if resume else ['--run_name', run_name]
+    for k, v in variant.items() if not resume else []:
+        if isinstance(v, bool):
+            arguments += ['--' + k] if v else []
+        else:
+            arguments += ['--' + k, str(v)]
+    if to_stage is not None:
+        arguments += ['--to_stage', to_stage]
+    return '{} {} {} --threads $ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS --work_dir {} >> {} 2>&1'.format(
+        sys.executable, os.path.join(build_template.GROUP_REGISTRATION_DIR, 'build_template.py'), ' '.join('"{}"'.format(a) for a in arguments),
+        work_dir, os.path.join(work_dir, 'build.log'))
+
+
+def last_row(csv_file):
+    if not os.path.isfile(csv_file):
+        return {}
+    with open(csv_file, 'r') as f:
+        rows = list(csv.DictReader(f))
+    return rows[-1] if len(rows) > 0 else {}
+
+
+def compare(runs, results_dir, stats, verification_file=None):
+    """
+    Returns one row per variant: its options, status, time, the last template change and the quality of its template
+    (and the mean verification scores of every analysis if a verification summary is given), best mean NCC first.
+    """
+    verification = {}
+    if verification_file is not None and os.path.isfile(verification_file):
+        with open(verification_file, 'r') as f:
+            for row in csv.DictReader(f):
+                verification.setdefault(row['run'], {}).setdefault(row['analysis'], []).append(float(row['mean']))
+    rows = []
+    for run_name, variant in runs.items():
+        run_dir = os.path.join(results_dir, run_name)
+        steps = [s for s in stats if s['job'] == run_name]
+        templates = [t for t in [os.path.join(run_dir, 'complete_template0.nii.gz'), os.path.join(run_dir, 'complete_template.nii.gz')] if os.path.isfile(t)]
+        convergence = last_row(os.path.join(run_dir, 'syn', 'convergence.csv'))
+        row = {'run': run_name}
+        row.update(variant)
+        row.update({
+            'status': 'done' if len(templates) > 0 else 'failed',
+            'wall_seconds': sum(s['wall_seconds'] for s in steps),
+            'cpu_seconds': sum(s['cpu_seconds'] for s in steps),
+            'iterations': int(convergence['iteration']) + 1 if 'iteration' in convergence else '',
+            'ncc': convergence.get('ncc', ''),
+            'relative_rms_change': convergence.get('relative_rms_change', ''),
+        })
+        if len(templates) > 0:
+            # runs published before the quality stage are measured here
+            quality = template_quality.read_quality(run_dir) or template_quality.assess(run_dir)
+            row.update({k: quality[k] for k in ['sharpness', 'entropy', 'mean_ncc', 'min_ncc']})
+        else:
+            row.update({k: '' for k in ['sharpness', 'entropy', 'mean_ncc', 'min_ncc']})
+        for analysis, means in sorted(verification.get(run_name, {}).items()):
+            row[analysis] = sum(means) / len(means)
+        rows.append(row)
+    # failed variants and variants without warped subjects last
+    return sorted(rows, key=lambda row: -row['mean_ncc'] if isinstance(row['mean_ncc'], float) and row['mean_ncc'] == row['mean_ncc'] else float('inf'))
+
+
+if __name__ == '__main__':
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description='Build several template variants on one core budget and compare them')
+    parser.add_argument('-m', '--matrix', type=str, help='JSON (or JSON file) of build_template.py options, lists are swept over (e.g. \'{"builder": ["mtc", "btp"], "syn_steps": ["60x120x40x20", "60x180x40x20"]}\')', required=True)
+    parser.add_argument('-t', '--threads', type=int, help='Number of cores shared by all builds (default: number of cpus)', default=os.cpu_count(), nargs='?')
+    parser.add_argument('-n', '--name', type=str, help='Name of the sweep (default: sweep_<date>)', default=None, nargs='?')
+    parser.add_argument('--verify', action='store_true', help='Run the verification (../verification/run_verification.py) of every template')
+    parser.add_argument('--dry_run', action='store_true', help='Only print the builds of the sweep')
+    args = parser.parse_args()
+
+    matrix = read_matrix(args.matrix)
+    for k in PATH_OPTIONS:
+        if k in matrix:
+            matrix[k] = [os.path.abspath(v) for v in matrix[k]] if isinstance(matrix[k], list) else os.path.abspath(matrix[k])
+    os.chdir(build_template.GROUP_REGISTRATION_DIR)
+    name = args.name if args.name is not None else 'sweep_{}'.format(datetime.now().strftime('%Y%m%d_%H%M'))
+    results_dir = os.path.join('..', 'results')
+    sweep_results = os.path.join(results_dir, 'sweeps', name)
+    runs = {'{}_{}'.format(name, variant_name(variant, matrix)): variant for variant in variants(matrix)}
+    work_dirs = {run_name: os.path.join(SWEEP_DIR, name, run_name) for run_name in runs}
+
+    # one variant of every group of variants with the same affine stage builds it first, the others copy it from the cache
+    groups = {}
+    for run_name, variant in runs.items():
+        group = affine_group(variant)
+        if group is not None:
+            groups.setdefault(group, []).append(run_name)
+    shared = {members[0]: [command(runs[members[0]], members[0], work_dirs[members[0]], to_stage='affine_template')] for members in groups.values() if len(members) > 1}
+    builds = {run_name: [command(variant, run_name, work_dirs[run_name], resume=run_name in shared)] for run_name, variant in runs.items()}
+
+    print('{} variants, {} shared affine stages, {} cores'.format(len(runs), len(shared), args.threads))
+    for members in groups.values():
+        print('same affine stage: {}'.format(', '.join(members)))
+    if args.dry_run:
+        for commands in list(shared.values()) + list(builds.values()):
+            print(commands[0])
+        sys.exit(0)
+
+    os.makedirs(sweep_results, exist_ok=True)
+    with open(os.path.join(sweep_results, 'sweep.json'), 'w') as f:
+        json.dump({'matrix': matrix, 'runs': runs}, f, indent=2)
+    for work_dir in work_dirs.values():
+        os.makedirs(work_dir, exist_ok=True)
+    executor = WorkStealingExecutor(args.threads, stats_file=os.path.join(sweep_results, 'jobs.csv'), poll_seconds=5, stop_on_failure=False)
+    for phase, jobs in [('affine', shared), ('build', builds)]:
+        try:
+            executor.run(jobs, phase=phase)
+        except AssertionError as error:
+            print('{} (see build.log in {})'.format(error, os.path.join(SWEEP_DIR, name)))
+        if phase == 'affine':
+            # variants whose shared affine stage failed build it themselves
+            for run_name in shared:
+                if not os.path.isfile(os.path.join(work_dirs[run_name], build_template.STATE_DIR, run_name, 'affine_template.done')):
+                    builds[run_name] = [command(runs[run_name], run_name, work_dirs[run_name])]
+
+    verification_file = None
+    finished = [os.path.join(results_dir, run_name) for run_name in runs if len(glob.glob(os.path.join(results_dir, run_name, 'complete_template*.nii.gz'))) > 0]
+    if args.verify and len(finished) > 0:
+        verification_dir = os.path.join(sweep_results, 'verification')
+        status = subprocess.call([sys.executable, os.path.join('..', 'verification', 'run_verification.py'), '-r'] + finished + ['-o', verification_dir, '-n', str(args.threads)])
+        if status != 0:
+            print('The verification failed with exit status {}'.format(status))
+        verification_file = os.path.join(verification_dir, 'verification_summary.csv')
+
+    rows = compare(runs, results_dir, executor.stats, verification_file)
+    fields = []
+    for row in rows:
+        fields += [k for k in row if k not in fields]
+    table_file = os.path.join(sweep_results, 'comparison.csv')
+    with open(table_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    for row in rows:
+        print('{run}: {status}, mean NCC {mean_ncc}, sharpness {sharpness}, entropy {entropy}, {wall_seconds:.0f} s'.format(**row))
+    print('Comparison saved to {}'.format(table_file))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# change between successive templates of a template construction (NCC, RMS intensity change, shape update displacement)
+
+import os
+import re
+import csv
+import glob
+import argparse
+import numpy as np
+import nibabel as nib
+
+FIELDS = ['iteration', 'ncc', 'relative_rms_change', 'mean_displacement', 'max_displacement', 'seconds']
+
+
+def read_volume(filename):
+    """
+    Returns the image data (float32) and the voxel size of a NIfTI image.
+    """
+    image = nib.load(filename)
+    return np.asarray(image.dataobj, dtype=np.float32), np.array(image.header.get_zooms()[:3], dtype=np.float64)
+
+
+def template_change(previous, current, slab=32):
+    """
+    Returns the normalized cross correlation and the RMS intensity change (relative to the RMS intensity of the
+    previous template) between two templates, accumulated over slabs of the first axis.
+    """
+    assert previous.shape == current.shape, 'Templates must have the same shape ({} != {})'.format(previous.shape, current.shape)
+    sums = np.zeros(5)
+    for start in range(0, previous.shape[0], slab):
+        a = previous[start:start + slab].astype(np.float64).ravel()
+        b = current[start:start + slab].astype(np.float64).ravel()
+        sums += [a.sum(), b.sum(), np.dot(a, a), np.dot(b, b), np.dot(a, b)]
+    n = previous.size
+    sum_a, sum_b, sum_aa, sum_bb, sum_ab = sums
+    covariance = sum_ab - sum_a * sum_b / n
+    variance = (sum_aa - sum_a**2 / n) * (sum_bb - sum_b**2 / n)
+    ncc = covariance / np.sqrt(variance) if variance > 0 else np.nan
+    # sum of (b - a)^2 from the same sums
+    rms_change = np.sqrt(max(sum_aa - 2 * sum_ab + sum_bb, 0) / n)
+    relative_rms_change = rms_change / np.sqrt(sum_aa / n) if sum_aa > 0 else np.nan
+    return {'ncc': float(ncc), 'relative_rms_change': float(relative_rms_change)}
+
+
+def update_displacement(warp_file, slab=32):
+    """
+    Returns the mean and maximum displacement (in voxels) of the shape update warp of a template construction iteration.
+    """
+    warp, voxel_size = read_volume(warp_file)
+    # ANTs displacement fields are stored as (x, y, z, 1, 3) in physical units
+    warp = warp.reshape(warp.shape[:3] + (-1,))
+    total, maximum = 0.0, 0.0
+    for start in range(0, warp.shape[0], slab):
+        displacement = np.sqrt(np.sum((warp[start:start + slab] / voxel_size.astype(np.float32))**2, axis=-1))
+        total += displacement.sum(dtype=np.float64)
+        maximum = max(maximum, float(displacement.max()))
+    return {'mean_displacement': total / np.prod(warp.shape[:3]), 'max_displacement': maximum}
+
+
+class ConvergenceMonitor:
+    """
+    Compares the template of every iteration with the one of the previous iteration, appends the change to a CSV
+    convergence curve and reports convergence once every tolerance is met (tolerances that are None are not used):
+    1 - NCC <= ncc_tolerance, relative RMS change <= rms_tolerance and mean update displacement (voxels) <= displacement_tolerance.
+    The first iteration is compared with the reference template if given (e.g. the template a build starts from).
+    """
+    def __init__(self, log_file, ncc_tolerance=1e-3, rms_tolerance=1e-2, displacement_tolerance=0.1, min_iterations=2, reference=None):
+        self.log_file = log_file
+        self.ncc_tolerance = ncc_tolerance
+        self.rms_tolerance = rms_tolerance
+        self.displacement_tolerance = displacement_tolerance
+        self.min_iterations = min_iterations
+        self.previous = read_volume(reference)[0] if reference is not None else None
+        self.curve = []
+
+    def update(self, iteration, template_file, warp_file=None, seconds=np.nan, **extra):
+        """
+        Adds the template of an iteration (and its shape update warp if available) and returns whether the template has converged.
+        Extra keyword arguments are logged as additional columns.
+        """
+        template, _ = read_volume(template_file)
+        row = {'iteration': iteration, 'ncc': np.nan, 'relative_rms_change': np.nan, 'mean_displacement': np.nan, 'max_displacement': np.nan, 'seconds': seconds}
+        row.update(extra)
+        if self.previous is not None and self.previous.shape == template.shape:
+            row.update(template_change(self.previous, template))
+        if warp_file is not None and os.path.isfile(warp_file):
+            row.update(update_displacement(warp_file))
+        self.previous = template
+        self.curve.append(row)
+        write_header = not os.path.isfile(self.log_file)
+        with open(self.log_file, 'a') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS + list(extra))
+            if write_header:
+                writer.writeheader()
+            writer.writerow(row)
+        print('iteration {}: NCC {:.6f}, relative RMS change {:.6f}, mean displacement {:.4f} voxels'.format(
+            iteration, row['ncc'], row['relative_rms_change'], row['mean_displacement']))
+        return self.converged()
+
+    def converged(self):
+        if len(self.curve) < max(self.min_iterations, 2):
+            return False
+        row = self.curve[-1]
+        checks = []
+        if self.ncc_tolerance is not None:
+            checks.append(1 - row['ncc'] <= self.ncc_tolerance)
+        if self.rms_tolerance is not None:
+            checks.append(row['relative_rms_change'] <= self.rms_tolerance)
+        if self.displacement_tolerance is not None and not np.isnan(row['mean_displacement']):
+            checks.append(row['mean_displacement'] <= self.displacement_tolerance)
+        return len(checks) > 0 and all(checks)
+
+
+def intermediate_templates(directory):
+    """
+    Returns the (iteration, template, shape update warp) of every iteration saved by antsMultivariateTemplateConstruction(2).sh
+    in its intermediateTemplates directory, sorted by iteration.
+    """
+    iterations = []
+    for f in glob.glob(os.path.join(directory, '*_iteration*_*template0.nii.gz')):
+        match = re.match(r'(.+)_iteration(\d+)_', os.path.basename(f))
+        warp = os.path.join(directory, '{}_iteration{}_shapeUpdateWarp.nii.gz'.format(match.group(1), match.group(2)))
+        iterations.append((int(match.group(2)), f, warp if os.path.isfile(warp) else None))
+    return sorted(iterations)
+
+
+if __name__ == '__main__':
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description='Convergence curve of a finished template construction (from its intermediateTemplates directory)')
+    parser.add_argument('-r', '--run_dir', type=str, help='Run directory (default: latest ../results/obiroi*)', default=None, nargs='?')
+    parser.add_argument('-s', '--stage', type=str, help='Stage of the run (default: syn)', default='syn', choices=['affine', 'syn'])
+    args = parser.parse_args()
+
+    run_dir = args.run_dir
+    if run_dir is None:
+        runs = [d for d in glob.glob(os.path.join('..', 'results', 'obiroi*')) if os.path.isdir(d)]
+        assert len(runs) > 0, 'No obiroi* runs in ../results'
+        run_dir = max(runs, key=os.path.getctime)
+    directory = os.path.join(run_dir, args.stage, 'intermediateTemplates')
+    iterations = intermediate_templates(directory)
+    assert len(iterations) > 0, 'No intermediate templates in {} (only saved by antsMultivariateTemplateConstruction(2).sh)'.format(directory)
+
+    log_file = os.path.join(run_dir, args.stage, 'convergence.csv')
+    if os.path.isfile(log_file):
+        os.remove(log_file)
+    monitor = ConvergenceMonitor(log_file)
+    for iteration, template, warp in iterations:
+        monitor.update(iteration, template, warp)
+    print('Convergence curve saved to {}'.format(log_file))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# one iteration of greedy SyN (GR) template construction run from Python with the commands of antsMultivariateTemplateConstruction.sh
+# (register every subject to the template, then average and shape update the template), so iterations can be controlled per subject
+
+import os
+import re
+import glob
+import subprocess
+from joblib import Parallel, delayed
+
+# registration parameters of antsMultivariateTemplateConstruction.sh for -t GR -s CC
+TRANSFORMATION = 'SyN[ 0.25 ]'
+REGULARIZATION = 'Gauss[ 3,0 ]'
+LINEAR_PARAMETERS = '--number-of-affine-iterations 10000x10000x1000 --MI-option 32x16000'
+GRADIENT_STEP = 0.25
+
+
+def run(command, log=None):
+    """
+    Runs a command with bash, appending its output to the log file if given.
+    """
+    if log is not None:
+        command = '{} >> {} 2>&1'.format(command, log)
+    status = subprocess.call(command, shell=True, executable='/bin/bash')
+    assert status == 0, 'Command failed with exit status {}: {}'.format(status, command)
+
+
+def subject_files(image, index, prefix='complete_', directory='.'):
+    """
+    Returns the files of a subject named as antsMultivariateTemplateConstruction.sh names them
+    (<prefix><image><index>Warp.nii.gz, ...Affine.txt, <prefix>template0<image><index>WarpedToTemplate.nii.gz).
+    """
+    name = os.path.basename(image)
+    transform = os.path.join(directory, '{}{}{}'.format(prefix, name, index))
+    return {
+        'warp': transform + 'Warp.nii.gz',
+        'inverse_warp': transform + 'InverseWarp.nii.gz',
+        'affine': transform + 'Affine.txt',
+        'warped': os.path.join(directory, '{}template0{}{}WarpedToTemplate.nii.gz'.format(prefix, name, index)),
+        'repaired': os.path.join(directory, '{}template0{}Repaired.nii.gz'.format(prefix, name)),
+        'prefix': transform,
+    }
+
+
+def find_affines(directory, prefix='complete_'):
+    """
+    Returns the affine transform of every subject registered in a directory (image name -> <prefix><image><index>Affine.txt).
+    """
+    affines = {}
+    for f in sorted(glob.glob(os.path.join(directory, prefix + '*Affine.txt'))):
+        match = re.match(re.escape(prefix) + r'(.+?)(\d+)Affine\.txt$', os.path.basename(f))
+        if match is not None and not match.group(1).startswith('template'):
+            affines[match.group(1)] = f
+    return affines
+
+
+def registration_commands(template, image, index, syn_steps, prefix='complete_', directory='.', initial_affine=None, n_threads=1):
+    """
+    Returns the commands that bias correct a subject, register it to the template and warp it to the template
+    (with n_threads ITK threads, or the threads set by the caller if n_threads is None).
+    """
+    files = subject_files(image, index, prefix, directory)
+    threads = 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS={} '.format(n_threads) if n_threads is not None else ''
+    commands = []
+    if not os.path.isfile(files['repaired']) or os.path.getsize(files['repaired']) == 0:
+        commands.append(threads + 'N4BiasFieldCorrection -d 3 -b [ 200 ] -c [ 50x50x40x30,0.00000001 ] -i {} -o {} -r 0 -s 2'.format(image, files['repaired']))
+    initial = ' --initial-affine {}'.format(initial_affine) if initial_affine is not None else ''
+    commands.append(threads + 'ANTS 3 -m CC[ {},{},1,5 ] -i {} -t {} -r {} -o {} --use-Histogram-Matching {}{}'.format(
+        template, files['repaired'], syn_steps, TRANSFORMATION, REGULARIZATION, files['prefix'], LINEAR_PARAMETERS, initial))
+    commands.append(threads + 'WarpImageMultiTransform 3 {} {} -R {} {} {}'.format(files['repaired'], files['warped'], template, files['warp'], files['affine']))
+    return commands
+
+
+def register_subject(template, image, index, syn_steps, prefix='complete_', directory='.', initial_affine=None, n_threads=1, log=None):
+    for command in registration_commands(template, image, index, syn_steps, prefix, directory, initial_affine, n_threads):
+        run(command, log)
+    return subject_files(image, index, prefix, directory)
+
+
+def register_subjects(template, images, syn_steps, prefix='complete_', directory='.', initial_affines=None, n_jobs=1, log=None, executor=None, stats_labels=None):
+    """
+    Registers every image (image i gets the index i) to the template within a budget of n_jobs cores.
+    initial_affines maps image names to affine transforms that initialize their registration.
+    With an executor (work_stealing.WorkStealingExecutor), the commands run on its cores instead of a static joblib pool
+    (stats_labels are added to the stats it records).
+    """
+    initial_affines = initial_affines if initial_affines is not None else {}
+    if executor is not None:
+        jobs = {os.path.basename(image): registration_commands(template, image, index, syn_steps, prefix, directory, initial_affines.get(os.path.basename(image)), None)
+                for index, image in enumerate(images)}
+        executor.run(jobs, **(stats_labels if stats_labels is not None else {}))
+        return [subject_files(image, index, prefix, directory) for index, image in enumerate(images)]
+    n_parallel = max(1, min(n_jobs, len(images)))
+    n_threads = max(1, n_jobs // n_parallel)
+    return Parallel(n_jobs=n_parallel, prefer='threads')(
+        delayed(register_subject)(template, image, index, syn_steps, prefix, directory, initial_affines.get(os.path.basename(image)), n_threads, log)
+        for index, image in enumerate(images))
+
+
+def shape_update(template, files, prefix='complete_', directory='.', gradient_step=GRADIENT_STEP, log=None):
+    """
+    Updates the template as shapeupdatetotemplate of antsMultivariateTemplateConstruction.sh does: the sharpened normalized
+    mean of the warped subjects, moved by the inverse of the average affine transform and the scaled average warp.
+    Returns the shape update warp.
+    """
+    name = os.path.join(directory, '{}template0'.format(prefix))
+    warp, affine = name + 'warp.nii.gz', name + 'Affine.txt'
+    run('AverageImages 3 {} 2 {}'.format(template, ' '.join(f['warped'] for f in files)), log)
+    run('ImageMath 3 {} Sharpen {} 0'.format(template, template), log)
+    run('AverageImages 3 {} 0 {}'.format(warp, ' '.join(f['warp'] for f in files)), log)
+    run('MultiplyImages 3 {} {} {}'.format(warp, -gradient_step, warp), log)
+    run('AverageAffineTransform 3 {} {}'.format(affine, ' '.join(f['affine'] for f in files)), log)
+    run('WarpImageMultiTransform 3 {} {} -i {} -R {}'.format(warp, warp, affine, template), log)
+    run('WarpImageMultiTransform 3 {} {} -i {} {} {} {} {} -R {}'.format(template, template, affine, warp, warp, warp, warp, template), log)
+    return warp
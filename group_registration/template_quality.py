@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# quality measures of a template (sharpness, intensity entropy and mean NCC of the subjects warped to the template)
+# computed over slabs of the first axis so whole brain templates fit in memory, written to template_quality.json of a run
+
+import os
+import glob
+import json
+import argparse
+import numpy as np
+import nibabel as nib
+from joblib import Parallel, delayed
+
+QUALITY_FILE = 'template_quality.json'
+
+
+def slabs(n, slab):
+    for start in range(0, n, slab):
+        yield start, min(start + slab, n)
+
+
+def gradient_energy(filename, slab=32):
+    """
+    Returns the sharpness of a template: the mean squared gradient magnitude (per micron^2) relative to the mean squared
+    intensity, so templates of different intensity scales can be compared (a blurrier template has a lower energy).
+    """
+    image = nib.load(filename)
+    data = image.dataobj
+    spacing = [float(s) for s in image.header.get_zooms()[:3]]
+    n = image.shape[0]
+    assert len(image.shape) == 3 and min(image.shape) > 1, 'Templates must be 3D volumes ({})'.format(filename)
+    gradient_sum, intensity_sum = 0.0, 0.0
+    for start, stop in slabs(n, slab):
+        # one voxel of overlap on both sides so the gradients are those of the whole volume
+        low, high = max(start - 1, 0), min(stop + 1, n)
+        block = np.asarray(data[low:high], dtype=np.float64)
+        gradients = np.gradient(block, *spacing)
+        inner = slice(start - low, start - low + stop - start)
+        gradient_sum += sum(np.sum(g[inner]**2) for g in gradients)
+        intensity_sum += np.sum(block[inner]**2)
+    return float(gradient_sum / intensity_sum) if intensity_sum > 0 else np.nan
+
+
+def intensity_entropy(filename, bins=256, slab=32):
+    """
+    Returns the entropy (bits) of the intensity histogram of the foreground (non-zero voxels) of a template.
+    """
+    data = nib.load(filename).dataobj
+    n = data.shape[0]
+    low, high = np.inf, -np.inf
+    for start, stop in slabs(n, slab):
+        block = np.asarray(data[start:stop], dtype=np.float32)
+        foreground = block[block != 0]
+        if foreground.size > 0:
+            low, high = min(low, float(foreground.min())), max(high, float(foreground.max()))
+    if not np.isfinite(low) or high <= low:
+        return 0.0
+    counts = np.zeros(bins, dtype=np.int64)
+    for start, stop in slabs(n, slab):
+        block = np.asarray(data[start:stop], dtype=np.float32)
+        counts += np.histogram(block[block != 0], bins=bins, range=(low, high))[0]
+    p = counts[counts > 0] / counts.sum()
+    return float(-np.sum(p * np.log2(p)))
+
+
+def ncc(filename_a, filename_b, slab=32):
+    """
+    Returns the normalized cross correlation of two images of the same grid.
+    """
+    a, b = nib.load(filename_a).dataobj, nib.load(filename_b).dataobj
+    assert a.shape[:3] == b.shape[:3], 'Images must have the same shape ({} != {})'.format(a.shape, b.shape)
+    sums = np.zeros(5)
+    for start, stop in slabs(a.shape[0], slab):
+        x = np.asarray(a[start:stop], dtype=np.float64).ravel()
+        y = np.asarray(b[start:stop], dtype=np.float64).ravel()
+        sums += [x.sum(), y.sum(), np.dot(x, x), np.dot(y, y), np.dot(x, y)]
+    n = np.prod(a.shape[:3])
+    sum_x, sum_y, sum_xx, sum_yy, sum_xy = sums
+    variance = (sum_xx - sum_x**2 / n) * (sum_yy - sum_y**2 / n)
+    return float((sum_xy - sum_x * sum_y / n) / np.sqrt(variance)) if variance > 0 else np.nan
+
+
+def run_template(run_dir):
+    # multivariate runs write complete_template0.nii.gz, single channel runs complete_template.nii.gz
+    for name in ['complete_template0.nii.gz', 'complete_template.nii.gz']:
+        if os.path.isfile(os.path.join(run_dir, name)):
+            return os.path.join(run_dir, name)
+    raise AssertionError('No complete template in {}'.format(run_dir))
+
+
+def warped_subjects(run_dir):
+    """
+    Returns the subjects warped to the template by the last iteration of a run (<prefix>template0<image><index>WarpedToTemplate.nii.gz
+    of antsMultivariateTemplateConstruction(2).sh, <prefix><image>deformed.nii.gz of buildtemplateparallel.sh).
+    """
+    syn_dir = os.path.join(run_dir, 'syn')
+    return sorted(glob.glob(os.path.join(syn_dir, '*WarpedToTemplate.nii.gz')) + glob.glob(os.path.join(syn_dir, '*deformed.nii.gz')))
+
+
+def assess(run_dir, n_jobs=1, slab=32):
+    """
+    Computes the quality measures of the template of a run, writes them to <run_dir>/template_quality.json and returns them.
+    """
+    template = run_template(run_dir)
+    subjects = warped_subjects(run_dir)
+    correlations = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(ncc)(template, subject, slab) for subject in subjects)
+    quality = {
+        'template': os.path.basename(template),
+        'sharpness': gradient_energy(template, slab),
+        'entropy': intensity_entropy(template, slab=slab),
+        'mean_ncc': float(np.nanmean(correlations)) if len(correlations) > 0 else None,
+        'min_ncc': float(np.nanmin(correlations)) if len(correlations) > 0 else None,
+        'n_subjects': len(subjects),
+        'subject_ncc': {os.path.basename(subject): correlation for subject, correlation in zip(subjects, correlations)},
+    }
+    with open(os.path.join(run_dir, QUALITY_FILE), 'w') as f:
+        json.dump(quality, f, indent=2)
+    return quality
+
+
+def read_quality(run_dir):
+    """
+    Returns the quality measures saved in a run directory (None if they have not been computed).
+    """
+    quality_file = os.path.join(run_dir, QUALITY_FILE)
+    if not os.path.isfile(quality_file):
+        return None
+    with open(quality_file, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description='Quality measures of the templates of finished runs (sharpness, intensity entropy, mean NCC of the subjects)')
+    parser.add_argument('-r', '--run_dirs', type=str, help='Run directories (default: latest ../results/obiroi*)', default=[], nargs='*')
+    parser.add_argument('-n', '--n_jobs', type=int, help='Number of subjects compared in parallel (default: 1)', default=1, nargs='?')
+    args = parser.parse_args()
+
+    run_dirs = args.run_dirs
+    if len(run_dirs) == 0:
+        runs = [d for d in glob.glob(os.path.join('..', 'results', 'obiroi*')) if os.path.isdir(d)]
+        assert len(runs) > 0, 'No obiroi* runs in ../results'
+        run_dirs = [max(runs, key=os.path.getctime)]
+    for run_dir in run_dirs:
+        quality = assess(run_dir, args.n_jobs)
+        print('{}: sharpness {:.4g}, entropy {:.3f} bits, mean NCC {} ({} subjects)'.format(
+            run_dir, quality['sharpness'], quality['entropy'], quality['mean_ncc'], quality['n_subjects']))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# local executor for the per-subject registrations of a template construction iteration: idle cores take the next
+# step from a shared queue and the long steps (the SyN registrations) launched while the queue drains get the idle cores
+
+import os
+import re
+import csv
+import time
+import subprocess
+from collections import deque
+
+FIELDS = ['job', 'step', 'threads', 'start', 'wall_seconds', 'cpu_seconds', 'max_rss_mb', 'exit_status']
+# the registration steps, minutes to hours per subject while bias correction and warping take seconds
+LONG_STEPS = r'(^|\s)(ANTS|antsRegistration) '
+
+
+class WorkStealingExecutor:
+    """
+    Runs jobs (lists of commands that run one after the other, e.g. N4, ANTS and WarpImageMultiTransform of a subject)
+    on a budget of n_cores cores without a scheduler. The long steps (commands matching long_steps) that have not been
+    launched yet split the cores that the running long steps do not hold: while there are more of them than cores every
+    long step runs single threaded, and the long steps launched as the queue drains (the slow subjects at the tail of
+    an iteration) get the cores freed by the finished ones as ITK threads.
+    Idle cores are held for a waiting long step until the short steps that are running free enough cores, and short steps
+    run single threaded while long steps wait (with no long steps left, they split the idle cores). The threads of a
+    step are fixed when it is launched, so long steps that are already running keep theirs.
+    A job continues with its next step as soon as a step is done. Wall time, CPU time and peak memory of every step
+    are recorded (and appended to stats_file if given). Unless stop_on_failure is False, no step is launched once a step failed.
+    """
+    def __init__(self, n_cores, log=None, stats_file=None, poll_seconds=0.5, stop_on_failure=True, long_steps=LONG_STEPS):
+        self.n_cores = max(1, n_cores)
+        self.long_steps = re.compile(long_steps)
+        self.stop_on_failure = stop_on_failure
+        self.log = log
+        self.stats_file = stats_file
+        self.poll_seconds = poll_seconds
+        self.stats = []
+
+    def launch(self, command, threads):
+        if self.log is not None:
+            command = '{} >> {} 2>&1'.format(command, self.log)
+        environment = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(threads))
+        return subprocess.Popen(command, shell=True, executable='/bin/bash', env=environment)
+
+    def record(self, row):
+        self.stats.append(row)
+        if self.stats_file is not None:
+            write_header = not os.path.isfile(self.stats_file)
+            with open(self.stats_file, 'a') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS + [k for k in row if k not in FIELDS])
+                if write_header:
+                    writer.writeheader()
+                writer.writerow(row)
+
+    def run(self, jobs, **extra):
+        """
+        Runs the jobs, a dictionary of job name -> list of commands. Extra keyword arguments are added to the recorded stats.
+        Raises an AssertionError listing the failed jobs once the running steps are done if any step failed.
+        """
+        ready = deque((name, 0) for name in jobs if len(jobs[name]) > 0)
+        running = {}
+        failed = []
+        free = self.n_cores
+        is_long = {(name, step): self.long_steps.search(command) is not None for name in jobs for step, command in enumerate(jobs[name])}
+        # the long steps that have not been launched yet
+        waiting_long = {key for key in is_long if is_long[key]}
+        while len(ready) > 0 or len(running) > 0:
+            running_short = sum(1 for name, step, _, _, _ in running.values() if not is_long[(name, step)])
+            for name, step in list(ready) if len(failed) == 0 or not self.stop_on_failure else []:
+                if free == 0:
+                    break
+                if is_long[(name, step)]:
+                    # the cores that the running long steps do not hold are split between the long steps not launched yet
+                    long_threads = sum(threads for name_, step_, _, threads, _ in running.values() if is_long[(name_, step_)])
+                    target = max(1, (self.n_cores - long_threads) // len(waiting_long))
+                    if free < target and running_short > 0:
+                        # the idle cores wait for the short steps to finish instead of going to the steps behind
+                        break
+                    threads = min(target, free)
+                    waiting_long.discard((name, step))
+                elif len(waiting_long) > 0:
+                    threads = 1
+                else:
+                    # no long step left to wait for, idle cores are split between the waiting steps
+                    threads = max(1, free // len(ready))
+                ready.remove((name, step))
+                process = self.launch(jobs[name][step], threads)
+                running[process.pid] = (name, step, process, threads, time.time())
+                free -= threads
+                running_short += 0 if is_long[(name, step)] else 1
+            finished = False
+            for pid in list(running):
+                reaped, status, usage = os.wait4(pid, os.WNOHANG)
+                if reaped == 0:
+                    continue
+                finished = True
+                name, step, process, threads, start = running.pop(pid)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                free += threads
+                self.record(dict({'job': name, 'step': step, 'threads': threads, 'start': start, 'wall_seconds': time.time() - start,
+                                  'cpu_seconds': usage.ru_utime + usage.ru_stime, 'max_rss_mb': usage.ru_maxrss / 1024.,
+                                  'exit_status': process.returncode}, **extra))
+                if process.returncode != 0:
+                    failed.append(name)
+                elif step + 1 < len(jobs[name]):
+                    # the job continues before the waiting jobs start (its inputs are still in the page cache)
+                    ready.appendleft((name, step + 1))
+            if len(failed) > 0 and self.stop_on_failure:
+                ready.clear()
+            if not finished:
+                time.sleep(self.poll_seconds)
+        assert len(failed) == 0, 'Failed jobs: {}'.format(', '.join(failed))
+        return self.stats
@@ -27,6 +27,8 @@ import time
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 
+import flip_cache
+
 about_message ="""
 Welcome to the Kronauer Lab Template Registration Toolkit!
 ==========================================================
@@ -375,29 +377,19 @@ class MainWindow(QtWidgets.QMainWindow):
         # create a list of intermediate files
         intermediate_files = []
 
-        # create a list of flip brain commands
-        flip_brain_commands = []
+        # create the flip brain job (the flipped brain is shared through the flip cache)
+        flip_brain_job = None
 
-        # create the flip brain command
         if flip_brain:
-            # define flipped command
-            flipped_input_file = output_directory + os.path.splitext(input_filename)[0]+"_flipped"+os.path.splitext(input_filename)[1]
+            # the reflection matrix is also copied next to the outputs for the warping tools' autofill
             mirror_file = output_directory + ((input_filename[:-5] if input_filename.endswith(".nrrd") else input_filename[:-7]) + '.mat')
-            flip_brain_commands.append("ImageMath 3 {} ReflectionMatrix {} 0 >{}_out.log 2>{}_err.log".format(mirror_file, input_file, mirror_file[:-4], mirror_file[:-4]))
-            flip_brain_commands.append("antsApplyTransforms -d 3 -i {} -o {} -t {} -r {} --float {} >{}_out.log 2>{}_err.log".format(input_file, flipped_input_file, mirror_file, input_file, low_memory_flip, flipped_input_file[:-5], flipped_input_file[:-5]))
+            flip_brain_job = (input_file, low_memory_flip, mirror_file)
             # create a file that be a reminder that the brain was flipped using cat
             flip_marker_file = output_directory + os.path.splitext(input_filename)[0]+"_flipped.txt"
             with open(flip_marker_file, "w") as f:
                 f.write("This file is a reminder that the brain was flipped before registration.")
-            # set the input file to the flipped input file
-            input_file = flipped_input_file
-
-            # add the intermediate files to the list (log files included)
-            intermediate_files.append(flipped_input_file)
-            intermediate_files.append(mirror_file[:-4]+"_out.log")
-            intermediate_files.append(mirror_file[:-4]+"_err.log")
-            intermediate_files.append(flipped_input_file[:-5]+"_out.log")
-            intermediate_files.append(flipped_input_file[:-5]+"_err.log")
+            # the worker replaces the placeholder with the cached flipped input file
+            input_file = flip_cache.FLIPPED
         
         # create the registration command
         registration_command = "antsIntroduction.sh -d 3 -r "+template_file+" -i "+input_file+" -o "+output_prefix+" -m "+num_iterations+" -t "+registration_type+" -n "+n4_bias_field+" -q "+quality_check+" -s "+similarity_metric+" >"+output_prefix+"out.log 2>"+output_prefix+"err.log"
@@ -438,7 +430,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # create a new thread to run the registration command
         self.registration_thread = QtCore.QThread()
-        self.registration_worker = RegistrationWorker(registration_command, flip_brain_commands, output_directory, intermediate_files)
+        self.registration_worker = RegistrationWorker(registration_command, flip_brain_job, output_directory, intermediate_files)
         self.registration_worker.moveToThread(self.registration_thread)
         self.registration_thread.started.connect(self.registration_worker.run_registration)
         self.registration_worker.finished.connect(self.registration_thread.quit)
@@ -510,22 +502,23 @@ class RegistrationWorker(QtCore.QObject):
     finished = QtCore.pyqtSignal()
     progress = QtCore.pyqtSignal(str)
 
-    def __init__(self, registration_command, flip_brain_commands, output_directory, intermediate_files):
+    def __init__(self, registration_command, flip_brain_job, output_directory, intermediate_files):
         super().__init__()
         self.registration_command = registration_command
-        self.flip_brain_commands = flip_brain_commands
+        self.flip_brain_job = flip_brain_job
         self.output_directory = output_directory
         self.intermediate_files = intermediate_files
 
     def run_registration(self):
-        if len(self.flip_brain_commands) > 0:
+        if self.flip_brain_job is not None:
             self.progress.emit("Flipping the brain...")
             self.progress.emit("")
-            # run the flip brain command
-            for command in self.flip_brain_commands:
-                self.progress.emit(command)
-                os.system(command)
-                self.progress.emit("")
+            # get the flipped brain from the flip cache (only computed if it is not cached yet)
+            input_file, low_memory_flip, mirror_file = self.flip_brain_job
+            flipped_file, cached_mirror_file = flip_cache.flip_input(input_file, low_memory_flip, log=self.progress.emit)
+            flip_cache.copy_mirror(cached_mirror_file, mirror_file)
+            self.registration_command = self.registration_command.replace(flip_cache.FLIPPED, flipped_file)
+            self.progress.emit("")
         # run the registration command
         self.progress.emit("Running registration...")
         self.progress.emit("")
@@ -28,6 +28,8 @@ import time
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 
+import flip_cache
+
 about_message ="""
 Welcome to the Kronauer Lab Ultimate Template Registration Toolkit!
 ===================================================================
@@ -444,29 +446,15 @@ class MainWindow(QtWidgets.QMainWindow):
         flip_brain = self.flip_brain_checkbox.isChecked()
         low_memory_flip = "1" if self.low_memory_checkbox.isChecked() else "0"
         intermediate_files = []
-        flip_brain_commands = []
+        flip_brain_job = None
 
-        # Prepare flip brain commands (if needed)
+        # Prepare the flip brain job (if needed); the flipped brain is shared through the flip cache
         if flip_brain:
-            # Define flipped command
-            flipped_input_file = output_prefix + "_flipped.nii.gz"
             mirror_file = output_prefix + "_mirror.mat"
-            flip_brain_commands.append(
-                f"ImageMath 3 {mirror_file} ReflectionMatrix {input_file} 0 >{output_prefix}out.log 2>{output_prefix}err.log"
-            )
-            flip_brain_commands.append(
-                f"antsApplyTransforms -d 3 -i {input_file} -o {flipped_input_file} -t {mirror_file} -r {input_file} --float {low_memory_flip} >{output_prefix}out.log 2>{output_prefix}err.log"
-            )
+            flip_brain_job = (input_file, low_memory_flip, mirror_file)
 
-            # Add intermediate files to the list
-            intermediate_files.append(flipped_input_file)
-            intermediate_files.append(f"{output_prefix}_mirror_out.log")
-            intermediate_files.append(f"{output_prefix}_mirror_err.log")
-            intermediate_files.append(f"{flipped_input_file[:-7]}_out.log")
-            intermediate_files.append(f"{flipped_input_file[:-7]}_err.log")
-
-            # Update input file for the next step
-            input_file = flipped_input_file
+            # Update input file for the next step (the worker replaces the placeholder with the cached flipped input file)
+            input_file = flip_cache.FLIPPED
 
         # Build registration commands for the chain
         commands = []
@@ -494,9 +482,9 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
         # Create and start the registration worker
-        self._start_registration_worker(commands, flip_brain_commands, output_prefix, intermediate_files)
+        self._start_registration_worker(commands, flip_brain_job, output_prefix, intermediate_files)
     
-    def _start_registration_worker(self, commands, flip_brain_commands, output_prefix, intermediate_files):
+    def _start_registration_worker(self, commands, flip_brain_job, output_prefix, intermediate_files):
 
         # check if debug mode is enabled
         if self.debug_mode_checkbox.isChecked():
@@ -513,7 +501,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # Start the registration worker thread
         self.registration_thread = QtCore.QThread()
-        self.registration_worker = RegistrationWorker(commands, flip_brain_commands, output_prefix, intermediate_files)
+        self.registration_worker = RegistrationWorker(commands, flip_brain_job, output_prefix, intermediate_files)
         self.registration_worker.moveToThread(self.registration_thread)
         self.registration_thread.started.connect(self.registration_worker.run_registration)
         self.registration_worker.finished.connect(self.registration_thread.quit)
@@ -572,22 +560,24 @@ class RegistrationWorker(QtCore.QObject):
     finished = QtCore.pyqtSignal()
     progress = QtCore.pyqtSignal(str)
 
-    def __init__(self, registration_commands, flip_brain_commands, output_directory, intermediate_files):
+    def __init__(self, registration_commands, flip_brain_job, output_directory, intermediate_files):
         super().__init__()
         self.registration_commands = registration_commands  # Support multiple commands
-        self.flip_brain_commands = flip_brain_commands
+        self.flip_brain_job = flip_brain_job
         self.output_directory = output_directory
         self.intermediate_files = intermediate_files
 
     def run_registration(self):
         # Flip the brain if required
-        if len(self.flip_brain_commands) > 0:
+        if self.flip_brain_job is not None:
             self.progress.emit("Flipping the brain...")
             self.progress.emit("")
-            for command in self.flip_brain_commands:
-                self.progress.emit(command)
-                os.system(command)
-                self.progress.emit("")
+            # get the flipped brain from the flip cache (only computed if it is not cached yet)
+            input_file, low_memory_flip, mirror_file = self.flip_brain_job
+            flipped_file, cached_mirror_file = flip_cache.flip_input(input_file, low_memory_flip, log=self.progress.emit)
+            flip_cache.copy_mirror(cached_mirror_file, mirror_file)
+            self.registration_commands = [command.replace(flip_cache.FLIPPED, flipped_file) for command in self.registration_commands]
+            self.progress.emit("")
 
         # Execute each registration command
         for idx, command in enumerate(self.registration_commands):
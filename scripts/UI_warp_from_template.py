@@ -7,6 +7,9 @@ import os
 import glob
 from PyQt5 import QtWidgets, QtCore, QtGui
 
+import ants_transforms
+import template_runs
+
 # check if there are no arguments or exactly 4 arguments other than the script name
 if len(sys.argv) == 7:
     _output_directory = sys.argv[1] 
@@ -53,16 +56,36 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # create the input file row
         self.input_row = QtWidgets.QHBoxLayout()
+        # add a checkbox for enabling or disabling batch mode (one transform set applied to several files)
+        self.batch_mode_checkbox = QtWidgets.QCheckBox("Batch Mode")
+        self.batch_mode_checkbox.setChecked(False)
+        self.batch_mode_checkbox.stateChanged.connect(self.toggle_batch_mode)
+        self.selected_input_files = []  # List of selected input files
         self.input_label = QtWidgets.QLabel("File to Warp:")
         self.input_textbox = QtWidgets.QLineEdit()
         self.input_textbox.setReadOnly(True)
         self.input_browse = QtWidgets.QPushButton("Browse")
         self.input_browse.clicked.connect(self.browse_input)
+        self.input_row.addWidget(self.batch_mode_checkbox)
         self.input_row.addWidget(self.input_label)
         self.input_row.addWidget(self.input_textbox)
         self.input_row.addWidget(self.input_browse)
         self.main_layout.addLayout(self.input_row)
 
+        # create the label maps row (batch mode only)
+        self.label_maps_row = QtWidgets.QHBoxLayout()
+        self.selected_label_files = []  # List of selected label maps
+        self.label_maps_label = QtWidgets.QLabel("Label Maps:")
+        self.label_maps_textbox = QtWidgets.QLineEdit()
+        self.label_maps_textbox.setReadOnly(True)
+        self.label_maps_browse = QtWidgets.QPushButton("Browse")
+        self.label_maps_browse.clicked.connect(self.browse_label_maps)
+        self.label_maps_browse.setEnabled(False)
+        self.label_maps_row.addWidget(self.label_maps_label)
+        self.label_maps_row.addWidget(self.label_maps_textbox)
+        self.label_maps_row.addWidget(self.label_maps_browse)
+        self.main_layout.addLayout(self.label_maps_row)
+
         # create the output directory row
         self.output_row = QtWidgets.QHBoxLayout()
         self.output_label = QtWidgets.QLabel("Output Directory:")
@@ -141,6 +164,37 @@ class MainWindow(QtWidgets.QMainWindow):
         self.reflection_row.addWidget(self.reflection_browse)
         self.main_layout.addLayout(self.reflection_row)
 
+        # create the cohort row (warp into every subject of a template building run)
+        self.cohort_row = QtWidgets.QHBoxLayout()
+        self.cohort_mode_checkbox = QtWidgets.QCheckBox("Cohort Mode")
+        self.cohort_mode_checkbox.setChecked(False)
+        self.cohort_mode_checkbox.stateChanged.connect(self.toggle_cohort_mode)
+        self.cohort_label = QtWidgets.QLabel("Results Run:")
+        self.cohort_textbox = QtWidgets.QLineEdit()
+        self.cohort_textbox.setReadOnly(True)
+        self.cohort_browse = QtWidgets.QPushButton("Browse")
+        self.cohort_browse.clicked.connect(self.browse_cohort)
+        self.cohort_row.addWidget(self.cohort_mode_checkbox)
+        self.cohort_row.addWidget(self.cohort_label)
+        self.cohort_row.addWidget(self.cohort_textbox)
+        self.cohort_row.addWidget(self.cohort_browse)
+        self.main_layout.addLayout(self.cohort_row)
+
+        # create the subject images row (cohort mode only, the subject images define each subject's space)
+        self.subject_dir_row = QtWidgets.QHBoxLayout()
+        self.subject_dir_label = QtWidgets.QLabel("Subject Images:")
+        self.subject_dir_textbox = QtWidgets.QLineEdit()
+        self.subject_dir_textbox.setText("./cleaned_data/whole_brain" if os.path.isdir("./cleaned_data/whole_brain") else "")
+        self.subject_dir_textbox.setReadOnly(True)
+        self.subject_dir_browse = QtWidgets.QPushButton("Browse")
+        self.subject_dir_browse.clicked.connect(self.browse_subject_dir)
+        self.subject_dir_row.addWidget(self.subject_dir_label)
+        self.subject_dir_row.addWidget(self.subject_dir_textbox)
+        self.subject_dir_row.addWidget(self.subject_dir_browse)
+        self.main_layout.addLayout(self.subject_dir_row)
+        self.cohort_browse.setEnabled(False)
+        self.subject_dir_browse.setEnabled(False)
+
         # create the special warping row (Volume, Segmentation Label, Point Set)
         self.special_warping_row = QtWidgets.QHBoxLayout()
         self.special_warping_label = QtWidgets.QLabel("Type of Data:")
@@ -168,7 +222,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.special_warping_row.addWidget(self.special_warping_point_set)
         self.main_layout.addLayout(self.special_warping_row)
 
-        # create the row 5 layout (Affine only, Time Series, Low Memory, Mirror after warping, Debug)
+        # create the row 5 layout (Affine only, Time Series, Low Memory, Mirror after warping, Debug, Cores)
         self.final_row = QtWidgets.QHBoxLayout()
         self.affine_only_checkbox = QtWidgets.QCheckBox("Affine Only")
         self.affine_only_checkbox.setChecked(False)
@@ -180,11 +234,17 @@ class MainWindow(QtWidgets.QMainWindow):
         self.flip_brain_checkbox.setChecked(_was_flipped)
         self.debug_mode_checkbox = QtWidgets.QCheckBox("Debug Mode")
         self.debug_mode_checkbox.setChecked(False)
+        self.cores_label = QtWidgets.QLabel("Cores:")
+        self.cores_spinbox = QtWidgets.QSpinBox()
+        self.cores_spinbox.setRange(1, os.cpu_count())
+        self.cores_spinbox.setValue(os.cpu_count())
         self.final_row.addWidget(self.affine_only_checkbox)
         self.final_row.addWidget(self.time_series_checkbox)
         self.final_row.addWidget(self.low_memory_checkbox)
         self.final_row.addWidget(self.flip_brain_checkbox)
         self.final_row.addWidget(self.debug_mode_checkbox)
+        self.final_row.addWidget(self.cores_label)
+        self.final_row.addWidget(self.cores_spinbox)
         self.main_layout.addLayout(self.final_row)
 
         # create the run button
@@ -222,13 +282,55 @@ class MainWindow(QtWidgets.QMainWindow):
     # function to browse for the input file (can be Image Files, or csv files)
     def browse_input(self):
         # open a file dialog
-        open_folder = os.getcwd() if self.input_textbox.text() == "" else os.path.dirname(self.input_textbox.text())
-        filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open Input File', open_folder, 'Image Files (*.nii.gz *.nrrd) ;; CSV Files (*.csv)')[0]
+        open_folder = os.getcwd() if self.input_textbox.text() == "" else os.path.dirname(self.input_textbox.text().split(", ")[0])
+        if not self.batch_mode_checkbox.isChecked():
+            filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open Input File', open_folder, 'Image Files (*.nii.gz *.nrrd) ;; CSV Files (*.csv)')[0]
+            # make sure there are no spaces in the filename and alert the user to change it if there are
+            if self.verify_no_spaces(filename) is False:
+                return
+            # set the textbox to the filename
+            self.input_textbox.setText(filename)
+            self.selected_input_files = [filename]  # Single file mode
+        else:
+            # get multiple files
+            filenames, _ = QtWidgets.QFileDialog.getOpenFileNames(self, 'Open Input Files', open_folder, 'Image Files (*.nii.gz *.nrrd) ;; CSV Files (*.csv)')
+            # make sure there are no spaces in the filename and alert the user to change it if there are
+            for filename in filenames:
+                if self.verify_no_spaces(filename) is False:
+                    return
+            # set the textbox to the filename
+            self.input_textbox.setText(", ".join(filenames))
+            self.selected_input_files = filenames # Batch mode
+
+    # function to browse for the label maps (batch mode only)
+    def browse_label_maps(self):
+        # open a file dialog
+        open_folder = os.getcwd() if self.label_maps_textbox.text() == "" else os.path.dirname(self.label_maps_textbox.text().split(", ")[0])
+        filenames, _ = QtWidgets.QFileDialog.getOpenFileNames(self, 'Open Label Maps', open_folder, 'Image Files (*.nii.gz *.nrrd)')
         # make sure there are no spaces in the filename and alert the user to change it if there are
-        if self.verify_no_spaces(filename) is False:
-            return
-        # set the textbox to the filename
-        self.input_textbox.setText(filename)
+        for filename in filenames:
+            if self.verify_no_spaces(filename) is False:
+                return
+        # set the textbox to the filenames
+        self.label_maps_textbox.setText(", ".join(filenames))
+        self.selected_label_files = filenames
+
+    # function to switch between single and batch mode
+    def toggle_batch_mode(self):
+        if not self.batch_mode_checkbox.isChecked() and (len(self.selected_input_files) > 1 or len(self.selected_label_files) > 0):
+            reply = QtWidgets.QMessageBox.question(
+                self, "Confirm Action",
+                "Disabling batch mode will clear the current file selection. Proceed?",
+                QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No
+            )
+            if reply == QtWidgets.QMessageBox.No:
+                self.batch_mode_checkbox.setChecked(True)
+                return
+        self.input_textbox.clear()
+        self.label_maps_textbox.clear()
+        self.selected_input_files = []
+        self.selected_label_files = []
+        self.label_maps_browse.setEnabled(self.batch_mode_checkbox.isChecked())
 
     # function to browse for the target reference file
     def browse_target(self):
@@ -301,6 +403,43 @@ class MainWindow(QtWidgets.QMainWindow):
         self.output_textbox.setText(filename)
 
 
+    # function to browse for the results run directory
+    def browse_cohort(self):
+        # open a file dialog
+        open_folder = os.path.join(os.getcwd(), "results") if self.cohort_textbox.text() == "" else os.path.dirname(self.cohort_textbox.text())
+        filename = QtWidgets.QFileDialog.getExistingDirectory(self, 'Open Results Run Directory', open_folder)
+        # make sure there are no spaces in the filename and alert the user to change it if there are
+        if self.verify_no_spaces(filename) is False:
+            return
+        # make sure the run has a syn directory
+        if filename != "" and not os.path.isdir(os.path.join(filename, "syn")):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Run directory must contain a syn directory.")
+            return
+        # set the textbox to the filename
+        self.cohort_textbox.setText(filename)
+
+    # function to browse for the subject images directory
+    def browse_subject_dir(self):
+        # open a file dialog
+        open_folder = os.getcwd() if self.subject_dir_textbox.text() == "" else self.subject_dir_textbox.text()
+        filename = QtWidgets.QFileDialog.getExistingDirectory(self, 'Open Subject Images Directory', open_folder)
+        # make sure there are no spaces in the filename and alert the user to change it if there are
+        if self.verify_no_spaces(filename) is False:
+            return
+        # set the textbox to the filename
+        self.subject_dir_textbox.setText(filename)
+
+    # function to switch cohort mode on or off
+    def toggle_cohort_mode(self):
+        cohort_mode = self.cohort_mode_checkbox.isChecked()
+        self.cohort_browse.setEnabled(cohort_mode)
+        self.subject_dir_browse.setEnabled(cohort_mode)
+        # the subject transforms come from the run, so the single subject files are not used
+        self.warp_deformed_browse.setEnabled(not cohort_mode)
+        self.target_browse.setEnabled(not cohort_mode)
+        self.inverse_warp_browse.setEnabled(not cohort_mode)
+        self.affine_browse.setEnabled(not cohort_mode)
+
     # function to browse for the inverse warp file
     def browse_inverse_warp(self):
         # open a file dialog
@@ -352,6 +491,16 @@ class MainWindow(QtWidgets.QMainWindow):
 
     # function to run the warping using ANTs
     def run_warping(self):
+        # cohort mode warps the selected files into every subject of a run
+        if self.cohort_mode_checkbox.isChecked():
+            self.run_cohort_warping()
+            return
+
+        # batch mode, point sets and time series load the transforms once and warp all selected files in-process
+        if self.batch_mode_checkbox.isChecked() or self.special_warping_type == "point_set" or self.time_series_checkbox.isChecked():
+            self.run_batch_warping()
+            return
+
         # Get all files
         input_file = self.input_textbox.text()
         target_file = self.target_textbox.text()
@@ -390,12 +539,12 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # Prepare the warping command
         special_warping_type = self.special_warping_type
-        time_series = self.time_series_checkbox.isChecked()
         low_memory = "1" if self.low_memory_checkbox.isChecked() else "0"
         debug_mode = self.debug_mode_checkbox.isChecked()
 
-        warping_command = f"antsApplyTransforms -d {'4 -e 3' if time_series else '3'}"
-        warping_command += f" -i {input_file} -o {output_prefix[:-1]}.nrrd" if special_warping_type != "point_set" else f" -o {output_prefix[:-1]}.csv"
+        # time series and point sets are warped by run_batch_warping
+        warping_command = "antsApplyTransforms -d 3"
+        warping_command += f" -i {input_file} -o {output_prefix[:-1]}.nrrd"
         warping_command += f" -r {target_file}"
         warping_command += f" -t [{affine_file}, 1]"
         if not affine_only:
@@ -412,7 +561,7 @@ class MainWindow(QtWidgets.QMainWindow):
         intermediate_files = [output_prefix[:-1] + "_out.log", output_prefix[:-1] + "_err.log"]
 
         if self.flip_brain_checkbox.isChecked():
-            mirrored_output_file = output_prefix[:-1] + "_mirrored.nrrd" if special_warping_type != "point_set" else output_prefix[:-1] + "_mirrored.csv"
+            mirrored_output_file = output_prefix[:-1] + "_mirrored.nrrd"
             mirror_file = self.reflection_textbox.text()
             flip_brain_commands.append(
                 f"antsApplyTransforms -d 3 -i {output_prefix[:-1]}.nrrd -o {mirrored_output_file} "
@@ -430,7 +579,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # output file
         else:
-            out_file = output_prefix[:-1] + ".nrrd" if special_warping_type != "point_set" else output_prefix[:-1] + ".csv"
+            out_file = output_prefix[:-1] + ".nrrd"
         
         # save the output file
         self.out_file = out_file
@@ -439,21 +588,7 @@ class MainWindow(QtWidgets.QMainWindow):
             intermediate_files = []
 
         # Disable the UI during processing
-        self.run_button.setEnabled(False)
-        self.input_browse.setEnabled(False)
-        self.warp_deformed_browse.setEnabled(False)
-        self.target_browse.setEnabled(False)
-        self.output_browse.setEnabled(False)
-        self.inverse_warp_browse.setEnabled(False)
-        self.affine_browse.setEnabled(False)
-        self.special_warping_volume.setEnabled(False)
-        self.special_warping_segmentation_label.setEnabled(False)
-        self.special_warping_point_set.setEnabled(False)
-        self.affine_only_checkbox.setEnabled(False)
-        self.time_series_checkbox.setEnabled(False)
-        self.low_memory_checkbox.setEnabled(False)
-        self.flip_brain_checkbox.setEnabled(False)
-        self.debug_mode_checkbox.setEnabled(False)
+        self.set_controls_enabled(False)
 
         # Run warping and mirroring commands in sequence
         self.warping_thread = QtCore.QThread()
@@ -470,24 +605,175 @@ class MainWindow(QtWidgets.QMainWindow):
         self.warping_thread.finished.connect(self.warping_finished)
 
 
+    # function to warp several images and label maps with one transform set (batch mode)
+    def run_batch_warping(self):
+        # get the all files
+        input_files = [f for f in self.selected_input_files if f != ""]
+        label_files = self.selected_label_files
+        target_file = self.target_textbox.text()
+        output_directory = self.output_textbox.text()
+        inverse_warp_file = self.inverse_warp_textbox.text()
+        affine_file = self.affine_textbox.text()
+        affine_only = self.affine_only_checkbox.isChecked()
+
+        # make sure none of the files are empty
+        if len(input_files) + len(label_files) == 0 or target_file == "" or output_directory == "" or affine_file == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "All files must be specified.")
+            return
+
+        if not affine_only and inverse_warp_file == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "Inverse Warp file must be specified for from_template warping.")
+            return
+
+        if self.flip_brain_checkbox.isChecked() and self.reflection_textbox.text() == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "Reflection file must be specified for mirroring.")
+            return
+
+        # time series are warped one timepoint at a time and cannot be combined with label maps or point sets
+        time_series = self.time_series_checkbox.isChecked()
+        if time_series and (len(label_files) > 0 or self.special_warping_type == "point_set"):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Time series cannot be combined with label maps or point sets.")
+            return
+
+        # point sets (CSV files) are transformed without label maps, images must not be CSV files
+        point_set = self.special_warping_type == "point_set"
+        if point_set and (len(label_files) > 0 or not all(f.endswith(".csv") for f in input_files)):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Point sets must be CSV files and cannot be combined with label maps.")
+            return
+        if not point_set and any(f.endswith(".csv") for f in input_files):
+            QtWidgets.QMessageBox.warning(self, "Warning", "CSV files can only be warped as point sets.")
+            return
+
+        # files selected as inputs are warped as the selected data type, label maps always as labels
+        is_label = self.special_warping_type == "segmentation_label"
+        jobs = []
+        for input_file in input_files + label_files:
+            input_filename = os.path.basename(input_file)
+            output_prefix = os.path.join(output_directory, os.path.splitext(input_filename)[0]+"_warped")
+            # make sure no files with the same prefix already exist (use glob)
+            if len(glob.glob(output_prefix+"*")) > 0:
+                QtWidgets.QMessageBox.warning(self, "Warning", "Files with the same prefix already exist ({}). Please change the output directory or the input files.".format(output_prefix))
+                return
+            jobs.append((input_file, output_prefix+("_mirrored" if self.flip_brain_checkbox.isChecked() else "")+(".csv" if point_set else ".nrrd"), is_label or input_file in label_files))
+
+        # build the transform list in antsApplyTransforms order
+        transforms = []
+        # mirroring after warping is folded into the transform list (applied to the outputs last)
+        if self.flip_brain_checkbox.isChecked():
+            transforms.append((self.reflection_textbox.text(), False))
+        transforms.append((affine_file, True))
+        if not affine_only:
+            transforms.append((inverse_warp_file, False))
+
+        # save the output file
+        self.out_file = ", ".join(job[1] for job in jobs)
+
+        # disable all the buttons
+        self.set_controls_enabled(False)
+
+        # create a new thread to run the batch warping
+        self.warping_thread = QtCore.QThread()
+        self.warping_worker = BatchWarpingWorker(jobs, target_file, transforms, point_set, time_series, self.cores_spinbox.value())
+        self.warping_worker.moveToThread(self.warping_thread)
+        self.warping_thread.started.connect(self.warping_worker.run_warping)
+        self.warping_worker.finished.connect(self.warping_thread.quit)
+        self.warping_worker.finished.connect(self.warping_worker.deleteLater)
+        self.warping_thread.finished.connect(self.warping_thread.deleteLater)
+        self.warping_worker.progress.connect(self.update_terminal)
+        self.warping_thread.start()
+
+        # when the thread is finished, print a message and enable the run button
+        self.warping_thread.finished.connect(self.warping_finished)
+
+    # function to warp template-space files into every subject of a results run (cohort mode)
+    def run_cohort_warping(self):
+        # get the all files
+        input_files = [f for f in self.selected_input_files if f != ""]
+        label_files = self.selected_label_files
+        run_dir = self.cohort_textbox.text()
+        subject_dir = self.subject_dir_textbox.text()
+        output_directory = self.output_textbox.text()
+
+        # make sure none of the files are empty
+        if len(input_files) + len(label_files) == 0 or run_dir == "" or subject_dir == "" or output_directory == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "Input files, results run, subject images and output directory must be specified.")
+            return
+
+        # cohort mode only handles 3D volumes and label maps
+        if self.special_warping_type == "point_set" or self.time_series_checkbox.isChecked() or self.flip_brain_checkbox.isChecked():
+            QtWidgets.QMessageBox.warning(self, "Warning", "Cohort mode only supports volumes and segmentation labels (no point sets, time series or mirroring).")
+            return
+
+        # find the transforms of every subject in the run
+        try:
+            subjects = template_runs.find_subject_transforms(run_dir, subject_dir)
+        except AssertionError as error:
+            QtWidgets.QMessageBox.warning(self, "Warning", str(error))
+            return
+        if len(subjects) == 0:
+            QtWidgets.QMessageBox.warning(self, "Warning", "No registered subjects found in {}.".format(run_dir))
+            return
+        missing = [subject["subject"] for subject in subjects if not os.path.isfile(subject["reference"])]
+        if len(missing) > 0:
+            reply = QtWidgets.QMessageBox.question(self, "Missing Subjects", "{} subject image(s) were not found in {} and will be reported as failed:\n{}\nContinue?".format(len(missing), subject_dir, ", ".join(missing)), QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
+            if reply == QtWidgets.QMessageBox.No:
+                return
+
+        # files selected as inputs are warped as the selected data type, label maps always as labels
+        is_label = self.special_warping_type == "segmentation_label"
+        inputs = [(input_file, is_label or input_file in label_files) for input_file in input_files + label_files]
+
+        # save the output file
+        self.out_file = os.path.join(output_directory, "cohort_warping.csv")
+
+        # disable all the buttons
+        self.set_controls_enabled(False)
+
+        # create a new thread to run the cohort warping
+        self.warping_thread = QtCore.QThread()
+        self.warping_worker = CohortWarpingWorker(inputs, subjects, output_directory, self.cores_spinbox.value(), self.affine_only_checkbox.isChecked())
+        self.warping_worker.moveToThread(self.warping_thread)
+        self.warping_thread.started.connect(self.warping_worker.run_warping)
+        self.warping_worker.finished.connect(self.warping_thread.quit)
+        self.warping_worker.finished.connect(self.warping_worker.deleteLater)
+        self.warping_thread.finished.connect(self.warping_thread.deleteLater)
+        self.warping_worker.progress.connect(self.update_terminal)
+        self.warping_thread.start()
+
+        # when the thread is finished, print a message and enable the run button
+        self.warping_thread.finished.connect(self.warping_finished)
+
+    # function to enable or disable all the buttons while a job is running
+    def set_controls_enabled(self, enabled):
+        self.run_button.setEnabled(enabled)
+        self.input_browse.setEnabled(enabled)
+        self.warp_deformed_browse.setEnabled(enabled)
+        self.target_browse.setEnabled(enabled)
+        self.output_browse.setEnabled(enabled)
+        self.inverse_warp_browse.setEnabled(enabled)
+        self.affine_browse.setEnabled(enabled)
+        self.special_warping_volume.setEnabled(enabled)
+        self.special_warping_segmentation_label.setEnabled(enabled)
+        self.special_warping_point_set.setEnabled(enabled)
+        self.affine_only_checkbox.setEnabled(enabled)
+        self.time_series_checkbox.setEnabled(enabled)
+        self.low_memory_checkbox.setEnabled(enabled)
+        self.flip_brain_checkbox.setEnabled(enabled)
+        self.debug_mode_checkbox.setEnabled(enabled)
+        self.cores_spinbox.setEnabled(enabled)
+        self.batch_mode_checkbox.setEnabled(enabled)
+        self.label_maps_browse.setEnabled(enabled and self.batch_mode_checkbox.isChecked())
+        self.cohort_mode_checkbox.setEnabled(enabled)
+        if enabled:
+            self.toggle_cohort_mode()
+        else:
+            self.cohort_browse.setEnabled(False)
+            self.subject_dir_browse.setEnabled(False)
+
     # function to print a message when the warping is finished
     def warping_finished(self):
         # enable all the buttons
-        self.run_button.setEnabled(True)
-        self.input_browse.setEnabled(True)
-        self.target_browse.setEnabled(True)
-        self.warp_deformed_browse.setEnabled(True)
-        self.output_browse.setEnabled(True)
-        self.inverse_warp_browse.setEnabled(True)
-        self.affine_browse.setEnabled(True)
-        self.special_warping_volume.setEnabled(True)
-        self.special_warping_segmentation_label.setEnabled(True)
-        self.special_warping_point_set.setEnabled(True)
-        self.affine_only_checkbox.setEnabled(True)
-        self.time_series_checkbox.setEnabled(True)
-        self.low_memory_checkbox.setEnabled(True)
-        self.flip_brain_checkbox.setEnabled(True)
-        self.debug_mode_checkbox.setEnabled(True)
+        self.set_controls_enabled(True)
 
         # pop up a message box
         QtWidgets.QMessageBox.information(self, "Warping Finished", "Warping finished check the output directory for the registered file: {}".format(self.out_file))
@@ -561,6 +847,73 @@ class WarpingWorker(QtCore.QObject):
         # emit the finished signal
         self.finished.emit()
 
+# create a worker class to warp several files with one transform set
+class BatchWarpingWorker(QtCore.QObject):
+    finished = QtCore.pyqtSignal()
+    progress = QtCore.pyqtSignal(str)
+
+    def __init__(self, jobs, target_file, transforms, point_set, time_series, n_threads):
+        super().__init__()
+        self.jobs = jobs
+        self.target_file = target_file
+        self.transforms = transforms
+        self.point_set = point_set
+        self.time_series = time_series
+        self.n_threads = n_threads
+
+    def run_warping(self):
+        transforms = list(self.transforms)
+        if self.point_set:
+            # points move in the opposite direction of images, so the inverse transforms are used
+            transforms = ants_transforms.invert_transforms(transforms)
+
+        # load the transforms once and warp all files
+        self.progress.emit("Loading transforms...")
+        for transform, inverse in transforms:
+            self.progress.emit("{}{}".format(transform, " (inverted)" if inverse else ""))
+        chain = ants_transforms.TransformChain(transforms)
+        self.progress.emit("")
+        self.progress.emit("Running batch warping...")
+        if self.point_set:
+            ants_transforms.transform_point_files([job[:2] for job in self.jobs], chain, n_threads=self.n_threads, log=self.progress.emit)
+        elif self.time_series:
+            for input_file, output_file, is_label in self.jobs:
+                ants_transforms.warp_time_series(input_file, output_file, self.target_file, chain, is_label=is_label, n_threads=self.n_threads, log=self.progress.emit)
+        else:
+            ants_transforms.warp_images(self.jobs, self.target_file, chain, n_threads=self.n_threads, log=self.progress.emit)
+
+        self.progress.emit("")
+        self.progress.emit("Warping finished.")
+        # emit the finished signal
+        self.finished.emit()
+
+# create a worker class to warp files into every subject of a run
+class CohortWarpingWorker(QtCore.QObject):
+    finished = QtCore.pyqtSignal()
+    progress = QtCore.pyqtSignal(str)
+
+    def __init__(self, inputs, subjects, output_directory, n_cores, affine_only):
+        super().__init__()
+        self.inputs = inputs
+        self.subjects = subjects
+        self.output_directory = output_directory
+        self.n_cores = n_cores
+        self.affine_only = affine_only
+
+    def run_warping(self):
+        self.progress.emit("Running cohort warping...")
+        self.progress.emit("")
+        table = template_runs.propagate_to_cohort(self.inputs, self.subjects, self.output_directory, n_cores=self.n_cores, affine_only=self.affine_only, log=self.progress.emit)
+        failed = table[table["status"] != "done"]["subject"].unique()
+        if len(failed) > 0:
+            self.progress.emit("")
+            self.progress.emit("Failed subjects: {}".format(", ".join(failed)))
+
+        self.progress.emit("")
+        self.progress.emit("Warping finished.")
+        # emit the finished signal
+        self.finished.emit()
+
 # create the main function
 def main():
     # create the application
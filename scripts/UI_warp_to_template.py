@@ -7,6 +7,9 @@ import os
 import glob
 from PyQt5 import QtWidgets, QtCore, QtGui
 
+import flip_cache
+import ants_transforms
+
 # check if there are no arguments or exactly 4 arguments other than the script name
 if len(sys.argv) == 7:
     _output_directory = sys.argv[1] 
@@ -51,16 +54,36 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # create the input file row
         self.input_row = QtWidgets.QHBoxLayout()
+        # add a checkbox for enabling or disabling batch mode (one transform set applied to several files)
+        self.batch_mode_checkbox = QtWidgets.QCheckBox("Batch Mode")
+        self.batch_mode_checkbox.setChecked(False)
+        self.batch_mode_checkbox.stateChanged.connect(self.toggle_batch_mode)
+        self.selected_input_files = []  # List of selected input files
         self.input_label = QtWidgets.QLabel("File to Warp:")
         self.input_textbox = QtWidgets.QLineEdit()
         self.input_textbox.setReadOnly(True)
         self.input_browse = QtWidgets.QPushButton("Browse")
         self.input_browse.clicked.connect(self.browse_input)
+        self.input_row.addWidget(self.batch_mode_checkbox)
         self.input_row.addWidget(self.input_label)
         self.input_row.addWidget(self.input_textbox)
         self.input_row.addWidget(self.input_browse)
         self.main_layout.addLayout(self.input_row)
 
+        # create the label maps row (batch mode only)
+        self.label_maps_row = QtWidgets.QHBoxLayout()
+        self.selected_label_files = []  # List of selected label maps
+        self.label_maps_label = QtWidgets.QLabel("Label Maps:")
+        self.label_maps_textbox = QtWidgets.QLineEdit()
+        self.label_maps_textbox.setReadOnly(True)
+        self.label_maps_browse = QtWidgets.QPushButton("Browse")
+        self.label_maps_browse.clicked.connect(self.browse_label_maps)
+        self.label_maps_browse.setEnabled(False)
+        self.label_maps_row.addWidget(self.label_maps_label)
+        self.label_maps_row.addWidget(self.label_maps_textbox)
+        self.label_maps_row.addWidget(self.label_maps_browse)
+        self.main_layout.addLayout(self.label_maps_row)
+
         # create the output directory row
         self.output_row = QtWidgets.QHBoxLayout()
         self.output_label = QtWidgets.QLabel("Output Directory:")
@@ -154,7 +177,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.special_warping_row.addWidget(self.special_warping_point_set)
         self.main_layout.addLayout(self.special_warping_row)
 
-        # create the row 5 layout (Affine only, Time Series, Low Memory, Mirror before warping, Debug)
+        # create the row 5 layout (Affine only, Time Series, Low Memory, Mirror before warping, Debug, Cores)
         self.final_row = QtWidgets.QHBoxLayout()
         self.affine_only_checkbox = QtWidgets.QCheckBox("Affine Only")
         self.affine_only_checkbox.setChecked(False)
@@ -170,7 +193,13 @@ class MainWindow(QtWidgets.QMainWindow):
         self.final_row.addWidget(self.time_series_checkbox)
         self.final_row.addWidget(self.low_memory_checkbox)
         self.final_row.addWidget(self.flip_brain_checkbox)
+        self.cores_label = QtWidgets.QLabel("Cores:")
+        self.cores_spinbox = QtWidgets.QSpinBox()
+        self.cores_spinbox.setRange(1, os.cpu_count())
+        self.cores_spinbox.setValue(os.cpu_count())
         self.final_row.addWidget(self.debug_mode_checkbox)
+        self.final_row.addWidget(self.cores_label)
+        self.final_row.addWidget(self.cores_spinbox)
         self.main_layout.addLayout(self.final_row)
 
         # create the run button
@@ -204,13 +233,55 @@ class MainWindow(QtWidgets.QMainWindow):
     # function to browse for the input file (can be Image Files, or csv files)
     def browse_input(self):
         # open a file dialog
-        open_folder = os.getcwd() if self.input_textbox.text() == "" else os.path.dirname(self.input_textbox.text())
-        filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open Input File', open_folder, 'Image Files (*.nii.gz *.nrrd) ;; CSV Files (*.csv)')[0]
+        open_folder = os.getcwd() if self.input_textbox.text() == "" else os.path.dirname(self.input_textbox.text().split(", ")[0])
+        if not self.batch_mode_checkbox.isChecked():
+            filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open Input File', open_folder, 'Image Files (*.nii.gz *.nrrd) ;; CSV Files (*.csv)')[0]
+            # make sure there are no spaces in the filename and alert the user to change it if there are
+            if self.verify_no_spaces(filename) is False:
+                return
+            # set the textbox to the filename
+            self.input_textbox.setText(filename)
+            self.selected_input_files = [filename]  # Single file mode
+        else:
+            # get multiple files
+            filenames, _ = QtWidgets.QFileDialog.getOpenFileNames(self, 'Open Input Files', open_folder, 'Image Files (*.nii.gz *.nrrd) ;; CSV Files (*.csv)')
+            # make sure there are no spaces in the filename and alert the user to change it if there are
+            for filename in filenames:
+                if self.verify_no_spaces(filename) is False:
+                    return
+            # set the textbox to the filename
+            self.input_textbox.setText(", ".join(filenames))
+            self.selected_input_files = filenames # Batch mode
+
+    # function to browse for the label maps (batch mode only)
+    def browse_label_maps(self):
+        # open a file dialog
+        open_folder = os.getcwd() if self.label_maps_textbox.text() == "" else os.path.dirname(self.label_maps_textbox.text().split(", ")[0])
+        filenames, _ = QtWidgets.QFileDialog.getOpenFileNames(self, 'Open Label Maps', open_folder, 'Image Files (*.nii.gz *.nrrd)')
         # make sure there are no spaces in the filename and alert the user to change it if there are
-        if self.verify_no_spaces(filename) is False:
-            return
-        # set the textbox to the filename
-        self.input_textbox.setText(filename)
+        for filename in filenames:
+            if self.verify_no_spaces(filename) is False:
+                return
+        # set the textbox to the filenames
+        self.label_maps_textbox.setText(", ".join(filenames))
+        self.selected_label_files = filenames
+
+    # function to switch between single and batch mode
+    def toggle_batch_mode(self):
+        if not self.batch_mode_checkbox.isChecked() and (len(self.selected_input_files) > 1 or len(self.selected_label_files) > 0):
+            reply = QtWidgets.QMessageBox.question(
+                self, "Confirm Action",
+                "Disabling batch mode will clear the current file selection. Proceed?",
+                QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No
+            )
+            if reply == QtWidgets.QMessageBox.No:
+                self.batch_mode_checkbox.setChecked(True)
+                return
+        self.input_textbox.clear()
+        self.label_maps_textbox.clear()
+        self.selected_input_files = []
+        self.selected_label_files = []
+        self.label_maps_browse.setEnabled(self.batch_mode_checkbox.isChecked())
 
     # function to browse for the target reference file
     def browse_target(self):
@@ -317,6 +388,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
     # function to run the warping using ANTs
     def run_warping(self):
+        # batch mode, point sets and time series load the transforms once and warp all selected files in-process
+        if self.batch_mode_checkbox.isChecked() or self.special_warping_type == "point_set" or self.time_series_checkbox.isChecked():
+            self.run_batch_warping()
+            return
+
         # get the all files
         input_file = self.input_textbox.text()
         target_file = self.target_textbox.text()
@@ -349,33 +425,25 @@ class MainWindow(QtWidgets.QMainWindow):
             return
 
         special_warping_type = self.special_warping_type
-        time_series = self.time_series_checkbox.isChecked()
         low_memory = "1" if self.low_memory_checkbox.isChecked() else "0"
         flip_brain = self.flip_brain_checkbox.isChecked()
         debug_mode = self.debug_mode_checkbox.isChecked()
 
         intermediate_files = []
-        flip_brain_commands = []
+        flip_job = None
 
         if flip_brain:
 
-            flipped_input_file = output_directory + os.path.splitext(input_filename)[0]+"_flipped"+os.path.splitext(input_filename)[1]
+            # the flipped input is shared with the registration tools through the flip cache
+            # (the worker replaces the placeholder with the cached flipped input file)
             mirror_file = self.reflection_textbox.text()
-            flip_brain_commands.append("antsApplyTransforms -d 3 -i {} -o {} -t {} -r {} --float {} >{}_out.log 2>{}_err.log".format(input_file, flipped_input_file, mirror_file, input_file, low_memory, flipped_input_file[:-5], flipped_input_file[:-5]))
-            input_file = flipped_input_file
-
-            # intermediate files
-            intermediate_files.append(flipped_input_file)
-            intermediate_files.append(mirror_file[:-4]+"_out.log")
-            intermediate_files.append(mirror_file[:-4]+"_err.log")
-            intermediate_files.append(flipped_input_file[:-5]+"_out.log")
-            intermediate_files.append(flipped_input_file[:-5]+"_err.log")
-
-        # create the command
-        warping_command = "antsApplyTransforms" # base command
-        warping_command += " -d 4 -e 3" if time_series else " -d 3"
+            flip_job = (input_file, low_memory, mirror_file if mirror_file != "" else None)
+            input_file = flip_cache.FLIPPED
+
+        # create the command (time series and point sets are warped by run_batch_warping)
+        warping_command = "antsApplyTransforms -d 3" # base command
         warping_command += " -i "+input_file
-        warping_command += " -o "+output_prefix[:-1]+".nrrd" if not special_warping_type == "point_set" else " -o "+output_prefix[:-1]+".csv"
+        warping_command += " -o "+output_prefix[:-1]+".nrrd"
         warping_command += " -r "+target_file
 
         if not affine_only:
@@ -396,7 +464,7 @@ class MainWindow(QtWidgets.QMainWindow):
         intermediate_files.append(output_prefix[:-1]+"_err.log")
 
         # output file
-        out_file = output_prefix[:-1]+".nrrd" if not special_warping_type == "point_set" else output_prefix[:-1]+".csv"
+        out_file = output_prefix[:-1]+".nrrd"
         
         # save the output file
         self.out_file = out_file
@@ -405,25 +473,12 @@ class MainWindow(QtWidgets.QMainWindow):
             intermediate_files = []
 
         # disable all the buttons
-        self.run_button.setEnabled(False)
-        self.input_browse.setEnabled(False)
-        self.target_browse.setEnabled(False)
-        self.output_browse.setEnabled(False)
-        self.warp_browse.setEnabled(False)
-        self.affine_browse.setEnabled(False)
-        self.special_warping_volume.setEnabled(False)
-        self.special_warping_segmentation_label.setEnabled(False)
-        self.special_warping_point_set.setEnabled(False)
-        self.affine_only_checkbox.setEnabled(False)
-        self.time_series_checkbox.setEnabled(False)
-        self.low_memory_checkbox.setEnabled(False)
-        self.flip_brain_checkbox.setEnabled(False)
-        self.debug_mode_checkbox.setEnabled(False)
+        self.set_controls_enabled(False)
 
 
         # create a new thread to run the warping command
         self.warping_thread = QtCore.QThread()
-        self.warping_worker = WarpingWorker(warping_command, flip_brain_commands, intermediate_files)
+        self.warping_worker = WarpingWorker(warping_command, flip_job, intermediate_files)
         self.warping_worker.moveToThread(self.warping_thread)
         self.warping_thread.started.connect(self.warping_worker.run_warping)
         self.warping_worker.finished.connect(self.warping_thread.quit)
@@ -435,23 +490,114 @@ class MainWindow(QtWidgets.QMainWindow):
         # when the thread is finished, print a message and enable the run button
         self.warping_thread.finished.connect(self.warping_finished)
 
+    # function to warp several images and label maps with one transform set (batch mode)
+    def run_batch_warping(self):
+        # get the all files
+        input_files = [f for f in self.selected_input_files if f != ""]
+        label_files = self.selected_label_files
+        target_file = self.target_textbox.text()
+        output_directory = self.output_textbox.text()
+        warp_file = self.warp_textbox.text()
+        affine_file = self.affine_textbox.text()
+        affine_only = self.affine_only_checkbox.isChecked()
+
+        # make sure none of the files are empty
+        if len(input_files) + len(label_files) == 0 or target_file == "" or output_directory == "" or affine_file == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "All files must be specified.")
+            return
+
+        if affine_only == False and warp_file == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "Warp file must be specified for to_template warping.")
+            return
+
+        # time series are warped one timepoint at a time and cannot be combined with label maps or point sets
+        time_series = self.time_series_checkbox.isChecked()
+        if time_series and (len(label_files) > 0 or self.special_warping_type == "point_set"):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Time series cannot be combined with label maps or point sets.")
+            return
+        if time_series and self.flip_brain_checkbox.isChecked() and self.reflection_textbox.text() == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "Reflection file must be specified for mirroring time series.")
+            return
+
+        # point sets (CSV files) are transformed without label maps, images must not be CSV files
+        point_set = self.special_warping_type == "point_set"
+        if point_set and (len(label_files) > 0 or not all(f.endswith(".csv") for f in input_files)):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Point sets must be CSV files and cannot be combined with label maps.")
+            return
+        if not point_set and any(f.endswith(".csv") for f in input_files):
+            QtWidgets.QMessageBox.warning(self, "Warning", "CSV files can only be warped as point sets.")
+            return
+        if point_set and self.flip_brain_checkbox.isChecked() and self.reflection_textbox.text() == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "Reflection file must be specified for mirroring point sets.")
+            return
+
+        # files selected as inputs are warped as the selected data type, label maps always as labels
+        is_label = self.special_warping_type == "segmentation_label"
+        jobs = []
+        for input_file in input_files + label_files:
+            input_filename = os.path.basename(input_file)
+            output_prefix = os.path.join(output_directory, os.path.splitext(input_filename)[0]+"_warped")
+            # make sure no files with the same prefix already exist (use glob)
+            if len(glob.glob(output_prefix+"*")) > 0:
+                QtWidgets.QMessageBox.warning(self, "Warning", "Files with the same prefix already exist ({}). Please change the output directory or the input files.".format(output_prefix))
+                return
+            jobs.append((input_file, output_prefix+(".csv" if point_set else ".nrrd"), is_label or input_file in label_files))
+
+        # build the transform list in antsApplyTransforms order
+        transforms = []
+        if not affine_only:
+            transforms.append((warp_file, False))
+        transforms.append((affine_file, False))
+
+        # mirroring before warping is applied to the inputs first, with the given reflection file or, without one,
+        # with the reflection matrix of each input image from the flip cache (built in the worker, it hashes the inputs)
+        flip_brain = self.flip_brain_checkbox.isChecked()
+        mirror_file = self.reflection_textbox.text() if self.reflection_textbox.text() != "" else None
+
+        # save the output file
+        self.out_file = ", ".join(job[1] for job in jobs)
+
+        # disable all the buttons
+        self.set_controls_enabled(False)
+
+        # create a new thread to run the batch warping
+        self.warping_thread = QtCore.QThread()
+        self.warping_worker = BatchWarpingWorker(jobs, target_file, transforms, flip_brain, mirror_file, point_set, time_series, self.cores_spinbox.value())
+        self.warping_worker.moveToThread(self.warping_thread)
+        self.warping_thread.started.connect(self.warping_worker.run_warping)
+        self.warping_worker.finished.connect(self.warping_thread.quit)
+        self.warping_worker.finished.connect(self.warping_worker.deleteLater)
+        self.warping_thread.finished.connect(self.warping_thread.deleteLater)
+        self.warping_worker.progress.connect(self.update_terminal)
+        self.warping_thread.start()
+
+        # when the thread is finished, print a message and enable the run button
+        self.warping_thread.finished.connect(self.warping_finished)
+
+    # function to enable or disable all the buttons while a job is running
+    def set_controls_enabled(self, enabled):
+        self.run_button.setEnabled(enabled)
+        self.input_browse.setEnabled(enabled)
+        self.target_browse.setEnabled(enabled)
+        self.output_browse.setEnabled(enabled)
+        self.warp_browse.setEnabled(enabled)
+        self.affine_browse.setEnabled(enabled)
+        self.special_warping_volume.setEnabled(enabled)
+        self.special_warping_segmentation_label.setEnabled(enabled)
+        self.special_warping_point_set.setEnabled(enabled)
+        self.affine_only_checkbox.setEnabled(enabled)
+        self.time_series_checkbox.setEnabled(enabled)
+        self.low_memory_checkbox.setEnabled(enabled)
+        self.flip_brain_checkbox.setEnabled(enabled)
+        self.debug_mode_checkbox.setEnabled(enabled)
+        self.cores_spinbox.setEnabled(enabled)
+        self.batch_mode_checkbox.setEnabled(enabled)
+        self.label_maps_browse.setEnabled(enabled and self.batch_mode_checkbox.isChecked())
+
     # function to print a message when the warping is finished
     def warping_finished(self):
         # enable all the buttons
-        self.run_button.setEnabled(True)
-        self.input_browse.setEnabled(True)
-        self.target_browse.setEnabled(True)
-        self.output_browse.setEnabled(True)
-        self.warp_browse.setEnabled(True)
-        self.affine_browse.setEnabled(True)
-        self.special_warping_volume.setEnabled(True)
-        self.special_warping_segmentation_label.setEnabled(True)
-        self.special_warping_point_set.setEnabled(True)
-        self.affine_only_checkbox.setEnabled(True)
-        self.time_series_checkbox.setEnabled(True)
-        self.low_memory_checkbox.setEnabled(True)
-        self.flip_brain_checkbox.setEnabled(True)
-        self.debug_mode_checkbox.setEnabled(True)
+        self.set_controls_enabled(True)
 
         # pop up a message box
         QtWidgets.QMessageBox.information(self, "Warping Finished", "Warping finished check the output directory for the registered file: {}".format(self.out_file))
@@ -465,21 +611,21 @@ class WarpingWorker(QtCore.QObject):
     finished = QtCore.pyqtSignal()
     progress = QtCore.pyqtSignal(str)
 
-    def __init__(self, warping_command, flip_brain_commands, intermediate_files):
+    def __init__(self, warping_command, flip_job, intermediate_files):
         super().__init__()
         self.warping_command = warping_command
-        self.flip_brain_commands = flip_brain_commands
+        self.flip_job = flip_job
         self.intermediate_files = intermediate_files
 
     def run_warping(self):
-        if len(self.flip_brain_commands) > 0:
+        if self.flip_job is not None:
             self.progress.emit("Flipping brain...")
             self.progress.emit("")
-            # run the flip brain command
-            for command in self.flip_brain_commands:
-                self.progress.emit(command)
-                os.system(command)
-                self.progress.emit("")
+            # get the flipped brain from the flip cache (only computed if it is not cached yet)
+            input_file, low_memory, mirror_file = self.flip_job
+            flipped_file, _ = flip_cache.flip_input(input_file, low_memory, mirror_file, log=self.progress.emit)
+            self.warping_command = self.warping_command.replace(flip_cache.FLIPPED, flipped_file)
+            self.progress.emit("")
 
         # run the warping command
         self.progress.emit("Running warping...")
@@ -524,6 +670,64 @@ class WarpingWorker(QtCore.QObject):
         # emit the finished signal
         self.finished.emit()
 
+# create a worker class to warp several files with one transform set
+class BatchWarpingWorker(QtCore.QObject):
+    finished = QtCore.pyqtSignal()
+    progress = QtCore.pyqtSignal(str)
+
+    def __init__(self, jobs, target_file, transforms, flip_brain, mirror_file, point_set, time_series, n_threads):
+        super().__init__()
+        self.jobs = jobs
+        self.target_file = target_file
+        self.transforms = transforms
+        self.flip_brain = flip_brain
+        self.mirror_file = mirror_file
+        self.point_set = point_set
+        self.time_series = time_series
+        self.n_threads = n_threads
+
+    def run_warping(self):
+        transforms = list(self.transforms)
+        input_transforms = None
+        if self.flip_brain and (self.point_set or self.time_series):
+            # point sets and time series are mirrored with the given reflection file (applied before the other transforms)
+            assert self.mirror_file is not None, "A reflection file is required to mirror point sets and time series."
+            transforms.append((self.mirror_file, False))
+        elif self.flip_brain:
+            # every image is mirrored about its own center with its reflection matrix from the flip cache
+            # (or with the given reflection file), applied before the other transforms
+            self.progress.emit("Getting reflection matrices...")
+            input_transforms = []
+            for input_file, _, _ in self.jobs:
+                if self.mirror_file is not None:
+                    input_transforms.append(self.mirror_file)
+                else:
+                    input_transforms.append(flip_cache.ensure_mirror(flip_cache.cache_entry(input_file), log=self.progress.emit))
+            self.progress.emit("")
+        if self.point_set:
+            # points move in the opposite direction of images, so the inverse transforms are used
+            transforms = ants_transforms.invert_transforms(transforms)
+
+        # load the transforms once and warp all files
+        self.progress.emit("Loading transforms...")
+        for transform, inverse in transforms:
+            self.progress.emit("{}{}".format(transform, " (inverted)" if inverse else ""))
+        chain = ants_transforms.TransformChain(transforms)
+        self.progress.emit("")
+        self.progress.emit("Running batch warping...")
+        if self.point_set:
+            ants_transforms.transform_point_files([job[:2] for job in self.jobs], chain, n_threads=self.n_threads, log=self.progress.emit)
+        elif self.time_series:
+            for input_file, output_file, is_label in self.jobs:
+                ants_transforms.warp_time_series(input_file, output_file, self.target_file, chain, is_label=is_label, n_threads=self.n_threads, log=self.progress.emit)
+        else:
+            ants_transforms.warp_images(self.jobs, self.target_file, chain, n_threads=self.n_threads, log=self.progress.emit, input_transforms=input_transforms)
+
+        self.progress.emit("")
+        self.progress.emit("Warping finished.")
+        # emit the finished signal
+        self.finished.emit()
+
 # create the main function
 def main():
     # create the application
@@ -0,0 +1,355 @@
+# in-process application of ANTs transforms (affine matrices and displacement fields) to images and point sets
+
+import os # file handling
+import numpy as np # linear algebra
+import pandas as pd # point set CSV files
+import nrrd # NRRD file I/O
+import nibabel as nib # NIfTI file I/O
+from scipy import io as sio # MATLAB (.mat) transform files
+from scipy import ndimage # interpolation
+from concurrent.futures import ThreadPoolExecutor # parallel processing
+
+# ITK works in LPS physical space while NIfTI headers are in RAS
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+## IMAGE I/O
+
+def read_image(filename):
+    """
+    Reads a .nrrd or .nii(.gz) image.
+    Returns the data (indexed x, y, z, ...) and the 4x4 index-to-physical (LPS) matrix.
+    """
+    if filename.endswith(".nrrd"):
+        data, header = nrrd.read(filename)
+        return data, nrrd_affine(header)
+    image = nib.load(filename)
+    return np.asanyarray(image.dataobj), RAS_TO_LPS @ image.affine
+
+def nrrd_affine(header):
+    """
+    Returns the 4x4 index-to-physical (LPS) matrix of a NRRD header.
+    """
+    dimension = 3
+    affine = np.eye(4)
+    if "space directions" in header:
+        # keep only the spatial axes (vector/time axes have no direction)
+        directions = [d for d in header["space directions"] if d is not None and not np.any(np.isnan(np.asarray(d, dtype=float)))]
+        affine[:3, :3] = np.array(directions[:dimension], dtype=float).T
+    elif "spacings" in header:
+        affine[:3, :3] = np.diag(np.asarray(header["spacings"], dtype=float)[:dimension])
+    if "space origin" in header:
+        affine[:3, 3] = np.asarray(header["space origin"], dtype=float)[:dimension]
+    # convert to LPS if the file uses a different space
+    space = header.get("space", "left-posterior-superior")
+    if space in ["right-anterior-superior", "RAS"]:
+        affine = RAS_TO_LPS @ affine
+    elif space in ["left-anterior-superior", "LAS"]:
+        affine = np.diag([1.0, -1.0, 1.0, 1.0]) @ affine
+    return affine
+
+def read_vector_image(filename):
+    """
+    Reads a 3D image of 3-vectors (a displacement field) as .nrrd or .nii(.gz).
+    Returns the data indexed component, x, y, z and the 4x4 index-to-physical (LPS) matrix.
+    """
+    if filename.endswith(".nrrd"):
+        data, header = nrrd.read(filename)
+        # ITK writes vector images as 3, x, y, z (the vector axis is the one of kind vector, or the one without a space direction)
+        kinds = header.get("kinds", [])
+        if len(kinds) == data.ndim:
+            vector_axes = [axis for axis, kind in enumerate(kinds) if kind not in ["domain", "space"]]
+        else:
+            directions = header.get("space directions", [None] * data.ndim)
+            vector_axes = [axis for axis, d in enumerate(directions) if d is None or np.any(np.isnan(np.asarray(d, dtype=float)))]
+        assert data.ndim == 4 and len(vector_axes) == 1 and data.shape[vector_axes[0]] == 3, \
+            "Unsupported displacement field layout {} (kinds {}) in {}, expected 3 x X x Y x Z.".format(data.shape, kinds, filename)
+        return np.moveaxis(data, vector_axes[0], 0), nrrd_affine(header)
+    data, affine = read_image(filename)
+    # ITK writes vector images as x, y, z, 1, 3
+    assert data.shape[3:] in [(1, 3), (3,)], \
+        "Unsupported displacement field layout {} in {}, expected X x Y x Z x 1 x 3.".format(data.shape, filename)
+    return np.moveaxis(data.reshape(data.shape[:3] + (3,)), -1, 0), affine
+
+def write_image(filename, data, affine):
+    """
+    Writes an image (indexed x, y, z, ...) with a 4x4 index-to-physical (LPS) matrix as .nrrd or .nii(.gz).
+    """
+    if filename.endswith(".nrrd"):
+        header = {
+            "space": "left-posterior-superior",
+            "space directions": affine[:3, :3].T,
+            "space origin": affine[:3, 3],
+            "encoding": "gzip",
+        }
+        if data.ndim > 3:
+            header["space directions"] = np.vstack([affine[:3, :3].T, np.full((data.ndim - 3, 3), np.nan)])
+            header["kinds"] = ["domain"] * 3 + ["list"] * (data.ndim - 3)
+        nrrd.write(filename, data, header)
+    else:
+        nib.save(nib.Nifti1Image(data, RAS_TO_LPS @ affine), filename)
+
+## TRANSFORM I/O
+
+def read_affine_transform(filename):
+    """
+    Reads an ITK affine transform (.txt or .mat) and returns it as a 4x4 matrix acting on LPS points.
+    """
+    if filename.endswith(".mat"):
+        transform = sio.loadmat(filename)
+        parameters = [transform[k] for k in transform if not k.startswith("__") and k != "fixed"][0].flatten()
+        fixed = transform["fixed"].flatten() if "fixed" in transform else np.zeros(3)
+    else:
+        parameters, fixed = None, np.zeros(3)
+        with open(filename, "r") as f:
+            for line in f:
+                if line.startswith("Parameters:"):
+                    parameters = np.array(line.split(":")[1].split(), dtype=float)
+                elif line.startswith("FixedParameters:"):
+                    fixed = np.array(line.split(":")[1].split(), dtype=float)
+        assert parameters is not None, "Could not find transform parameters in {}.".format(filename)
+    assert len(parameters) == 12, "Only 3D affine transforms are supported ({}).".format(filename)
+    # y = M (x - c) + t + c
+    matrix = np.eye(4)
+    matrix[:3, :3] = parameters[:9].reshape(3, 3)
+    matrix[:3, 3] = parameters[9:] + fixed - matrix[:3, :3] @ fixed
+    return matrix
+
+class DisplacementField:
+    """
+    An ITK displacement field (vectors in LPS physical space) sampled with trilinear interpolation.
+    """
+    def __init__(self, filename):
+        data, affine = read_vector_image(filename)
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+        self.affine = affine
+        self.inverse_affine = np.linalg.inv(affine)
+        self.filename = filename
+
+    def displacement(self, points):
+        """
+        Returns the displacement at (N, 3) physical points (zero outside the field).
+        """
+        index = (points @ self.inverse_affine[:3, :3].T + self.inverse_affine[:3, 3]).T
+        return np.stack([ndimage.map_coordinates(component, index, order=1, mode="constant", cval=0.0, prefilter=False) for component in self.data], axis=1)
+
+class TransformChain:
+    """
+    A list of ANTs transforms loaded once and applied in-process.
+    The transforms are given in antsApplyTransforms command line order as (filename, inverse) pairs;
+    a point in the reference space passes through them in that order to reach the input space.
+    """
+    def __init__(self, transforms):
+        self.transforms = []
+        for filename, inverse in transforms:
+            if filename.endswith(".nii.gz") or filename.endswith(".nii") or filename.endswith(".nrrd"):
+                assert not inverse, "Displacement fields cannot be inverted in-process, use the InverseWarp file instead."
+                self.transforms.append(("field", DisplacementField(filename)))
+            else:
+                matrix = read_affine_transform(filename)
+                self.transforms.append(("affine", np.linalg.inv(matrix) if inverse else matrix))
+
+    def transform_points(self, points):
+        """
+        Maps (N, 3) physical points from the reference space to the input space.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        for kind, transform in self.transforms:
+            if kind == "affine":
+                points = points @ transform[:3, :3].T + transform[:3, 3]
+            else:
+                points = points + transform.displacement(points)
+        return points
+
+def invert_transforms(transforms):
+    """
+    Returns the (filename, inverse) list of the inverse mapping of a transform list.
+    Affine transforms are inverted, displacement fields are swapped with their Warp/InverseWarp counterpart.
+    Point sets move in the opposite direction of images, so this turns an image transform list into a point transform list.
+    """
+    inverted = []
+    for filename, inverse in reversed(transforms):
+        if filename.endswith(".nii.gz") or filename.endswith(".nii") or filename.endswith(".nrrd"):
+            if "InverseWarp" in os.path.basename(filename):
+                counterpart = os.path.join(os.path.dirname(filename), os.path.basename(filename).replace("InverseWarp", "Warp"))
+            else:
+                counterpart = os.path.join(os.path.dirname(filename), os.path.basename(filename).replace("Warp", "InverseWarp"))
+            assert counterpart != filename and os.path.isfile(counterpart), "Could not find the inverse of {} (expected {}).".format(filename, counterpart)
+            inverted.append((counterpart, False))
+        else:
+            inverted.append((filename, not inverse))
+    return inverted
+
+## POINT SETS
+
+def transform_point_files(jobs, chain, chunk_size=1000000, n_threads=1, log=print):
+    """
+    Transforms point sets with a single, already loaded transform chain.
+    jobs is a list of (input_csv, output_csv) tuples. The CSV files use the antsApplyTransformsToPoints
+    format (x, y, z columns in LPS physical coordinates, other columns are copied unchanged) and are read
+    and written in chunks of chunk_size points so that large detection files do not have to fit in memory.
+    Files are processed in parallel.
+    """
+    def transform_file(job):
+        input_file, output_file = job
+        n_points = 0
+        with open(output_file, "w") as f:
+            for i, chunk in enumerate(pd.read_csv(input_file, chunksize=chunk_size)):
+                assert all(c in chunk.columns for c in ["x", "y", "z"]), "{} must have x, y and z columns.".format(input_file)
+                chunk[["x", "y", "z"]] = chain.transform_points(chunk[["x", "y", "z"]].to_numpy(dtype=np.float64))
+                chunk.to_csv(f, header=(i == 0), index=False)
+                n_points += len(chunk)
+        log("Saved {} ({} points)".format(output_file, n_points))
+        return output_file
+
+    log("Transforming {} point set(s) using {} thread(s)...".format(len(jobs), n_threads))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(transform_file, jobs))
+
+## RESAMPLING
+
+def _slab_points(shape, affine, z_start, z_stop):
+    # physical coordinates of every voxel in the reference slab z_start:z_stop
+    index = np.stack(np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(z_start, z_stop), indexing="ij"), axis=-1).reshape(-1, 3)
+    return index @ affine[:3, :3].T + affine[:3, 3]
+
+def warp_images(jobs, reference_file, chain, n_threads=1, slab_size=16, log=print, input_transforms=None):
+    """
+    Warps several images into the space of a reference image with a single, already loaded transform chain.
+    jobs is a list of (input_file, output_file, is_label) tuples. Volumes are linearly interpolated and written
+    as float32, label maps use nearest neighbour interpolation and keep their data type. The reference grid is
+    processed in z-slabs so that the transform is evaluated once per voxel for all images, and the outputs are
+    written in parallel. input_transforms optionally gives one affine transform file (or None) per job that is
+    applied after the chain, e.g. the reflection matrix of each input when mirroring.
+    """
+    # load the reference geometry and the inputs
+    reference, reference_affine = read_image(reference_file)
+    shape = reference.shape[:3]
+    del reference
+    inputs = []
+    input_transforms = input_transforms if input_transforms is not None else [None] * len(jobs)
+    for (input_file, output_file, is_label), input_transform in zip(jobs, input_transforms):
+        log("Loading {}".format(input_file))
+        data, affine = read_image(input_file)
+        data = np.asarray(data) if is_label else np.asarray(data, dtype=np.float32)
+        output = np.zeros(shape, dtype=data.dtype if is_label else np.float32)
+        # physical points to input voxels (through the affine transform of the input first, if any)
+        inverse_affine = np.linalg.inv(affine) if input_transform is None else np.linalg.inv(affine) @ read_affine_transform(input_transform)
+        inputs.append((data, inverse_affine, is_label, output))
+
+    # warp every slab of the reference grid
+    def warp_slab(z_start):
+        z_stop = min(z_start + slab_size, shape[2])
+        points = chain.transform_points(_slab_points(shape, reference_affine, z_start, z_stop))
+        for data, inverse_affine, is_label, output in inputs:
+            index = (points @ inverse_affine[:3, :3].T + inverse_affine[:3, 3]).T
+            values = ndimage.map_coordinates(data, index, order=0 if is_label else 1, mode="constant", cval=0, prefilter=False)
+            output[:, :, z_start:z_stop] = values.reshape(shape[0], shape[1], z_stop - z_start)
+        return z_stop
+
+    log("Warping {} image(s) in {} slabs using {} thread(s)...".format(len(inputs), int(np.ceil(shape[2] / slab_size)), n_threads))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(warp_slab, range(0, shape[2], slab_size)))
+
+    # write the outputs in parallel
+    def write_output(i):
+        output_file = jobs[i][1]
+        write_image(output_file, inputs[i][3], reference_affine)
+        log("Saved {}".format(output_file))
+        return output_file
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(write_output, range(len(jobs))))
+
+## TIME SERIES
+
+# numpy types of the NRRD type names that can be memory mapped
+NRRD_TYPES = {
+    "uchar": "u1", "unsigned char": "u1", "uint8": "u1", "uint8_t": "u1",
+    "signed char": "i1", "int8": "i1", "int8_t": "i1",
+    "short": "i2", "short int": "i2", "signed short": "i2", "signed short int": "i2", "int16": "i2", "int16_t": "i2",
+    "ushort": "u2", "unsigned short": "u2", "unsigned short int": "u2", "uint16": "u2", "uint16_t": "u2",
+    "int": "i4", "signed int": "i4", "int32": "i4", "int32_t": "i4",
+    "uint": "u4", "unsigned int": "u4", "uint32": "u4", "uint32_t": "u4",
+    "float": "f4", "double": "f8",
+}
+
+def _time_series_reader(filename):
+    """
+    Returns the shape, the 4x4 index-to-physical (LPS) matrix and a function that reads one timepoint
+    of a 4D image (time is the last axis). Raw NRRD files are memory mapped and NIfTI files are read
+    through the nibabel proxy, so only the requested timepoint is loaded.
+    """
+    if filename.endswith(".nrrd"):
+        with open(filename, "rb") as f:
+            header = nrrd.read_header(f)
+            offset = f.tell()
+        shape = tuple(header["sizes"])
+        if header.get("encoding", "raw") == "raw" and header["type"] in NRRD_TYPES and "data file" not in header and "datafile" not in header:
+            dtype = np.dtype(NRRD_TYPES[header["type"]]).newbyteorder("<" if header.get("endian", "little") == "little" else ">")
+            data = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape, order="F")
+        else:
+            data, header = nrrd.read(filename)
+        return shape, nrrd_affine(header), lambda t: np.asarray(data[..., t], dtype=np.float32)
+    image = nib.load(filename)
+    return image.shape, RAS_TO_LPS @ image.affine, lambda t: np.asarray(image.dataobj[..., t], dtype=np.float32)
+
+def _create_nrrd_memmap(filename, shape, affine):
+    """
+    Creates a raw float32 NRRD file of the given shape and returns it as a writable memory map.
+    The data is stored in Fortran (NRRD) order, so every timepoint is a contiguous block.
+    """
+    directions = " ".join("({},{},{})".format(*affine[:3, i]) for i in range(3)) + " none" * (len(shape) - 3)
+    header = "NRRD0004\n"
+    header += "type: float\n"
+    header += "dimension: {}\n".format(len(shape))
+    header += "space: left-posterior-superior\n"
+    header += "sizes: {}\n".format(" ".join(str(n) for n in shape))
+    header += "space directions: {}\n".format(directions)
+    header += "kinds: {}\n".format(" ".join(["domain"] * 3 + ["list"] * (len(shape) - 3)))
+    header += "endian: little\n"
+    header += "encoding: raw\n"
+    header += "space origin: ({},{},{})\n\n".format(*affine[:3, 3])
+    header = header.encode("ascii")
+    with open(filename, "wb") as f:
+        f.write(header)
+        f.truncate(len(header) + int(np.prod(shape)) * 4)
+    return np.memmap(filename, dtype="<f4", mode="r+", offset=len(header), shape=shape, order="F")
+
+def warp_time_series(input_file, output_file, reference_file, chain, is_label=False, n_threads=1, log=print):
+    """
+    Warps a 4D time series (time is the last axis) into the space of a 3D reference image, one timepoint at a time.
+    The sampling coordinates are computed once from the transform chain and shared by all timepoints, which are
+    warped in parallel and written straight into a preallocated raw NRRD output, so memory use is bounded by the
+    number of timepoints in flight.
+    """
+    assert output_file.endswith(".nrrd"), "Time series are written as .nrrd files."
+    shape, affine, read_timepoint = _time_series_reader(input_file)
+    assert len(shape) == 4, "{} is not a 4D image.".format(input_file)
+    reference, reference_affine = read_image(reference_file)
+    reference_shape = reference.shape[:3]
+    del reference
+
+    # sampling coordinates of the input for every reference voxel (shared by all timepoints)
+    log("Computing sampling coordinates...")
+    inverse_affine = np.linalg.inv(affine)
+    index = np.empty((3,) + reference_shape, dtype=np.float32)
+    for z in range(reference_shape[2]):
+        points = chain.transform_points(_slab_points(reference_shape, reference_affine, z, z + 1))
+        index[:, :, :, z] = (points @ inverse_affine[:3, :3].T + inverse_affine[:3, 3]).T.reshape(3, reference_shape[0], reference_shape[1])
+
+    # warp every timepoint into the preallocated output
+    output = _create_nrrd_memmap(output_file, reference_shape + (shape[3],), reference_affine)
+
+    def warp_timepoint(t):
+        output[..., t] = ndimage.map_coordinates(read_timepoint(t), index, order=0 if is_label else 1, mode="constant", cval=0, prefilter=False)
+        return t
+
+    log("Warping {} timepoints using {} thread(s)...".format(shape[3], n_threads))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for t in executor.map(warp_timepoint, range(shape[3])):
+            if (t + 1) % 10 == 0 or t + 1 == shape[3]:
+                log("Warped timepoint {} of {}".format(t + 1, shape[3]))
+    output.flush()
+    del output
+    log("Saved {}".format(output_file))
+    return output_file
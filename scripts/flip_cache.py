@@ -0,0 +1,200 @@
+# a content-addressed cache of mirrored (flipped) brains shared by the registration and warping tools
+
+import os # file handling
+import json # hash index
+import fcntl # file locking
+import shutil # file copying
+import hashlib # content hashing
+
+# default cache location (<repository>/cache/flipped) and size limit; both can be overridden with environment variables
+CACHE_DIR = os.environ.get("OBIROI_FLIP_CACHE", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "flipped"))
+MAX_CACHE_SIZE = float(os.environ.get("OBIROI_FLIP_CACHE_GB", "20")) * 1024**3
+
+# name of the index that remembers content hashes of input files
+INDEX_FILE = "hash_index.json"
+
+# function to lock the cache directory while it is being modified
+class _CacheLock:
+    def __init__(self, cache_dir):
+        self.lock_file = os.path.join(cache_dir, ".lock")
+
+    def __enter__(self):
+        self.handle = open(self.lock_file, "w")
+        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+
+# function to get the content hash of a file (memoized by path, size and modification time)
+def file_hash(filename, cache_dir=CACHE_DIR):
+    """
+    Returns the sha256 hex digest of a file. Hashes are remembered in the cache index
+    so that repeat runs on an unchanged file do not read it again.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    stat = os.stat(filename)
+    memo_key = "{}:{}:{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    index_file = os.path.join(cache_dir, INDEX_FILE)
+
+    # look up the hash in the index
+    with _CacheLock(cache_dir):
+        index = _read_index(index_file)
+    if memo_key in index:
+        return index[memo_key]
+
+    # hash the file in 16 MB blocks
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024**2), b""):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    # store the hash in the index
+    with _CacheLock(cache_dir):
+        index = _read_index(index_file)
+        index[memo_key] = digest
+        _write_index(index_file, index)
+    return digest
+
+def _read_index(index_file):
+    if not os.path.exists(index_file):
+        return {}
+    try:
+        with open(index_file, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def _write_index(index_file, index):
+    with open(index_file + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_file + ".tmp", index_file)
+
+# placeholder of the flipped volume in commands built by the GUIs (the cache entry hashes the input, so the
+# flipped volume is only known once the worker thread has built the entry)
+FLIPPED = "@FLIPPED_INPUT@"
+
+# function to get the cache entry for a flipped brain
+def cache_entry(input_file, axis=0, low_memory="1", mirror_file=None, cache_dir=CACHE_DIR):
+    """
+    Returns a dictionary with the cached reflection matrix of an input file (keyed by the input hash and the axis)
+    or the given mirror_file (e.g. a .mat file saved during registration). Hashes the input, so it is built in the
+    worker threads of the GUIs. The flipped volume is keyed by the input hash, the hash of the content of the
+    reflection matrix and the precision (low memory) flag (see flipped_name), so the registration and warping tools
+    share it whether the matrix is computed or passed as a .mat file.
+    """
+    input_hash = file_hash(input_file, cache_dir)
+    entry = {"input_file": input_file, "input_hash": input_hash, "axis": axis, "low_memory": low_memory, "cache_dir": cache_dir}
+    if mirror_file is None:
+        entry["mirror_file"] = os.path.join(cache_dir, "{}_axis{}.mat".format(input_hash[:24], axis))
+        entry["external_mirror"] = False
+    else:
+        entry["mirror_file"] = mirror_file
+        entry["external_mirror"] = True
+    return entry
+
+# function to get the name of the flipped volume of a cache entry (its reflection matrix must exist)
+def flipped_name(entry):
+    extension = ".nrrd" if entry["input_file"].endswith(".nrrd") else ".nii.gz"
+    mirror_hash = file_hash(entry["mirror_file"], entry["cache_dir"])
+    return os.path.join(entry["cache_dir"], "{}_mat{}_float{}{}".format(entry["input_hash"][:24], mirror_hash[:12], entry["low_memory"], extension))
+
+# function to make sure the flipped brain exists in the cache
+def ensure_flipped(entry, log=print, max_cache_size=MAX_CACHE_SIZE):
+    """
+    Creates the reflection matrix and the flipped volume of a cache entry if they are missing,
+    marks them as recently used and evicts the least recently used files above the size limit.
+    Returns the flipped volume and the reflection matrix.
+    """
+    cache_dir = entry["cache_dir"]
+    input_file = entry["input_file"]
+    mirror_file = ensure_mirror(entry, log)
+    flipped_file = flipped_name(entry)
+
+    # create the flipped volume
+    if not os.path.exists(flipped_file):
+        extension = ".nrrd" if flipped_file.endswith(".nrrd") else ".nii.gz"
+        temp_flipped = flipped_file[:-len(extension)] + "_{}.tmp{}".format(os.getpid(), extension)
+        command = "antsApplyTransforms -d 3 -i {} -o {} -t {} -r {} --float {} >{}_out.log 2>{}_err.log".format(input_file, temp_flipped, mirror_file, input_file, entry["low_memory"], temp_flipped[:-len(extension)], temp_flipped[:-len(extension)])
+        log(command)
+        os.system(command)
+        _publish(temp_flipped, flipped_file, log)
+    else:
+        log("Using cached flipped brain {}".format(flipped_file))
+
+    # mark as recently used and evict old entries
+    in_use = [flipped_file]
+    if not entry["external_mirror"]:
+        in_use.append(mirror_file)
+    for file in in_use:
+        os.utime(file, None)
+    evict(cache_dir, max_cache_size, keep=in_use, log=log)
+    return flipped_file, mirror_file
+
+# function to get the flipped brain of an input file (used by the worker threads of the GUIs)
+def flip_input(input_file, low_memory="1", mirror_file=None, axis=0, log=print, cache_dir=CACHE_DIR):
+    """
+    Returns the flipped volume and the reflection matrix of an input file from the cache, creating them if needed.
+    """
+    return ensure_flipped(cache_entry(input_file, axis, low_memory, mirror_file, cache_dir), log)
+
+# function to make sure the reflection matrix of a cache entry exists
+def ensure_mirror(entry, log=print):
+    """
+    Creates the reflection matrix of a cache entry if it is missing and returns it.
+    Used directly when the mirroring is applied as part of another transform.
+    """
+    mirror_file = entry["mirror_file"]
+
+    # create the reflection matrix (written to a temporary name and moved into place)
+    if not entry["external_mirror"] and not os.path.exists(mirror_file):
+        temp_mirror = mirror_file[:-4] + "_{}.tmp.mat".format(os.getpid())
+        command = "ImageMath 3 {} ReflectionMatrix {} {} >{}_out.log 2>{}_err.log".format(temp_mirror, entry["input_file"], entry["axis"], temp_mirror[:-4], temp_mirror[:-4])
+        log(command)
+        os.system(command)
+        _publish(temp_mirror, mirror_file, log)
+    else:
+        log("Using cached reflection matrix {}".format(mirror_file))
+    if not entry["external_mirror"]:
+        os.utime(mirror_file, None)
+    return mirror_file
+
+def _publish(temp_file, final_file, log):
+    # make sure ANTs produced the file, remove empty logs and move the file into the cache
+    base = temp_file[:-4] if temp_file.endswith(".mat") else temp_file.split(".tmp")[0] + ".tmp"
+    assert os.path.isfile(temp_file), "ERROR: {} was not created. Check {}_err.log for more information.".format(temp_file, base)
+    for log_file in [base + "_out.log", base + "_err.log"]:
+        if os.path.exists(base + "_err.log") and os.stat(base + "_err.log").st_size == 0 and os.path.exists(log_file):
+            os.remove(log_file)
+    os.replace(temp_file, final_file)
+
+# function to evict least recently used cache files
+def evict(cache_dir=CACHE_DIR, max_cache_size=MAX_CACHE_SIZE, keep=(), log=print):
+    """
+    Removes the least recently used flipped volumes and reflection matrices until the cache
+    is below max_cache_size bytes. Files in keep are never removed.
+    """
+    with _CacheLock(cache_dir):
+        files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if (f.endswith(".nrrd") or f.endswith(".nii.gz") or f.endswith(".mat")) and ".tmp" not in f]
+        files = [(os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files]
+        total_size = sum(size for _, size, _ in files)
+        keep = [os.path.abspath(f) for f in keep]
+        for _, size, f in sorted(files):
+            if total_size <= max_cache_size:
+                break
+            if os.path.abspath(f) in keep:
+                continue
+            log("Evicting {} from the flip cache".format(f))
+            os.remove(f)
+            total_size -= size
+
+# function to copy the reflection matrix next to the registration outputs (used by the warping tools' autofill)
+def copy_mirror(mirror_file, destination):
+    """
+    Copies a cached reflection matrix to destination if it is not already there.
+    """
+    if os.path.abspath(mirror_file) != os.path.abspath(destination):
+        shutil.copyfile(mirror_file, destination)
+    return destination
@@ -0,0 +1,89 @@
+# staging of the images of a template building run: the images are exposed to ANTs under safe IDs (symlinks in the
+# working directory) and a manifest maps every ID back to its original file, so nothing is copied or renamed
+
+import os # file handling
+import glob # file handling
+import json # manifest
+import argparse # command line arguments
+
+# name of the manifest in the run directory (results/obiroi_*/staging_manifest.json)
+MANIFEST = "staging_manifest.json"
+
+# function to get the safe ID of an image
+def safe_id(filename):
+    """
+    Returns the name of an image with every '.' except the one of the extension replaced by '_'
+    (ANTs uses the dots to find the output prefix).
+    """
+    stem, extension = os.path.splitext(os.path.basename(filename))
+    return stem.replace(".", "_") + extension
+
+# function to read a manifest
+def read_manifest(manifest_file):
+    """
+    Returns the ID -> original file dictionary of a manifest (empty if the manifest does not exist).
+    """
+    if manifest_file is None or not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, "r") as f:
+        return json.load(f)["images"]
+
+# function to find the manifest of a run
+def run_manifest(run_dir):
+    """
+    Returns the manifest of a run directory (empty for runs staged by copying and renaming the images).
+    """
+    return read_manifest(os.path.join(run_dir, MANIFEST))
+
+# function to stage images
+def stage_images(files, manifest_file, directory=".", sanitize=True):
+    """
+    Links every file into directory under its ID (safe_id, or its name if sanitize is False) and adds it to the manifest.
+    An image that is staged again under the same ID (e.g. the diff data) replaces the link, never the linked file.
+    Returns the IDs.
+    """
+    ids = [safe_id(f) if sanitize else os.path.basename(f) for f in files]
+    assert len(set(ids)) == len(ids), "Images with the same ID: {}".format(", ".join(sorted(set(i for i in ids if ids.count(i) > 1))))
+    manifest = read_manifest(manifest_file)
+    for image_id, f in zip(ids, files):
+        link = os.path.join(directory, image_id)
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.abspath(f), link)
+        manifest[image_id] = os.path.abspath(f)
+        print("ln -s {} {}".format(os.path.abspath(f), link))
+    os.makedirs(os.path.dirname(manifest_file) or ".", exist_ok=True)
+    with open(manifest_file, "w") as f:
+        json.dump({"images": manifest}, f, indent=2)
+    return ids
+
+# function to find the ID in the name of an output file
+def resolve(filename, manifest):
+    """
+    Returns the ID that the name of an ANTs output file contains (e.g. complete_<ID>3Warp.nii.gz), None if there is none.
+    """
+    name = os.path.basename(filename)
+    matches = [image_id for image_id in manifest if image_id in name]
+    return max(matches, key=len) if len(matches) > 0 else None
+
+# function to get the original name of a staged image
+def original_name(image_id, manifest):
+    """
+    Returns the name of the original file of an ID in the manifest.
+    """
+    return os.path.basename(manifest[image_id])
+
+
+if __name__ == "__main__":
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description="Link the images of a template building run into the working directory under safe IDs.")
+    parser.add_argument("-d", "--data_dir", type=str, help="directory with the images", required=True)
+    parser.add_argument("-i", "--id", type=str, help="identifier (with wildcards) of the images (e.g. synA647_*.nrrd)", required=True)
+    parser.add_argument("-m", "--manifest", type=str, help="manifest file (e.g. obiroi_cns_mtc_<DATE>/staging_manifest.json)", required=True)
+    parser.add_argument("-o", "--output_dir", type=str, help="directory to link the images into (default: ./)", default=".", nargs="?")
+    parser.add_argument("--keep_names", action="store_true", help="link the images under their own names (default: replace the dots)")
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.data_dir, args.id)))
+    assert len(files) > 0, "No images {} in {}.".format(args.id, args.data_dir)
+    stage_images(files, args.manifest, args.output_dir, sanitize=not args.keep_names)
@@ -8,6 +8,8 @@ import argparse # command line arguments
 from joblib import Parallel, delayed # parallel processing
 import datetime # date and time
 
+import staging # staging manifest of the run
+
 # clear output
 os.system('cls' if os.name == 'nt' else 'clear')
 
@@ -108,8 +110,15 @@ nii_files = [file for file in nii_files if not os.path.basename(file).startswith
 # remove duplicates
 nii_files = list(set(nii_files))
 
+# get the staging manifest of the run (empty for runs that copied and renamed the data)
+manifest = staging.run_manifest(input_dir)
+
 # create function to get original name
 def get_original_name(file):
+    # with a manifest, the ID in the file name is mapped back to the resampled image (with its dots)
+    image_id = staging.resolve(file, manifest)
+    if image_id is not None:
+        return os.path.splitext(staging.original_name(image_id, manifest))[0].split("_resampled")[0] + ".nrrd"
     # get basename
     file = os.path.basename(file)
     # remove everything after resampled
@@ -173,9 +182,7 @@ basefile_dict = {}
 # for each original file, find the basefile
 for original_file in original_files:
     # find the matching basefile
-    temp = original_file.replace(".nrrd", "")
-    temp = "complete_" + temp
-    basefile = [file for file in basefiles if file.startswith(temp)]
+    basefile = [file for file in basefiles if get_original_name(file) == original_file]
     # make sure there is only one basefile
     assert len(basefile) == 1, f"Could not find basefile for {original_file}. Make sure there is only one basefile for each original file."
     # add basefile to dictionary
@@ -0,0 +1,133 @@
+# helpers to find the per-subject transforms of a template building run (results/obiroi_*) and warp template-space files into every subject
+
+import os # file handling
+import time # timing
+import pandas as pd # output table
+from joblib import Parallel, delayed # parallel processing
+
+import ants_transforms
+import staging
+
+# function to get the latest run directory in results/
+def latest_run(results_dir="results"):
+    """
+    Returns the most recently created obiroi_* directory in results_dir.
+    """
+    directory_list = [os.path.join(results_dir, d) for d in os.listdir(results_dir) if d.startswith("obiroi")]
+    directory_list = [d for d in directory_list if os.path.isdir(d)]
+    assert len(directory_list) > 0, "No obiroi_* run directories found in {}.".format(results_dir)
+    return max(directory_list, key=os.path.getctime)
+
+# function to get original name
+def get_original_name(file, manifest=None):
+    # with the staging manifest of the run, the ID in the file name is mapped back to the resampled image (with its dots)
+    image_id = staging.resolve(file, manifest) if manifest else None
+    if image_id is not None:
+        return os.path.splitext(staging.original_name(image_id, manifest))[0].split("_resampled")[0] + ".nrrd"
+    # get basename
+    file = os.path.basename(file)
+    # remove everything after resampled
+    original_name = file.split("_resampled")[0] + ".nrrd"
+    # remove "complete_" from the beginning
+    original_name = original_name.replace("complete_", "")
+    return original_name
+
+# function to get basefile names
+def get_basefile_name(file):
+    # get basename
+    file = os.path.basename(file)
+    # remove everything after nrrd
+    basefile = file.split(".nrrd")[0] + ".nrrd"
+    return basefile
+
+# function to find the transforms of every subject in a run
+def find_subject_transforms(run_dir, subject_dir=None):
+    """
+    Returns one dictionary per registered subject of a run with the subject name, the Warp,
+    InverseWarp and Affine files in the syn directory and (if subject_dir is given) the subject
+    image in subject_dir that serves as the reference space of the subject.
+    """
+    syn_dir = os.path.join(run_dir, "syn")
+    assert os.path.isdir(syn_dir), "Run directory {} does not contain syn directory.".format(run_dir)
+    syn_files = os.listdir(syn_dir)
+    manifest = staging.run_manifest(run_dir)
+
+    # get the basefile of every registered subject (skip the template itself)
+    basefiles = [get_basefile_name(file) for file in syn_files if file.endswith(".nii.gz") and ".nrrd" in file and not file.startswith("complete_template")]
+    basefiles = sorted(set(basefiles))
+
+    subjects = []
+    for basefile in basefiles:
+        # find the transforms that start with basefile
+        warp_files = [file for file in syn_files if file.startswith(basefile) and file.endswith("Warp.nii.gz") and not "Inverse" in file]
+        inverse_warp_files = [file for file in syn_files if file.startswith(basefile) and file.endswith("InverseWarp.nii.gz")]
+        affine_files = [file for file in syn_files if file.startswith(basefile) and file.endswith("Affine.txt")]
+        # make sure there is exactly one of each
+        assert len(warp_files) == 1, "Run directory does not contain {}<xxx>Warp.nii.gz file.".format(basefile)
+        assert len(inverse_warp_files) == 1, "Run directory does not contain {}<xxx>InverseWarp.nii.gz file.".format(basefile)
+        assert len(affine_files) == 1, "Run directory does not contain {}<xxx>Affine.txt file.".format(basefile)
+        subject = {
+            "subject": get_original_name(basefile, manifest)[:-5],
+            "basefile": basefile,
+            "warp": os.path.join(syn_dir, warp_files[0]),
+            "inverse_warp": os.path.join(syn_dir, inverse_warp_files[0]),
+            "affine": os.path.join(syn_dir, affine_files[0]),
+        }
+        if subject_dir is not None:
+            subject["reference"] = os.path.join(subject_dir, get_original_name(basefile, manifest))
+        subjects.append(subject)
+    return subjects
+
+# function to warp template-space files into one subject
+def warp_to_subject(subject, inputs, output_dir, n_threads=1, affine_only=False):
+    """
+    Warps template-space (input_file, is_label) pairs into the space of one subject.
+    Returns one table row per input.
+    """
+    start = time.time()
+    rows = []
+    jobs = []
+    for input_file, is_label in inputs:
+        input_name = os.path.basename(input_file).split(".nii")[0].split(".nrrd")[0]
+        output_file = os.path.join(output_dir, "{}_to_{}.nrrd".format(input_name, subject["subject"]))
+        jobs.append((input_file, output_file, is_label))
+        rows.append({"subject": subject["subject"], "input_file": input_file, "output_file": output_file, "label": is_label, "reference": subject.get("reference", ""), "affine": subject["affine"], "inverse_warp": subject["inverse_warp"]})
+    try:
+        assert os.path.isfile(subject["reference"]), "Subject image {} not found.".format(subject["reference"])
+        # from template: [Affine, 1] then InverseWarp (antsApplyTransforms order)
+        transforms = [(subject["affine"], True)]
+        if not affine_only:
+            transforms.append((subject["inverse_warp"], False))
+        chain = ants_transforms.TransformChain(transforms)
+        ants_transforms.warp_images(jobs, subject["reference"], chain, n_threads=n_threads, log=lambda message: None)
+        status = "done"
+    except Exception as error:
+        status = "failed: {}".format(error)
+    for row in rows:
+        row["status"] = status
+        row["seconds"] = round(time.time() - start, 1)
+    return rows
+
+# function to warp template-space files into every subject of a run
+def propagate_to_cohort(inputs, subjects, output_dir, n_cores=1, affine_only=False, log=print):
+    """
+    Warps template-space (input_file, is_label) pairs into every subject in parallel.
+    The core budget is split between subjects running at the same time and the threads each subject uses.
+    Writes cohort_warping.csv with one row per subject and input to output_dir and returns it as a DataFrame.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    n_jobs = max(1, min(n_cores, len(subjects)))
+    n_threads = max(1, n_cores // n_jobs)
+    log("Warping {} file(s) into {} subject(s) ({} subject(s) at a time, {} thread(s) each)...".format(len(inputs), len(subjects), n_jobs, n_threads))
+
+    rows = []
+    results = Parallel(n_jobs=n_jobs, return_as="generator")(delayed(warp_to_subject)(subject, inputs, output_dir, n_threads, affine_only) for subject in subjects)
+    for subject_rows in results:
+        log("{}: {} ({} s)".format(subject_rows[0]["subject"], subject_rows[0]["status"], subject_rows[0]["seconds"]))
+        rows.extend(subject_rows)
+
+    table = pd.DataFrame(rows)
+    table_file = os.path.join(output_dir, "cohort_warping.csv")
+    table.to_csv(table_file, index=False)
+    log("Saved {}".format(table_file))
+    return table
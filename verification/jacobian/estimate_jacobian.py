@@ -1,84 +1,175 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import argparse
 from joblib import Parallel, delayed
 import numpy as np
+import nibabel as nib
 import nrrd
 import matplotlib.pyplot as plt
 
-results_dir = '../../results/obiroi_cns_mtc_20231229_1450/syn'
+import jacobian_stats
+import log_jacobian
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from verification_cache import VerificationCache
+
+# parse command line arguments
+parser = argparse.ArgumentParser(description='Estimate the log jacobian statistics of the warps of a template building run.')
+parser.add_argument('-r','--run_dir', type=str, help='path to the run directory (must contain syn directory; default: latest obiroi directory in ../../results/)', default="", nargs='?')
+parser.add_argument('-o','--output_dir', type=str, help='path to the output directory for the whole brain statistics (default: ./whole_brain)', default="whole_brain", nargs='?')
+parser.add_argument('-n','--neuropil_dir', type=str, help='path to the output directory for the per-neuropil statistics (default: ./neuropils)', default="neuropils", nargs='?')
+parser.add_argument('-s','--segmentation', type=str, help='consensus segmentation of the neuropils in template space (default: ../segmentation/processed_data/template/consensus_segmentation_template.nrrd)', default="../segmentation/processed_data/template/consensus_segmentation_template.nrrd", nargs='?')
+parser.add_argument('-c','--cache_dir', type=str, help='path to the cache directory (default: ../cache)', default="../cache", nargs='?')
+parser.add_argument('--use_ants', action='store_true', help='compute the log jacobians with CreateJacobianDeterminantImage instead of in-process')
+parser.add_argument('--statistics_only', action='store_true', help='do not cache the log jacobian volumes (the statistics are computed in one pass over the warps; computed in-process, cannot be combined with --use_ants)')
+args = parser.parse_args()
+if args.statistics_only and args.use_ants:
+    # CreateJacobianDeterminantImage writes whole volumes, the statistics are streamed from the in-process slabs
+    parser.error('--statistics_only cannot be combined with --use_ants')
+
+run_dir = args.run_dir
+if run_dir == "":
+    # get the latest run directory
+    runs = [os.path.join('../../results', d) for d in os.listdir('../../results') if d.startswith('obiroi')]
+    assert len(runs) > 0, 'No obiroi_* run directories found in ../../results'
+    run_dir = max(runs, key=os.path.getctime)
+results_dir = os.path.join(run_dir, 'syn')
+assert os.path.isdir(results_dir), 'Run directory {} does not contain syn directory'.format(run_dir)
+print('Using run {}'.format(run_dir))
+
 # get all the files in the results directory
-files = os.listdir(results_dir)
+files = sorted(os.listdir(results_dir))
 # keep only warp files
 files = [f for f in files if f.endswith('Warp.nii.gz')]
 # remove the inverse warp files
 files = [f for f in files if not f.endswith('InverseWarp.nii.gz')]
 print('Found {} files'.format(len(files)))
 
-processed_data_dir = 'whole_brain/processed_data'
-# check if the processed data directory exists
-if not os.path.exists(processed_data_dir):
-    print('Directory {} does not exist'.format(processed_data_dir))
-    exit()
-else:
-    print('Found directory {}'.format(processed_data_dir))
+os.makedirs(args.output_dir, exist_ok=True)
+os.makedirs(args.neuropil_dir, exist_ok=True)
+
+# load the consensus template if it exists and set up the per-channel (neuropil) reducer
+channel_reducer = None
+if os.path.exists(args.segmentation):
+    print('Found consensus template')
+    consensus_template, _ = nrrd.read(args.segmentation)
+    # look fo the number of channels by counting the number of consensus_segmentation_channel files
+    segmentation_dir = os.path.dirname(args.segmentation)
+    n_channels = len([f for f in os.listdir(segmentation_dir) if f.startswith('consensus_segmentation_channel') and f.endswith('.nrrd')])
+    print('Found {} channels'.format(n_channels))
+    # digitize the consensus template
+    consensus_template = np.digitize(consensus_template, bins=np.linspace(0, np.max(consensus_template), n_channels))-1
+    # the values of every channel are streamed to a csv file (one row per jacobian file)
+    value_files = [os.path.join(args.neuropil_dir, 'jacobian_values_channel_{}.csv'.format(l)) for l in range(n_channels)]
+    channel_reducer = jacobian_stats.LabelReducer(consensus_template, n_labels=n_channels, value_files=value_files)
 
-# get the jacobian of all the warp files (parallel using joblib)
+# get the log jacobian of all the warp files
+# by default the log jacobian is computed in-process from the displacement field (z-slabs on n_cpus threads),
+# with --use_ants it is computed with CreateJacobianDeterminantImage instead (parallel using joblib)
 
 n_cpus = os.cpu_count()
 print('Using {} cpus'.format(n_cpus))
 
-def get_jacobian(f):
-    file_to_process = os.path.join(results_dir, f)
-    processed_file = os.path.join(processed_data_dir, os.path.basename(f)[:-7] + '_logjacobian.nrrd')
-    
-    # if the file already exists, skip it
-    if os.path.exists(processed_file):
-        return processed_file
-    jacobian_command = 'CreateJacobianDeterminantImage 3 {} {} 1 1'.format(file_to_process, processed_file)
-    os.system(jacobian_command)
-    return processed_file
-
-jacobian_files = Parallel(n_jobs=n_cpus)(delayed(get_jacobian)(f) for f in files)
-
-print('Found {} jacobian files'.format(len(jacobian_files)))
-for f in jacobian_files:
-    print(f)
-
-# read the jacobian files using pynrrd
-jacobians = []
-for f in jacobian_files:
-    print('Read file {}'.format(f))
-    j, _ = nrrd.read(f)
-    jacobians.append(j)
-
-# get the standard deviation of the jacobians
-
-mean_jacobian = np.mean(jacobians, axis=0)
-std_jacobian = np.std(jacobians, axis=0)
-# get the header of the first file
-header = nrrd.read_header(jacobian_files[0])
+voxel_stats = jacobian_stats.VoxelwiseStats()
+header = None
+
+if args.statistics_only:
+    # a single pass over the log jacobian slabs of every warp file updates the sketch, the voxelwise
+    # statistics and the channel statistics, the log jacobian volumes are never stored
+    sketches = []
+    for f in files:
+        print('Compute log jacobian statistics of {}'.format(f))
+        warp_file = os.path.join(results_dir, f)
+        image = nib.load(warp_file)
+        if header is None:
+            header = log_jacobian.nrrd_header(log_jacobian.RAS_TO_LPS @ image.affine)
+        sketch = jacobian_stats.HistogramSketch()
+        for z_start, _, slab in log_jacobian.iter_log_jacobian(warp_file, n_threads=n_cpus):
+            sketch.update(slab)
+            voxel_stats.update_slab(slab, z_start, image.shape[:3])
+            if channel_reducer is not None:
+                channel_reducer.update_slab(slab, z_start)
+        voxel_stats.end_volume()
+        if channel_reducer is not None:
+            channel_reducer.end_volume()
+        sketches.append(sketch)
+else:
+    # log jacobians and their sketches are cached by the content of the warp file
+    cache = VerificationCache(args.cache_dir)
+    method = 'ants' if args.use_ants else 'numpy'
+
+    def compute_jacobian(f, entry, n_threads):
+        file_to_process = os.path.join(results_dir, f)
+        processed_file = os.path.join(entry, 'logjacobian.nrrd')
+        if args.use_ants:
+            log_jacobian.ants_log_jacobian(file_to_process, processed_file)
+        else:
+            log_jacobian.write_log_jacobian(file_to_process, processed_file, n_threads=n_threads)
+        assert os.path.isfile(processed_file), 'Could not compute the log jacobian of {}'.format(f)
+        # summarize the log jacobian in a histogram sketch
+        j, _ = nrrd.read(processed_file)
+        jacobian_stats.HistogramSketch().update(j).save(os.path.join(entry, 'sketch.npz'))
+
+    def get_entry(f, n_threads=1):
+        compute = lambda entry: compute_jacobian(f, entry, n_threads)
+        return cache.cached('logjacobian', [os.path.join(results_dir, f)], compute, method=method)
+
+    if args.use_ants:
+        entries = Parallel(n_jobs=n_cpus)(delayed(get_entry)(f) for f in files)
+    else:
+        # every file already uses all cpus
+        entries = [get_entry(f, n_cpus) for f in files]
+
+    print('Found {} cached log jacobians'.format(len(entries)))
+    for f, entry in zip(files, entries):
+        print('{} -> {}'.format(f, entry))
+
+    sketches = [jacobian_stats.HistogramSketch.load(os.path.join(entry, 'sketch.npz')) for entry in entries]
+
+    # load the log jacobians one at a time and update the streaming statistics
+    for f, entry in zip(files, entries):
+        print('Load log jacobian of {}'.format(f))
+        j, j_header = nrrd.read(os.path.join(entry, 'logjacobian.nrrd'))
+        if header is None:
+            header = j_header
+        voxel_stats.update(j)
+        # update the statistics of all channels in a single pass
+        if channel_reducer is not None:
+            channel_reducer.update(j)
+
+# combine the sketches of all subjects
+summary = jacobian_stats.HistogramSketch()
+for sketch in sketches:
+    summary.merge(sketch)
+summary.save(os.path.join(args.output_dir, 'jacobian_sketch.npz'))
+print('Summarized {} values from {} files'.format(summary.moments.count, len(sketches)))
+
+# get the voxelwise mean and standard deviation of the jacobians
+
+mean_jacobian = voxel_stats.mean
+std_jacobian = voxel_stats.std()
+# use the header of the first file
 # save the mean jacobian as a nrrd file
-nrrd.write('whole_brain/mean_logjacobian.nrrd', mean_jacobian, header)
+nrrd.write(os.path.join(args.output_dir, 'mean_logjacobian.nrrd'), mean_jacobian, header)
 # save the sd jacobian as a nrrd file
-nrrd.write('whole_brain/sd_logjacobian.nrrd', std_jacobian, header)
+nrrd.write(os.path.join(args.output_dir, 'sd_logjacobian.nrrd'), std_jacobian, header)
 print('Saved mean and sd jacobian files')
 
-jacobian_values = np.array(jacobians).flatten()
-
-mean_val = np.mean(jacobian_values)
-std_val = np.std(jacobian_values)
-CI_95 = np.percentile(jacobian_values, [2.5, 97.5])
+mean_val = summary.moments.mean
+std_val = summary.moments.std()
+CI_95 = summary.quantile([0.025, 0.975])
 
 print('Mean log jacobian: {:.4f}'.format(mean_val))
 print('SD log jacobian: {:.4f}'.format(std_val))
-print('95% CI: [{:.4f}, {:.4f}]'.format(CI_95[0], CI_95[1]))
+print('95% CI: [{:.4f}, {:.4f}] (+/- {:.4f})'.format(CI_95[0], CI_95[1], summary.error_bound))
 
 # save the jacobian stats as a text file
-with open('whole_brain/jacobian_values.txt', 'w') as f:
+with open(os.path.join(args.output_dir, 'jacobian_values.txt'), 'w') as f:
     f.write('Mean log jacobian: {:.4f}\n'.format(mean_val))
     f.write('SD log jacobian: {:.4f}\n'.format(std_val))
-    f.write('95% CI: [{:.4f}, {:.4f}]\n'.format(CI_95[0], CI_95[1]))
+    f.write('95% CI: [{:.4f}, {:.4f}] (+/- {:.4f})\n'.format(CI_95[0], CI_95[1], summary.error_bound))
 
 # get a histogram of the jacobians (dont show the plot)
 
@@ -86,7 +177,8 @@ with open('whole_brain/jacobian_values.txt', 'w') as f:
 plt.ioff()
 
 plt.figure(figsize=(4, 3))
-plt.hist(jacobian_values, bins=70, color='steelblue', histtype='step', linewidth=2)
+counts, edges = summary.histogram(bins=70)
+plt.hist(edges[:-1], bins=edges, weights=counts, color='steelblue', histtype='step', linewidth=2)
 # add a vertical line at the mean with text
 plt.axvline(x=mean_val, color='k', linestyle='-', label='Mean')
 # plt.text(mean_val - 0.2, 1e5, '{:.2f}'.format(mean_val), color='k', rotation=90, verticalalignment='center')
@@ -103,44 +195,27 @@ plt.yscale('log')
 plt.yticks([])
 plt.legend(loc='center right', frameon=False)
 plt.tight_layout()
-plt.savefig('whole_brain/jacobian_histogram.png', dpi=300)
+plt.savefig(os.path.join(args.output_dir, 'jacobian_histogram.png'), dpi=300)
 plt.close()
 print('Saved histogram of jacobians')
 
-# load the consensus template if it exists
-if os.path.exists('../segmentation/processed_data/template/consensus_segmentation_template.nrrd'):
-    print('Found consensus template')
-    consensus_template, _ = nrrd.read('../segmentation/processed_data/template/consensus_segmentation_template.nrrd')
-    # look fo the number of channels by counting the number of consensus_segmentation_channel files
-    n_channels = len([f for f in os.listdir('../segmentation/processed_data/template') if f.startswith('consensus_segmentation_channel' and f.endswith('.nrrd'))])
-    print('Found {} channels'.format(n_channels))
-    # digitize the consensus template
-    consensus_template = np.digitize(consensus_template, bins=np.linspace(0, np.max(consensus_template), n_channels))-1
-    # loop over the labels and mask the jacobians
-    for l in range(n_channels):
+# save the statistics of every channel
+if channel_reducer is not None:
+    for l, channel_summary in enumerate(channel_reducer.sketches):
         print('Channel {}'.format(l))
         print('==========')
-        # get the mask
-        mask = consensus_template == l
-        # mask the jacobians
-        masked_jacobians = []
-        for j in jacobians:
-            masked_jacobians.append(j[mask])
         # compute the statistics
-        mean_val = np.mean(masked_jacobians)
-        std_val = np.std(masked_jacobians)
-        CI_95 = np.percentile(masked_jacobians, [2.5, 97.5])
+        mean_val = channel_summary.moments.mean
+        std_val = channel_summary.moments.std()
+        CI_95 = channel_summary.quantile([0.025, 0.975])
         print('Mean log jacobian: {:.4f}'.format(mean_val))
         print('SD log jacobian: {:.4f}'.format(std_val))
-        print('95% CI: [{:.4f}, {:.4f}]'.format(CI_95[0], CI_95[1]))
+        print('95% CI: [{:.4f}, {:.4f}] (+/- {:.4f})'.format(CI_95[0], CI_95[1], channel_summary.error_bound))
         # save the statistics
-        with open('neuropils/jacobian_values_channel_{}.txt'.format(l), 'w') as f:
+        with open(os.path.join(args.neuropil_dir, 'jacobian_values_channel_{}.txt'.format(l)), 'w') as f:
             f.write('Mean log jacobian: {:.4f}\n'.format(mean_val))
             f.write('SD log jacobian: {:.4f}\n'.format(std_val))
-            f.write('95% CI: [{:.4f}, {:.4f}]\n'.format(CI_95[0], CI_95[1]))
-        
-        # save all the values as a csv file
-        np.savetxt('neuropils/jacobian_values_channel_{}.csv'.format(l), masked_jacobians, delimiter=',')
+            f.write('95% CI: [{:.4f}, {:.4f}] (+/- {:.4f})\n'.format(CI_95[0], CI_95[1], channel_summary.error_bound))
         print('Saved statistics and values for channel {}'.format(l))
 
 
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# streaming statistics for log-Jacobian volumes (one volume in memory at a time)
+
+import numpy as np
+
+
+class VoxelwiseStats:
+    """
+    Voxelwise mean and variance over a stream of volumes (Welford's algorithm).
+    Keeps two float64 volumes (mean and sum of squared deviations) regardless of the number of volumes.
+    The volumes passed to update are not modified:
+
+    >>> volume = np.arange(4.0)
+    >>> stats = VoxelwiseStats()
+    >>> stats.update(volume); stats.update(volume + 2)
+    >>> volume.tolist(), stats.mean.tolist(), stats.variance().tolist()
+    ([0.0, 1.0, 2.0, 3.0], [1.0, 2.0, 3.0, 4.0], [1.0, 1.0, 1.0, 1.0])
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, volume):
+        volume = np.asarray(volume)
+        self._accumulate(volume, Ellipsis, volume.shape)
+        self.end_volume()
+
+    def update_slab(self, slab, z_start, shape):
+        """
+        Adds the slab [:, :, z_start:z_start + depth] of the current volume (of the given shape). Every slab of
+        the volume is added once, then end_volume is called.
+        """
+        self._accumulate(np.asarray(slab), np.s_[:, :, z_start:z_start + slab.shape[2]], shape)
+
+    def _accumulate(self, values, index, shape):
+        values = np.asarray(values, dtype=np.float64)
+        if self.mean is None:
+            self.mean = np.zeros(shape)
+            self.m2 = np.zeros(shape)
+        assert tuple(shape) == self.mean.shape, 'All volumes must have the same shape ({} != {})'.format(tuple(shape), self.mean.shape)
+        mean, m2 = self.mean[index], self.m2[index]
+        delta = values - mean
+        mean += delta / (self.count + 1)
+        # delta * (values - new mean), computed in a new array (float64 values are not copied by asarray)
+        deviation = values - mean
+        deviation *= delta
+        m2 += deviation
+
+    def end_volume(self):
+        self.count += 1
+
+    def merge(self, other):
+        # combine with the statistics of another stream (Chan et al.)
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        return self
+
+    def variance(self, ddof=0):
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+
+class GlobalMoments:
+    """
+    Count, mean, variance, minimum and maximum of all values in a stream of arrays.
+    Each array is reduced on its own and merged with the running moments (Chan et al.), which keeps the sums accurate.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values).ravel()
+        if values.size == 0:
+            return self
+        mean = float(np.mean(values, dtype=np.float64))
+        m2 = float(np.sum((values - mean)**2, dtype=np.float64))
+        other = GlobalMoments()
+        other.count, other.mean, other.m2, other.min, other.max = values.size, mean, m2, float(np.min(values)), float(np.max(values))
+        return self.merge(other)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def variance(self, ddof=0):
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+
+class HistogramSketch:
+    """
+    Mergeable fixed-bin histogram of a stream of values with exact moments.
+    Values inside [lo, hi) are counted in n_bins equal bins, values outside in an underflow and an overflow bin.
+    Quantiles are interpolated within a bin, so for quantiles inside [lo, hi) the error is at most one bin width
+    (error_bound). Sketches with the same bins can be merged, so subjects can be summarized in parallel and new
+    subjects added to an existing summary.
+    """
+    def __init__(self, lo=-5.0, hi=5.0, n_bins=10000):
+        self.lo = float(lo)
+        self.hi = float(hi)
+        self.n_bins = int(n_bins)
+        self.counts = np.zeros(self.n_bins + 2, dtype=np.int64) # underflow, bins, overflow
+        self.moments = GlobalMoments()
+
+    @property
+    def error_bound(self):
+        return (self.hi - self.lo) / self.n_bins
+
+    @property
+    def edges(self):
+        return np.linspace(self.lo, self.hi, self.n_bins + 1)
+
+    def bin_index(self, values):
+        # bin index of every value (0 is underflow, n_bins + 1 is overflow)
+        index = np.floor((values - self.lo) / self.error_bound).astype(np.int64) + 1
+        np.clip(index, 0, self.n_bins + 1, out=index)
+        return index
+
+    def update(self, values):
+        values = np.asarray(values).ravel()
+        values = values[np.isfinite(values)]
+        self.counts += np.bincount(self.bin_index(values), minlength=self.n_bins + 2)
+        self.moments.update(values)
+        return self
+
+    def merge(self, other):
+        assert (self.lo, self.hi, self.n_bins) == (other.lo, other.hi, other.n_bins), 'Sketches must have the same bins'
+        self.counts += other.counts
+        self.moments.merge(other.moments)
+        return self
+
+    def quantile(self, q):
+        """
+        Returns the approximate q-quantile(s) (q in [0, 1]).
+        """
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        cumulative = np.cumsum(self.counts)
+        total = cumulative[-1]
+        assert total > 0, 'The sketch is empty'
+        # lower and upper value of every bin (under/overflow bins span to the observed minimum/maximum)
+        lower = np.concatenate([[self.moments.min], self.edges])
+        upper = np.concatenate([self.edges, [self.moments.max]])
+        lower[-1] = max(lower[-1], self.moments.min)
+        upper[0] = min(upper[0], self.moments.max)
+        result = []
+        for rank in q * total:
+            b = min(int(np.searchsorted(cumulative, rank, side='left')), len(cumulative) - 1)
+            before = cumulative[b - 1] if b > 0 else 0
+            fraction = (rank - before) / self.counts[b] if self.counts[b] > 0 else 0.0
+            result.append(lower[b] + fraction * (upper[b] - lower[b]))
+        result = np.clip(result, self.moments.min, self.moments.max)
+        return result if len(result) > 1 else result[0]
+
+    def histogram(self, bins=70, range=None):
+        """
+        Returns a coarser histogram (counts, edges) with the given number of bins over range (default: observed minimum to maximum).
+        Every fine bin is assigned to the coarse bin of its center, so edges are accurate to one fine bin width.
+        """
+        lo, hi = range if range is not None else (self.moments.min, self.moments.max)
+        centers = np.concatenate([[self.moments.min], (self.edges[:-1] + self.edges[1:]) / 2, [self.moments.max]])
+        # keep the bins that contain the minimum/maximum inside the range
+        centers = np.clip(centers, lo, hi)
+        return np.histogram(centers, bins=bins, range=(lo, hi), weights=self.counts)
+
+    def save(self, filename):
+        m = self.moments
+        np.savez(filename, bins=[self.lo, self.hi, self.n_bins], counts=self.counts, moments=[m.count, m.mean, m.m2, m.min, m.max])
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        lo, hi, n_bins = data['bins']
+        sketch = cls(lo, hi, int(n_bins))
+        sketch.counts = data['counts']
+        count, sketch.moments.mean, sketch.moments.m2, sketch.moments.min, sketch.moments.max = data['moments']
+        sketch.moments.count = int(count)
+        return sketch
+
+
+class LabelReducer:
+    """
+    Per-label statistics of a stream of volumes that share one label image (e.g. the consensus neuropil segmentation).
+    Every volume is reduced z-slab by z-slab with np.bincount (counts, sums, squared deviations and histogram bins keyed
+    by label), giving one HistogramSketch per label, so volumes can also be streamed slab by slab (update_slab). If
+    value_files are given, the values of every label are appended to its file (one comma separated row per volume,
+    slab by slab) instead of being kept in memory.
+    """
+    def __init__(self, labels, n_labels=None, value_files=None, lo=-5.0, hi=5.0, n_bins=10000, slab_size=16):
+        self.labels = np.asarray(labels).astype(np.int64)
+        assert self.labels.ndim == 3, 'The label image must be a 3D volume'
+        assert self.labels.min() >= 0, 'Labels must be non-negative'
+        self.n_labels = int(self.labels.max()) + 1 if n_labels is None else int(n_labels)
+        self.sketches = [HistogramSketch(lo, hi, n_bins) for _ in range(self.n_labels)]
+        self.value_files = value_files
+        self.slab_size = slab_size
+        # voxel order that groups the voxels of every label in every z-slab (used to stream the values and to get the minimum/maximum)
+        self.slabs = {}
+        # labels whose row of the current volume already has values
+        self.started = np.zeros(self.n_labels, dtype=bool)
+        if value_files is not None:
+            assert len(value_files) == self.n_labels, 'One value file per label is required'
+            for value_file in value_files:
+                open(value_file, 'w').close()
+
+    def slab_labels(self, z_start, z_stop):
+        if (z_start, z_stop) not in self.slabs:
+            labels = self.labels[:, :, z_start:z_stop].ravel()
+            order = np.argsort(labels, kind='stable')
+            sizes = np.bincount(labels, minlength=self.n_labels)[:self.n_labels]
+            self.slabs[(z_start, z_stop)] = (labels, order, sizes, np.concatenate([[0], np.cumsum(sizes)[:-1]]))
+        return self.slabs[(z_start, z_stop)]
+
+    def update(self, volume):
+        volume = np.asarray(volume)
+        assert volume.shape[:3] == self.labels.shape, 'Volume and label image must have the same shape'
+        for z_start in range(0, volume.shape[2], self.slab_size):
+            z_stop = min(z_start + self.slab_size, volume.shape[2])
+            self.update_slab(volume[:, :, z_start:z_stop], z_start)
+        return self.end_volume()
+
+    def update_slab(self, slab, z_start):
+        """
+        Adds the slab [:, :, z_start:z_start + depth] of the current volume. Every slab of the volume is added once,
+        in order, then end_volume is called (the value files hold the values of every label slab by slab).
+        """
+        values = np.asarray(slab).ravel()
+        slab_labels, order, sizes, starts = self.slab_labels(z_start, z_start + slab.shape[2])
+        assert values.size == slab_labels.size, 'Slab and label image must have the same number of voxels'
+        n_bins = self.sketches[0].n_bins + 2
+        # non-finite values are not counted (they go to an extra label that is dropped)
+        finite = np.isfinite(values)
+        labels = np.where(finite, slab_labels, self.n_labels)
+        clean = np.where(finite, values, 0).astype(np.float64)
+
+        # counts, means and squared deviations of every label
+        count = np.bincount(labels, minlength=self.n_labels + 1)[:self.n_labels]
+        sums = np.bincount(labels, weights=clean, minlength=self.n_labels + 1)[:self.n_labels]
+        mean = np.append(sums / np.maximum(count, 1), 0.0)
+        m2 = np.bincount(labels, weights=(clean - mean[labels])**2, minlength=self.n_labels + 1)[:self.n_labels]
+
+        # histogram of every label
+        joint = labels * n_bins + self.sketches[0].bin_index(clean)
+        histograms = np.bincount(joint, minlength=(self.n_labels + 1) * n_bins)[:self.n_labels * n_bins].reshape(self.n_labels, n_bins)
+
+        # values grouped by label (minimum/maximum and value files)
+        grouped = values[order]
+        grouped_finite = np.where(np.isfinite(grouped), grouped, np.nan)
+        for l, sketch in enumerate(self.sketches):
+            segment = grouped_finite[starts[l]:starts[l] + sizes[l]]
+            if count[l] > 0:
+                moments = GlobalMoments()
+                moments.count, moments.mean, moments.m2 = int(count[l]), float(mean[l]), float(m2[l])
+                moments.min, moments.max = float(np.nanmin(segment)), float(np.nanmax(segment))
+                sketch.counts += histograms[l]
+                sketch.moments.merge(moments)
+            if self.value_files is not None and sizes[l] > 0:
+                # the row of the volume is continued slab by slab and ended by end_volume
+                with open(self.value_files[l], 'ab') as f:
+                    if self.started[l]:
+                        f.write(b',')
+                    np.savetxt(f, grouped[None, starts[l]:starts[l] + sizes[l]], delimiter=',', newline='')
+                self.started[l] = True
+        return self
+
+    def end_volume(self):
+        if self.value_files is not None:
+            for value_file in self.value_files:
+                with open(value_file, 'ab') as f:
+                    f.write(b'\n')
+        self.started[:] = False
+        return self
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# in-process log-Jacobian determinant of ITK displacement fields (finite differences over z-slabs)
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+import nrrd
+
+# ITK works in LPS physical space while NIfTI headers are in RAS
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def read_displacement_field(warp_file):
+    """
+    Reads an ITK displacement field (.nii.gz, vectors in LPS) as an (x, y, z, 3) float32 array
+    and its 4x4 index-to-physical (LPS) matrix.
+    """
+    image = nib.load(warp_file)
+    data = np.asarray(image.dataobj, dtype=np.float32)
+    # ITK writes vector images as x, y, z, 1, 3
+    data = data.reshape(data.shape[:3] + (3,))
+    return data, RAS_TO_LPS @ image.affine
+
+
+def affine_log_determinant(affine_file):
+    """
+    Returns log|det| of the matrix of an ITK affine transform (.txt).
+    """
+    with open(affine_file, 'r') as f:
+        for line in f:
+            if line.startswith('Parameters:'):
+                parameters = np.array(line.split(':')[1].split(), dtype=float)
+                return float(np.log(np.abs(np.linalg.det(parameters[:9].reshape(3, 3)))))
+    raise ValueError('Could not find transform parameters in {}'.format(affine_file))
+
+
+def _slab_log_jacobian(field, inverse_directions, z_start, z_stop, min_determinant):
+    # take the slab with a one voxel halo so that central differences match the whole volume
+    z_low, z_high = max(z_start - 1, 0), min(z_stop + 1, field.shape[2])
+    block = field[:, :, z_low:z_high]
+    # gradient of every displacement component along the index axes (central differences, one-sided at the volume border)
+    gradient = np.stack([np.stack(np.gradient(block[..., i], axis=(0, 1, 2)), axis=-1) for i in range(3)], axis=-2)
+    gradient = gradient[:, :, z_start - z_low:z_stop - z_low]
+    # jacobian of x -> x + u(x) with respect to physical coordinates
+    jacobian = gradient @ inverse_directions.astype(np.float32)
+    jacobian[..., 0, 0] += 1
+    jacobian[..., 1, 1] += 1
+    jacobian[..., 2, 2] += 1
+    determinant = (jacobian[..., 0, 0] * (jacobian[..., 1, 1] * jacobian[..., 2, 2] - jacobian[..., 1, 2] * jacobian[..., 2, 1])
+                   - jacobian[..., 0, 1] * (jacobian[..., 1, 0] * jacobian[..., 2, 2] - jacobian[..., 1, 2] * jacobian[..., 2, 0])
+                   + jacobian[..., 0, 2] * (jacobian[..., 1, 0] * jacobian[..., 2, 1] - jacobian[..., 1, 1] * jacobian[..., 2, 0]))
+    # folded voxels (non-positive determinant) are clamped before taking the log
+    return np.log(np.maximum(determinant, min_determinant)).astype(np.float32)
+
+
+def iter_log_jacobian(warp_file, affine_file=None, n_threads=1, slab_size=16, min_determinant=1e-6):
+    """
+    Yields (z_start, z_stop, log_jacobian_slab) for the log-Jacobian determinant of a displacement field.
+    Slabs are computed in parallel on a thread pool and yielded in order, so statistics can be updated
+    without keeping the whole log-Jacobian volume. If affine_file is given, log|det| of the affine is added
+    (the Jacobian of the composed transform).
+    """
+    field, affine = read_displacement_field(warp_file)
+    assert min(field.shape[:3]) > 1 and slab_size > 0, 'The displacement field must have at least 2 voxels along every axis'
+    inverse_directions = np.linalg.inv(affine[:3, :3])
+    offset = affine_log_determinant(affine_file) if affine_file is not None else 0.0
+
+    def compute(z_start):
+        z_stop = min(z_start + slab_size, field.shape[2])
+        return z_start, z_stop, _slab_log_jacobian(field, inverse_directions, z_start, z_stop, min_determinant) + np.float32(offset)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        # keep at most 2 * n_threads slabs in flight
+        starts = list(range(0, field.shape[2], slab_size))
+        pending = [executor.submit(compute, z) for z in starts[:2 * n_threads]]
+        for i in range(len(starts)):
+            z_start, z_stop, slab = pending.pop(0).result()
+            if i + 2 * n_threads < len(starts):
+                pending.append(executor.submit(compute, starts[i + 2 * n_threads]))
+            yield z_start, z_stop, slab
+
+
+def log_jacobian(warp_file, affine_file=None, n_threads=1, slab_size=16, min_determinant=1e-6):
+    """
+    Returns the log-Jacobian determinant volume of a displacement field and its 4x4 index-to-physical (LPS) matrix.
+    """
+    image = nib.load(warp_file)
+    volume = np.empty(image.shape[:3], dtype=np.float32)
+    for z_start, z_stop, slab in iter_log_jacobian(warp_file, affine_file, n_threads, slab_size, min_determinant):
+        volume[:, :, z_start:z_stop] = slab
+    return volume, RAS_TO_LPS @ image.affine
+
+
+def nrrd_header(affine):
+    """
+    Returns a .nrrd header for a volume with the given 4x4 index-to-physical (LPS) matrix.
+    """
+    return {'space': 'left-posterior-superior', 'space directions': affine[:3, :3].T, 'space origin': affine[:3, 3], 'encoding': 'gzip'}
+
+
+def write_log_jacobian(warp_file, output_file, affine_file=None, n_threads=1, slab_size=16):
+    """
+    Computes the log-Jacobian determinant of a displacement field and writes it as a .nrrd file.
+    """
+    volume, affine = log_jacobian(warp_file, affine_file, n_threads, slab_size)
+    nrrd.write(output_file, volume, nrrd_header(affine))
+    return output_file
+
+
+def ants_log_jacobian(warp_file, output_file):
+    """
+    Computes the log-Jacobian determinant with ANTs (CreateJacobianDeterminantImage, geometric Jacobian).
+    """
+    jacobian_command = 'CreateJacobianDeterminantImage 3 {} {} 1 1'.format(warp_file, output_file)
+    os.system(jacobian_command)
+    return output_file
+
+
+def validate(warp_file, output_dir='.', n_threads=1):
+    """
+    Compares the in-process log-Jacobian with the ANTs result for one displacement field.
+    Returns the mean absolute difference and the correlation of the two volumes.
+    """
+    ants_file = os.path.join(output_dir, os.path.basename(warp_file)[:-7] + '_ants_logjacobian.nrrd')
+    ants_log_jacobian(warp_file, ants_file)
+    reference, _ = nrrd.read(ants_file)
+    volume, _ = log_jacobian(warp_file, n_threads=n_threads)
+    difference = np.mean(np.abs(volume - reference))
+    correlation = np.corrcoef(volume.ravel(), reference.ravel())[0, 1]
+    return difference, correlation
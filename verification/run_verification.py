@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# run the verification (segmentation dice scores and log jacobian statistics) for one or more template building runs
+# all intermediates go to a shared content-keyed cache, so work is shared between runs and repeated invocations
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+verification_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(verification_dir, 'segmentation'))
+sys.path.append(os.path.join(verification_dir, 'jacobian'))
+import segmentation_pipeline
+import jacobian_stats
+from verification_cache import VerificationCache
+
+# parse command line arguments
+parser = argparse.ArgumentParser(description='Verify one or more template building runs (segmentation dice scores and log jacobian statistics).')
+parser.add_argument('-r','--run_dirs', type=str, help='paths to the run directories (must contain syn directory and complete_template<0>.nii.gz; default: latest obiroi directory in ./results/)', default=[], nargs='*')
+parser.add_argument('-s','--splits', type=str, help='segmentation splits to verify (train, test and/or template; default: train test)', default=['train', 'test'], nargs='*')
+parser.add_argument('-o','--output_dir', type=str, help='path to the output directory (default: ./verification/results)', default=os.path.join(verification_dir, 'results'), nargs='?')
+parser.add_argument('-c','--cache_dir', type=str, help='path to the cache directory (default: ./verification/cache)', default=os.path.join(verification_dir, 'cache'), nargs='?')
+parser.add_argument('-d','--data_dir', type=str, help='path to the segmentation data (default: ./verification/data/segmentation_data)', default=os.path.join(verification_dir, 'data', 'segmentation_data'), nargs='?')
+parser.add_argument('-v','--target_voxel_size', type=str, help='voxel size of the segmentation data in microns (default: 0.8x0.8x0.8)', default="0.8x0.8x0.8", nargs='?')
+parser.add_argument('-n','--n_jobs', type=int, help='number of parallel jobs (default: number of cpus)', default=os.cpu_count(), nargs='?')
+parser.add_argument('-p','--threads_per_job', type=int, help='number of threads of every registration (default: the cores split evenly between the subjects)', default=None, nargs='?')
+parser.add_argument('--flip_back', action='store_true', help='mirror the warped labels of mirrored subjects back')
+parser.add_argument('--consensus', type=str, help='consensus segmentation mode (and, majority, threshold or staple; default: and)', default="and", nargs='?')
+parser.add_argument('--consensus_threshold', type=float, help='fraction of the votes needed for the threshold consensus (default: 0.5)', default=0.5, nargs='?')
+parser.add_argument('--skip_segmentation', action='store_true', help='do not run the segmentation verification')
+parser.add_argument('--skip_jacobian', action='store_true', help='do not run the log jacobian statistics')
+args = parser.parse_args()
+
+assert all(split in ['train', 'test', 'template'] for split in args.splits), "Splits must be train, test or template."
+
+run_dirs = args.run_dirs
+if len(run_dirs) == 0:
+    # get the latest run directory
+    runs = [os.path.join('results', d) for d in os.listdir('results') if d.startswith('obiroi')]
+    assert len(runs) > 0, "No obiroi_* run directories found in ./results."
+    run_dirs = [max(runs, key=os.path.getctime)]
+for run_dir in run_dirs:
+    assert os.path.isdir(os.path.join(run_dir, 'syn')), "Run directory {} does not contain syn directory.".format(run_dir)
+
+def find_run_template(run_dir):
+    # multivariate runs write complete_template0.nii.gz, single channel runs complete_template.nii.gz
+    for name in ['complete_template0.nii.gz', 'complete_template.nii.gz']:
+        if os.path.isfile(os.path.join(run_dir, name)):
+            return os.path.join(run_dir, name)
+    raise FileNotFoundError("Run directory {} does not contain complete_template<0>.nii.gz.".format(run_dir))
+
+cache = VerificationCache(args.cache_dir)
+rows = []
+
+def summarize_dice(run, split, dice_scores):
+    for channel, scores in enumerate(dice_scores):
+        scores = scores[~np.isnan(scores)]
+        if len(scores) == 0:
+            continue
+        rows.append({"run": run, "analysis": "dice_" + split, "channel": channel, "n": len(scores), "mean": np.mean(scores), "median": np.median(scores), "sd": np.std(scores), "ci_low": np.percentile(scores, 2.5), "ci_high": np.percentile(scores, 97.5)})
+
+# the template segmentations do not depend on the run
+if not args.skip_segmentation and 'template' in args.splits:
+    print("Comparing the template segmentations...")
+    dice_scores = segmentation_pipeline.run_template(os.path.join(args.output_dir, 'template'), cache, args.data_dir, args.n_jobs, args.consensus, args.consensus_threshold)
+    summarize_dice('template', 'template', dice_scores)
+
+for run_dir in run_dirs:
+    run = os.path.basename(os.path.normpath(run_dir))
+    run_output_dir = os.path.join(args.output_dir, run)
+    print("Verifying run {}...".format(run))
+
+    splits = [split for split in args.splits if split != 'template']
+    if not args.skip_segmentation and len(splits) > 0:
+        template_path = find_run_template(run_dir)
+        for split in splits:
+            print("Segmentation verification ({})...".format(split))
+            dice_scores = segmentation_pipeline.run_split(split, template_path, os.path.join(run_output_dir, 'segmentation', split), cache, args.data_dir, args.target_voxel_size, args.n_jobs, args.consensus, args.consensus_threshold, args.threads_per_job, args.flip_back)
+            summarize_dice(run, split, dice_scores)
+
+    if not args.skip_jacobian:
+        print("Log jacobian statistics...")
+        jacobian_output_dir = os.path.abspath(os.path.join(run_output_dir, 'jacobian'))
+        sketch_file = os.path.join(jacobian_output_dir, 'whole_brain', 'jacobian_sketch.npz')
+        if os.path.isfile(sketch_file):
+            os.remove(sketch_file)
+        # use the consensus segmentation of the template from this invocation if there is one
+        segmentation = os.path.abspath(os.path.join(args.output_dir, 'template', 'consensus_segmentation_template.nrrd'))
+        if not os.path.isfile(segmentation):
+            segmentation = os.path.join(verification_dir, 'segmentation', 'processed_data', 'template', 'consensus_segmentation_template.nrrd')
+        # estimate_jacobian.py uses paths relative to its directory
+        command = 'cd {} && {} estimate_jacobian.py -r {} -o {} -n {} -s {} -c {}'.format(os.path.join(verification_dir, 'jacobian'), sys.executable, os.path.abspath(run_dir), os.path.join(jacobian_output_dir, 'whole_brain'), os.path.join(jacobian_output_dir, 'neuropils'), segmentation, os.path.abspath(args.cache_dir))
+        print(command)
+        os.system(command)
+        if os.path.isfile(sketch_file):
+            summary = jacobian_stats.HistogramSketch.load(sketch_file)
+            CI_95 = summary.quantile([0.025, 0.975])
+            rows.append({"run": run, "analysis": "logjacobian", "channel": "", "n": summary.moments.count, "mean": summary.moments.mean, "median": summary.quantile(0.5), "sd": summary.moments.std(), "ci_low": CI_95[0], "ci_high": CI_95[1]})
+        else:
+            print("Could not compute the log jacobian statistics of run {}.".format(run))
+
+# save one table to compare the runs
+os.makedirs(args.output_dir, exist_ok=True)
+table = pd.DataFrame(rows)
+table_file = os.path.join(args.output_dir, 'verification_summary.csv')
+table.to_csv(table_file, index=False)
+print(table.to_string())
+print("Saved {}".format(table_file))
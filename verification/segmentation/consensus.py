@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# streaming consensus segmentation (vote counts accumulated one subject at a time) with majority, threshold and STAPLE fusion
+
+import numpy as np
+
+CONSENSUS_MODES = ['and', 'majority', 'threshold', 'staple']
+
+
+class VoteCounter:
+    """
+    Number of subjects that assign every voxel to every channel, accumulated one label image at a time.
+    The counts use the smallest unsigned integer type that can hold the number of subjects.
+    """
+    def __init__(self, n_channels, n_subjects):
+        self.n_channels = n_channels
+        self.n_subjects = n_subjects
+        self.dtype = np.uint8 if n_subjects < 2**8 else np.uint16 if n_subjects < 2**16 else np.uint32
+        self.counts = None
+        self.count = 0
+
+    def update(self, labels):
+        labels = np.asarray(labels)
+        if self.counts is None:
+            self.counts = np.zeros((self.n_channels,) + labels.shape, dtype=self.dtype)
+        assert labels.shape == self.counts.shape[1:], 'All label images must have the same shape ({} != {})'.format(labels.shape, self.counts.shape[1:])
+        assert self.count < self.n_subjects, 'More label images than subjects ({})'.format(self.n_subjects)
+        for channel in range(self.n_channels):
+            np.add(self.counts[channel], 1, out=self.counts[channel], where=labels == channel)
+        self.count += 1
+        return self
+
+    def agreement(self, channel):
+        """
+        Returns the fraction of subjects that assign every voxel to the channel.
+        """
+        return self.counts[channel] / np.float32(self.count)
+
+    def required_votes(self, fraction):
+        # smallest number of votes that is at least the fraction of the subjects
+        return max(1, int(np.ceil(fraction * self.count - 1e-9)))
+
+    def mask(self, channel, fraction):
+        """
+        Returns the voxels that at least the fraction of the subjects assign to the channel.
+        """
+        return self.counts[channel] >= self.required_votes(fraction)
+
+    def majority(self):
+        """
+        Returns the channel with the most votes at every voxel (ties go to the lower channel).
+        """
+        return np.argmax(self.counts, axis=0).astype(np.uint8 if self.n_channels <= 2**8 else np.uint16)
+
+    def threshold(self, fraction):
+        """
+        Returns the channel with the most votes at every voxel where it has at least the fraction of the votes,
+        and the background (channel 0) elsewhere. A fraction of 1 is the logical and of all subjects.
+        """
+        fused = self.majority()
+        votes = np.take_along_axis(self.counts, fused[None].astype(np.intp), axis=0)[0]
+        fused[votes < self.required_votes(fraction)] = 0
+        return fused
+
+
+def staple(load_labels, counter, iterations=5, epsilon=1e-6):
+    """
+    STAPLE-style weighted fusion (multi-label STAPLE, Warfield et al. 2004) of the label images load_labels(0), ...,
+    load_labels(n_subjects - 1), which are loaded one at a time in every iteration.
+    Every subject gets a performance matrix (probability of every observed channel given the true channel), starting from
+    the agreement with the majority vote, and the posterior of every channel is updated with the log performance of every subject.
+    counter is the VoteCounter of the same label images (majority vote and channel priors).
+    Returns the fused label image, the posterior probability of every channel (float32) and the performance matrices.
+    """
+    n_channels, n_subjects = counter.n_channels, counter.count
+    shape = counter.counts.shape[1:]
+    # prior of every channel from the votes of all subjects
+    prior = counter.counts.reshape(n_channels, -1).sum(axis=1, dtype=np.int64) / float(n_subjects * np.prod(shape))
+    fused = counter.majority().ravel()
+    posterior = None
+    for iteration in range(iterations):
+        # performance of every subject given the current estimate of the true labels
+        performance = np.zeros((n_subjects, n_channels, n_channels))
+        for j in range(n_subjects):
+            observed = np.asarray(load_labels(j)).ravel().astype(np.intp)
+            if posterior is None:
+                performance[j] = np.bincount(observed * n_channels + fused, minlength=n_channels**2)[:n_channels**2].reshape(n_channels, n_channels)
+            else:
+                for s in range(n_channels):
+                    performance[j, :, s] = np.bincount(observed, weights=posterior[s], minlength=n_channels)[:n_channels]
+            performance[j] /= np.maximum(performance[j].sum(axis=0, keepdims=True), epsilon)
+        # posterior of every channel given the labels of all subjects
+        posterior = np.empty((n_channels, fused.size), dtype=np.float32)
+        posterior[:] = np.log(prior + epsilon).astype(np.float32)[:, None]
+        for j in range(n_subjects):
+            observed = np.asarray(load_labels(j)).ravel().astype(np.intp)
+            log_performance = np.log(performance[j] + epsilon).astype(np.float32)
+            for s in range(n_channels):
+                posterior[s] += log_performance[:, s][observed]
+        posterior -= posterior.max(axis=0)
+        np.exp(posterior, out=posterior)
+        posterior /= posterior.sum(axis=0)
+    fused = np.argmax(posterior, axis=0).astype(np.uint8 if n_channels <= 2**8 else np.uint16)
+    return fused.reshape(shape), posterior.reshape((n_channels,) + shape), performance
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# all-pairs, all-channels Dice scores of label images given as bit-packed masks of their channels
+# (and of label arrays with a joint bincount, the reference the bit-packed engine is validated against)
+
+import numpy as np
+from joblib import Parallel, delayed
+
+import packed_masks
+
+
+def as_label_array(labels, n_channels):
+    """
+    Stacks label images into one (n_labels, n_voxels) array of the smallest unsigned integer type that holds the channels.
+    """
+    dtype = np.uint8 if n_channels <= 256 else np.uint16
+    return np.stack([np.asarray(label).ravel().astype(dtype) for label in labels])
+
+
+def channel_counts(labels, n_channels):
+    """
+    Returns the number of voxels of every channel in every label image (n_labels x n_channels).
+    """
+    return np.stack([np.bincount(label, minlength=n_channels)[:n_channels] for label in labels])
+
+
+def _pair_intersections(labels, pairs, n_channels):
+    # the voxels where both label images agree, counted by channel (the diagonal of the joint label histogram)
+    intersections = np.zeros((len(pairs), n_channels), dtype=np.int64)
+    for k, (i, j) in enumerate(pairs):
+        agree = labels[i] == labels[j]
+        intersections[k] = np.bincount(labels[i][agree], minlength=n_channels)[:n_channels]
+    return intersections
+
+
+def pairwise_dice(labels, n_channels, n_jobs=1, pairs_per_job=16):
+    """
+    Computes the Dice score of every channel between all pairs of label images in one pass per pair (the reference
+    the bit-packed engine pairwise_dice_masks is validated against, see validate). Returns an (n_channels, n_labels, n_labels) array with the scores of the pairs i < j in the upper triangle
+    and NaN elsewhere (and for channels that are empty in one of the two images).
+    Pairs are split into blocks that are processed in parallel with joblib (the label array is shared with the workers).
+    """
+    labels = as_label_array(labels, n_channels)
+    n_labels = len(labels)
+    counts = channel_counts(labels, n_channels)
+    pairs = [(i, j) for i in range(n_labels) for j in range(i + 1, n_labels)]
+    blocks = [pairs[k:k + pairs_per_job] for k in range(0, len(pairs), pairs_per_job)]
+    if n_jobs == 1:
+        intersections = [_pair_intersections(labels, block, n_channels) for block in blocks]
+    else:
+        intersections = Parallel(n_jobs=n_jobs)(delayed(_pair_intersections)(labels, block, n_channels) for block in blocks)
+    return _dice_scores(counts, pairs, intersections, n_labels, n_channels)
+
+
+def _dice_scores(counts, pairs, intersections, n_labels, n_channels):
+    # the dice scores of the pairs from the channel counts and the intersections of every block of pairs
+    dice_scores = np.ones((n_channels, n_labels, n_labels)) * np.nan
+    if len(pairs) == 0:
+        return dice_scores
+    intersections = np.concatenate(intersections)
+    first, second = np.array(pairs).T
+    total = counts[first] + counts[second]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = 2 * intersections / total
+    # channels that are empty in one of the two images have no score
+    scores[(counts[first] == 0) | (counts[second] == 0)] = np.nan
+    dice_scores[:, first, second] = scores.T
+    return dice_scores
+
+
+def _pair_mask_intersections(masks, pairs):
+    # popcount of the and of the packed masks of every channel
+    return np.array([[a.intersection(b) for a, b in zip(masks[i], masks[j])] for i, j in pairs], dtype=np.int64).reshape(len(pairs), -1)
+
+
+def pairwise_dice_masks(masks, n_jobs=1, pairs_per_job=16):
+    """
+    Computes the Dice score of every channel between all pairs of label images given as bit-packed masks (one list of
+    PackedMask per label image, one PackedMask per channel). Returns an (n_channels, n_labels, n_labels) array with the
+    scores of the pairs i < j in the upper triangle and NaN elsewhere (and for channels that are empty in one of the two
+    images). Blocks of pairs are processed on n_jobs threads (the masks are shared, not copied).
+    """
+    n_labels, n_channels = len(masks), len(masks[0])
+    counts = np.array([[mask.count for mask in label_masks] for label_masks in masks], dtype=np.int64)
+    pairs = [(i, j) for i in range(n_labels) for j in range(i + 1, n_labels)]
+    blocks = [pairs[k:k + pairs_per_job] for k in range(0, len(pairs), pairs_per_job)]
+    intersections = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(_pair_mask_intersections)(masks, block) for block in blocks)
+    return _dice_scores(counts, pairs, intersections, n_labels, n_channels)
+
+
+def validate(labels, n_channels, n_jobs=1):
+    """
+    Compares the Dice scores of the bit-packed engine with the label-array reference for the same label images.
+    Returns the maximum absolute difference of the scores (NaN where both are NaN is a match, NaN in only one is inf).
+    """
+    reference = pairwise_dice(labels, n_channels, n_jobs=n_jobs)
+    masks = [packed_masks.PackedMask.from_labels(np.asarray(label), n_channels) for label in labels]
+    scores = pairwise_dice_masks(masks, n_jobs=n_jobs)
+    if not np.array_equal(np.isnan(reference), np.isnan(scores)):
+        return np.inf
+    return float(np.nanmax(np.abs(reference - scores), initial=0.0))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# bit-packed binary masks (one bit per voxel, cropped to the bounding box) with popcount overlaps
+
+import numpy as np
+
+# number of set bits of every byte (np.bitwise_count is only available from numpy 2.0)
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(bits):
+    """
+    Returns the number of set bits in a uint8 array.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(bits).sum(dtype=np.int64))
+    return int(POPCOUNT_TABLE[bits].sum(dtype=np.int64))
+
+
+class PackedMask:
+    """
+    Binary mask stored with np.packbits along the last (fastest) axis and cropped to its bounding box.
+    The bounding box starts at a multiple of 8 voxels along the last axis, so the bytes of two masks are aligned
+    and overlaps are computed with a bitwise and and a popcount on the bytes they share.
+    """
+    def __init__(self, bits, start, shape, count):
+        self.bits = bits
+        self.start = tuple(int(s) for s in start)
+        self.shape = tuple(shape)
+        self.count = int(count)
+
+    @classmethod
+    def from_mask(cls, mask):
+        mask = np.asarray(mask, dtype=bool)
+        ndim = mask.ndim
+        if not mask.any():
+            return cls(np.zeros((0,) * ndim, dtype=np.uint8), (0,) * ndim, mask.shape, 0)
+        # bounding box along every axis
+        start, stop = [], []
+        for axis in range(ndim):
+            nonzero = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(ndim) if a != axis)))
+            start.append(nonzero[0])
+            stop.append(nonzero[-1] + 1)
+        # align the start of the last axis to a byte
+        start[-1] = start[-1] // 8 * 8
+        bits = np.packbits(mask[tuple(slice(a, b) for a, b in zip(start, stop))], axis=-1)
+        return cls(bits, start, mask.shape, popcount(bits))
+
+    @classmethod
+    def from_labels(cls, labels, n_channels):
+        """
+        Returns one PackedMask per channel of a label image.
+        """
+        return [cls.from_mask(labels == channel) for channel in range(n_channels)]
+
+    @property
+    def stop(self):
+        # end of the bounding box (the last axis is in whole bytes, so it can extend past the volume)
+        return tuple(s + n * (8 if axis == len(self.shape) - 1 else 1) for axis, (s, n) in enumerate(zip(self.start, self.bits.shape)))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _overlap(self, other):
+        # the bytes of self and other that cover the intersection of their bounding boxes
+        assert self.shape == other.shape, 'Masks must have the same shape ({} != {})'.format(self.shape, other.shape)
+        start = np.maximum(self.start, other.start)
+        stop = np.minimum(self.stop, other.stop)
+        if self.count == 0 or other.count == 0 or np.any(stop <= start):
+            return None, None, start
+        scale = [1] * (len(self.shape) - 1) + [8]
+        region = lambda mask: tuple(slice((a - s) // k, (b - s) // k) for a, b, s, k in zip(start, stop, mask.start, scale))
+        return self.bits[region(self)], other.bits[region(other)], start
+
+    def intersection(self, other):
+        """
+        Returns the number of voxels in both masks.
+        """
+        a, b, _ = self._overlap(other)
+        return 0 if a is None else popcount(a & b)
+
+    def union(self, other):
+        """
+        Returns the number of voxels in either mask.
+        """
+        return self.count + other.count - self.intersection(other)
+
+    def dice(self, other):
+        """
+        Returns the Dice overlap of two masks (NaN if one of them is empty).
+        """
+        if self.count == 0 or other.count == 0:
+            return np.nan
+        return 2 * self.intersection(other) / (self.count + other.count)
+
+    def __and__(self, other):
+        a, b, start = self._overlap(other)
+        if a is None:
+            return PackedMask(np.zeros((0,) * len(self.shape), dtype=np.uint8), (0,) * len(self.shape), self.shape, 0)
+        bits = a & b
+        return PackedMask(bits, start, self.shape, popcount(bits))
+
+    def to_mask(self):
+        """
+        Returns the mask as a full size boolean array.
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        if self.count == 0:
+            return mask
+        last = min(self.stop[-1], self.shape[-1]) - self.start[-1]
+        region = tuple(slice(s, s + n) for s, n in zip(self.start[:-1], self.bits.shape[:-1])) + (slice(self.start[-1], self.start[-1] + last),)
+        mask[region] = np.unpackbits(self.bits, axis=-1, count=last).astype(bool)
+        return mask
+
+
+def consensus(masks):
+    """
+    Returns the voxels that are in all masks (logical and) as a PackedMask.
+    """
+    result = masks[0]
+    for mask in masks[1:]:
+        result = result & mask
+    return result
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+# shared pipeline of the segmentation verification (prepare, register, warp labels, dice scores and consensus segmentation)
+# every intermediate is stored in a content-keyed VerificationCache so it is shared between splits, templates and runs
+
+import os
+import sys
+import shutil
+import itertools
+import nrrd
+import numpy as np
+from scipy.signal import find_peaks
+from joblib import Parallel, delayed
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from verification_cache import VerificationCache
+import dice_engine
+import packed_masks
+import consensus
+
+TARGET_DIRECTION = 'LEFT'
+
+def find_template(template_dir='../data/templates', target_resolution='0.8x0.8x0.8'):
+    """
+    Returns the template in template_dir with the target resolution in its name.
+    """
+    template_filenames = [f for f in os.listdir(template_dir) if f.endswith('.nrrd')]
+    template_filename = [f for f in template_filenames if target_resolution in f]
+    assert len(template_filename) == 1, "There should be only one template with the target resolution"
+    return os.path.join(template_dir, template_filename[0])
+
+def match_images_and_labels(data_dir):
+    """
+    Returns the images of data_dir that have a segmentation and a dictionary from every label to its image.
+    """
+    filenames = [f for f in sorted(os.listdir(data_dir)) if f.endswith('.nrrd')]
+    # separate into images and labels
+    images = [os.path.join(data_dir, f) for f in filenames if 'segmentation' not in f]
+    labels = [os.path.join(data_dir, f) for f in filenames if 'segmentation' in f]
+    # create a matching list of pairs of images and labels
+    label_to_image = {}
+    for image, label in itertools.product(images, labels):
+        if os.path.splitext(image)[0] == os.path.splitext(label)[0].replace('_segmentation', ''):
+            label_to_image[label] = image
+    return label_to_image
+
+def is_mirrored(file, target_direction=TARGET_DIRECTION):
+    """
+    Returns True if the file is from the other side than the target direction (and is mirrored before registration).
+    """
+    return ('RIGHT' if target_direction == 'LEFT' else 'LEFT') in os.path.basename(file)
+
+def prepare(file, cache, is_label, target_resolution='0.8x0.8x0.8', target_direction=TARGET_DIRECTION):
+    """
+    Mirrors a file to the target direction (if it is from the other side) and resamples it to the target resolution.
+    Returns the prepared file in the cache.
+    """
+    opposite = 'RIGHT' if target_direction == 'LEFT' else 'LEFT'
+    mirror = is_mirrored(file, target_direction)
+    name = os.path.basename(file).replace(opposite, target_direction).replace('.nrrd', '_resampled_{}.nrrd'.format(target_resolution))
+
+    def compute(entry):
+        source = file
+        if mirror:
+            print("Mirroring: " + file)
+            reflection_matrix = os.path.join(entry, 'reflection_matrix.mat')
+            source = os.path.join(entry, 'mirrored.nrrd')
+            flip_brain_command1 = "ImageMath 3 {} ReflectionMatrix {} 0 >{}_out.log 2>{}_err.log".format(reflection_matrix, file, reflection_matrix[:-4], reflection_matrix[:-4])
+            if is_label:
+                flip_brain_command2 = "antsApplyTransforms -d 3 -i {} -o {} -t {} -r {} >{}_out.log 2>{}_err.log".format(file, source, reflection_matrix, file, source[:-5], source[:-5])
+            else:
+                flip_brain_command2 = "WarpImageMultiTransform 3 {} {} -R {} {} >{}_out.log 2>{}_err.log".format(file, source, file, reflection_matrix, source[:-5], source[:-5])
+            print(flip_brain_command1)
+            os.system(flip_brain_command1)
+            print(flip_brain_command2)
+            os.system(flip_brain_command2)
+        # resample to the target resolution (same command as scripts/resample.py)
+        print("Resampling: " + file)
+        resampled = os.path.join(entry, name)
+        spacing = target_resolution.split('x')
+        os.system('ResampleImageBySpacing 3 {} {} {} {} {} 0 0 0 >{}_out.log 2>{}_err.log'.format(source, resampled, spacing[0], spacing[1], spacing[2], resampled[:-5], resampled[:-5]))
+        assert os.path.isfile(resampled), "Could not prepare {}".format(file)
+
+    entry = cache.cached('prepared', [file], compute, name=name, label=is_label, mirror=mirror, target_resolution=target_resolution)
+    return os.path.join(entry, name)
+
+def register(image, template_path, cache):
+    """
+    Registers an image to the template with antsIntroduction.sh.
+    Returns the output prefix of the transforms (<prefix>Warp.nii.gz and <prefix>Affine.txt) in the cache.
+    """
+    def compute(entry):
+        # antsIntroduction.sh needs full paths
+        output_prefix_ = os.path.abspath(os.path.join(entry, 'registration_'))
+        command = f'antsIntroduction.sh -d 3 -r {os.path.abspath(template_path)} -i {os.path.abspath(image)} '
+        command += f'-o {output_prefix_} -t GR -s CC -m 30x90x20x8 -n 1 -q 0 '
+        command += f'>{output_prefix_}_out.log 2>{output_prefix_}_err.log'
+        print(command)
+        os.system(command)
+        assert os.path.isfile(output_prefix_ + 'Warp.nii.gz'), "Could not register {}".format(image)
+
+    entry = cache.cached('registration', [template_path, image], compute, transformation='GR', similarity='CC', iterations='30x90x20x8')
+    return os.path.join(entry, 'registration_')
+
+def warp_label(label, registration_prefix, template_path, cache):
+    """
+    Warps a label to the template with the transforms of its image.
+    Returns the warped label in the cache.
+    """
+    warp = registration_prefix + 'Warp.nii.gz'
+    affine = registration_prefix + 'Affine.txt'
+
+    def compute(entry):
+        output_prefix = os.path.join(entry, 'warped_label')
+        command = f'antsApplyTransforms -d 3 -i {label} -r {template_path}'
+        command += f' -o {output_prefix}.nrrd -n GenericLabel -t {warp}'
+        command += f' -t {affine} >{output_prefix}_out.log 2>{output_prefix}_err.log'
+        print(command)
+        os.system(command)
+        assert os.path.isfile(output_prefix + '.nrrd'), "Could not warp {}".format(label)
+
+    entry = cache.cached('warped_label', [label, template_path, warp, affine], compute, interpolation='GenericLabel')
+    return os.path.join(entry, 'warped_label.nrrd')
+
+def label_lut(n_channels):
+    """
+    Returns the 256-entry lookup table from the label intensities (0-255) to the channels 0, 1, ..., n_channels-1
+    (the bins of np.digitize with n_channels equal intervals between 0 and 255).
+    """
+    return (np.digitize(np.arange(256), bins=np.linspace(0, 255, n_channels))-1).astype(np.uint8)
+
+def as_uint8_labels(label_data):
+    """
+    Returns the label intensities as uint8 (they must be integers between 0 and 255).
+    """
+    if label_data.dtype == np.uint8:
+        return label_data
+    assert label_data.min() >= 0 and label_data.max() <= 255 and np.all(np.mod(label_data, 1) == 0), "Label intensities must be integers between 0 and 255"
+    return label_data.astype(np.uint8)
+
+def flip_label(label, cache):
+    """
+    Mirrors a (warped) label back with a reflection through the center of its image.
+    Returns the flipped label in the cache.
+    """
+    def compute(entry):
+        reflection_matrix = os.path.join(entry, 'flipback_matrix.mat')
+        output_prefix = os.path.join(entry, 'flipped_label')
+        flip_brain_command1 = "ImageMath 3 {} ReflectionMatrix {} 0 >{}_out.log 2>{}_err.log".format(reflection_matrix, label, reflection_matrix[:-4], reflection_matrix[:-4])
+        flip_brain_command2 = "antsApplyTransforms -d 3 -i {} -o {}.nrrd -n GenericLabel -t {} -r {} >{}_out.log 2>{}_err.log".format(label, output_prefix, reflection_matrix, label, output_prefix, output_prefix)
+        print(flip_brain_command1)
+        os.system(flip_brain_command1)
+        print(flip_brain_command2)
+        os.system(flip_brain_command2)
+        assert os.path.isfile(output_prefix + '.nrrd'), "Could not flip {}".format(label)
+
+    entry = cache.cached('flipped_label', [label], compute, interpolation='GenericLabel')
+    return os.path.join(entry, 'flipped_label.nrrd')
+
+def verify_subject(label, image, template_path, cache, target_resolution='0.8x0.8x0.8', n_threads=1, flip_back=False):
+    """
+    Runs the steps of one subject in order: prepare (mirror and resample) the image and its label, register the image to the
+    template, warp the label with the transforms of the image and (if flip_back) mirror the warped label back if the subject
+    was mirrored. ANTs commands use at most n_threads threads. Returns the name and the file of the label in template space.
+    """
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(n_threads)
+    prepared_image = prepare(image, cache, False, target_resolution)
+    prepared_label = prepare(label, cache, True, target_resolution)
+    # register the image to the template and warp its label with the same transforms
+    registration_prefix = register(prepared_image, template_path, cache)
+    warped_label = warp_label(prepared_label, registration_prefix, template_path, cache)
+    if flip_back and is_mirrored(label):
+        warped_label = flip_label(warped_label, cache)
+    return 'warped_' + os.path.basename(prepared_label), warped_label
+
+def process_label(label, cache):
+    """
+    Maps the intensity levels of a label (0-255) to the channels 0, 1, 2, ... using the peaks of its histogram.
+    Returns the processed label (uint8) in the cache, its number of channels and the lookup table used.
+    """
+    def compute(entry):
+        label_data, label_header = nrrd.read(label)
+        label_data = as_uint8_labels(label_data)
+        # get a histogram of the label data (256 bins between the minimum and maximum, as np.histogram) from the count of every intensity
+        value_counts = np.bincount(label_data.ravel(), minlength=256)
+        values = np.flatnonzero(value_counts)
+        lo, hi = values[0], values[-1]
+        bins = np.minimum(((values - lo) * 256 // max(hi - lo, 1)), 255)
+        hist = np.bincount(bins, weights=value_counts[values], minlength=256)
+        # find the peaks of the histogram
+        peaks, _ = find_peaks(hist, threshold=1e3)
+        n_channels = len(peaks)+2 # for the background and the highest peak
+        # map the intensities to the channels with a lookup table (from 0 to n_channels-1)
+        lut = label_lut(n_channels)
+        processed_label = np.take(lut, label_data)
+        nrrd.write(os.path.join(entry, 'processed_label.nrrd'), processed_label, label_header)
+        np.save(os.path.join(entry, 'lut.npy'), lut)
+
+    entry = cache.cached('processed_label', [label], compute, threshold=1e3, encoding='uint8')
+    lut = np.load(os.path.join(entry, 'lut.npy'))
+    return os.path.join(entry, 'processed_label.nrrd'), int(lut.max())+1, lut
+
+def write_dice_statistics(dice_scores, stats_file):
+    """
+    Prints the Dice score statistics of every channel and saves them to stats_file.
+    """
+    with open(stats_file, 'w') as f:
+        for i, channel in enumerate(dice_scores):
+            # remove the NaNs
+            channel_ = channel[~np.isnan(channel)].flatten()
+            # check if there are any dice volumes
+            if len(channel_) == 0:
+                print("No overlap volumes for channel {}".format(i))
+                continue
+            # compute the statistics
+            lines = ['Channel {}'.format(i if i>0 else '0 (Background)'), '==========',
+                     "Average Dice score: {:.2f}".format(np.mean(channel_)),
+                     "Median Dice score: {:.2f}".format(np.median(channel_)),
+                     "95% CI Dice score: ({:.2f}, {:.2f})".format(np.percentile(channel_, 2.5), np.percentile(channel_, 97.5)),
+                     "Min Dice score: {:.2f}".format(np.min(channel_)),
+                     "Max Dice score: {:.2f}".format(np.max(channel_)),
+                     "Std Dice score: {:.2f}".format(np.std(channel_)), ""]
+            print("\n".join(lines))
+            # save the statistics
+            f.write("\n".join(lines) + "\n")
+
+def compare_labels(labels, output_dir, suffix, cache, stats_name=None, n_jobs=1, consensus_mode='and', consensus_threshold=0.5):
+    """
+    Processes the (name, label) pairs (all in template space), computes the pairwise Dice scores of every channel
+    and the consensus segmentation, and saves them to output_dir. Returns the Dice scores (channels x labels x labels).
+    The Dice scores of the pairs are computed with n_jobs parallel jobs. The consensus is the logical and of all labels
+    ('and'), the majority vote ('majority'), the channels with at least consensus_threshold of the votes ('threshold')
+    or the STAPLE fusion of the labels ('staple').
+    """
+    assert consensus_mode in consensus.CONSENSUS_MODES, "Consensus mode must be one of {}".format(consensus.CONSENSUS_MODES)
+    os.makedirs(output_dir, exist_ok=True)
+    processed = [process_label(label, cache) for _, label in labels]
+    n_channels = [n for _, n, _ in processed]
+    # assert that all the labels have the same number of channels and intensity to channel mapping
+    assert len(set(n_channels)) == 1, "All the labels should have the same number of channels"
+    assert all(np.array_equal(lut, processed[0][2]) for _, _, lut in processed), "All the labels should have the same intensity to channel mapping"
+    n_channels = n_channels[0]
+    print("Consensus Number of channels: {}".format(n_channels))
+
+    # keep a copy of the processed labels with the results, keep every channel as a bit-packed mask and count the votes of every channel
+    masks = []
+    votes = consensus.VoteCounter(n_channels, len(labels))
+    for (name, _), (processed_file, _, _) in zip(labels, processed):
+        shutil.copyfile(processed_file, os.path.join(output_dir, name.replace('.nrrd', '_processed.nrrd')))
+        label_data, label_header = nrrd.read(processed_file)
+        masks.append(packed_masks.PackedMask.from_labels(label_data, n_channels))
+        votes.update(label_data)
+    print("Channel masks generated ({:.1f} MB packed, {:.1f} MB as boolean volumes).".format(sum(m.nbytes for label_masks in masks for m in label_masks) / 1e6, len(masks) * n_channels * label_data.size / 1e6))
+
+    # compute the pairwise dice volume of all channels with popcounts (cached by the processed labels)
+    def compute(entry):
+        dice_scores = dice_engine.pairwise_dice_masks(masks, n_jobs=n_jobs)
+        print("Dice volumes computed for {} channels".format(n_channels))
+        np.save(os.path.join(entry, 'dice_scores.npy'), dice_scores)
+
+    entry = cache.cached('dice', [processed_file for processed_file, _, _ in processed], compute, n_channels=n_channels)
+    dice_scores = np.load(os.path.join(entry, 'dice_scores.npy'))
+
+    # save the dice volumes and their statistics
+    np.save(os.path.join(output_dir, f'dice_scores_{suffix}.npy'), dice_scores)
+    write_dice_statistics(dice_scores, os.path.join(output_dir, stats_name or f'dice_scores_{suffix}.txt'))
+
+    # find the consensus segmentation
+    print("Computing the consensus segmentation ({})".format(consensus_mode))
+    if consensus_mode == 'staple':
+        fused, agreement, performance = consensus.staple(lambda k: nrrd.read(processed[k][0])[0], votes)
+        np.save(os.path.join(output_dir, f'staple_performance_{suffix}.npy'), performance)
+    else:
+        fused = votes.majority() if consensus_mode == 'majority' else votes.threshold(1.0 if consensus_mode == 'and' else consensus_threshold)
+        agreement = [votes.agreement(i) for i in range(n_channels)]
+    consensus_segmentation = np.zeros(label_data.shape, dtype=np.float32)
+    for i in range(n_channels):
+        if consensus_mode in ['and', 'threshold']:
+            channel_consensus = votes.mask(i, 1.0 if consensus_mode == 'and' else consensus_threshold)
+        else:
+            channel_consensus = fused == i
+        # save the consensus segmentation and the agreement of the channel as nrrd files
+        nrrd.write(os.path.join(output_dir, f'consensus_segmentation_channel_{i}_{suffix}.nrrd'), np.float32(channel_consensus), label_header)
+        nrrd.write(os.path.join(output_dir, f'consensus_agreement_channel_{i}_{suffix}.nrrd'), np.float32(agreement[i]), label_header)
+        # add the channel to the consensus segmentation
+        if i > 0:
+            consensus_segmentation[fused == i] = i+1
+        print("Consensus segmentation computed for channel {}".format(i))
+
+    # save the consensus segmentation as a nrrd file
+    nrrd.write(os.path.join(output_dir, f'consensus_segmentation_{suffix}.nrrd'), np.float32(consensus_segmentation), label_header)
+    print("Consensus segmentation saved as a nrrd file.")
+    return dice_scores
+
+def run_split(train_or_test, template_path, output_dir, cache, data_dir='../data/segmentation_data', target_resolution='0.8x0.8x0.8', n_jobs=1, consensus_mode='and', consensus_threshold=0.5, n_threads=None, flip_back=False):
+    """
+    Verifies the registration to template_path with the manual segmentations of a dataset split (train or test):
+    prepares the images and labels, registers the images, warps the labels and compares them in template space.
+    The subjects run in a process pool within a budget of n_jobs cores, with n_threads threads per subject
+    (default: the cores split evenly between the subjects). Returns the Dice scores (channels x labels x labels).
+    """
+    label_to_image = match_images_and_labels(os.path.join(data_dir, train_or_test))
+    assert len(label_to_image) > 0, "No images with segmentations found in {}".format(os.path.join(data_dir, train_or_test))
+    if n_threads is None:
+        n_parallel = max(1, min(n_jobs, len(label_to_image)))
+        n_threads = max(1, n_jobs // n_parallel)
+    else:
+        n_parallel = max(1, min(n_jobs // n_threads, len(label_to_image)))
+    print("Registering {} subject(s) ({} at a time, {} thread(s) each)".format(len(label_to_image), n_parallel, n_threads))
+    labels = Parallel(n_jobs=n_parallel)(delayed(verify_subject)(label, image, template_path, cache, target_resolution, n_threads, flip_back) for label, image in label_to_image.items())
+    # pick up the digests computed by the workers
+    cache.reload()
+    return compare_labels(labels, output_dir, train_or_test, cache, n_jobs=n_jobs, consensus_mode=consensus_mode, consensus_threshold=consensus_threshold)
+
+def run_template(output_dir, cache, data_dir='../data/segmentation_data', n_jobs=1, consensus_mode='and', consensus_threshold=0.5):
+    """
+    Compares the segmentations of the template (labels with 'segmented' in the name, already in template space).
+    Returns the Dice scores (channels x labels x labels).
+    """
+    template_data_dir = os.path.join(data_dir, 'template')
+    labels = [f for f in sorted(os.listdir(template_data_dir)) if f.endswith('.nrrd') and 'segmented' in f]
+    assert len(labels) > 0, "No segmentations found in {}".format(template_data_dir)
+    # assert that all the labels have the same voxel spacing
+    resolutions = [nrrd.read_header(os.path.join(template_data_dir, label))['space directions'] for label in labels]
+    assert all(np.allclose(r, resolutions[0]) for r in resolutions), "All the labels should have the same voxel spacing"
+    labels = [(label, os.path.join(template_data_dir, label)) for label in labels]
+    return compare_labels(labels, output_dir, 'template', cache, stats_name='dice_scores_channel_template.txt', n_jobs=n_jobs, consensus_mode=consensus_mode, consensus_threshold=consensus_threshold)
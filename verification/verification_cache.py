@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# content-keyed cache for the intermediates of the verification pipelines (warps, jacobians, processed labels, dice matrices)
+
+import os
+import json
+import shutil
+import hashlib
+
+
+class VerificationCache:
+    """
+    Cache of intermediate results keyed by the content of their input files and their parameters.
+    Every entry is a directory <cache_dir>/<stage>/<key> that is only used once it has a manifest.json
+    (written after the entry was computed successfully), so interrupted computations are redone.
+    File digests are remembered by path, size and modification time so unchanged files are hashed only once.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.digest_file = os.path.join(cache_dir, 'digests.json')
+        self.digests = {}
+        self.reload()
+
+    def reload(self):
+        """
+        Adds the digests saved by other processes (e.g. parallel workers) to the known digests.
+        """
+        if os.path.isfile(self.digest_file):
+            with open(self.digest_file, 'r') as f:
+                self.digests.update(json.load(f))
+
+    def digest(self, filename, block_size=1 << 24):
+        """
+        Returns the sha1 digest of the content of a file.
+        """
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        known = self.digests.get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+            return known['digest']
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        # merge with the digests saved by other processes and write to a temporary file first so that readers never see a partial file
+        self.reload()
+        self.digests[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': sha.hexdigest()}
+        temporary_file = '{}.{}.tmp'.format(self.digest_file, os.getpid())
+        with open(temporary_file, 'w') as f:
+            json.dump(self.digests, f)
+        os.replace(temporary_file, self.digest_file)
+        return sha.hexdigest()
+
+    def key(self, stage, files=(), **params):
+        """
+        Returns the key of a stage given its input files and parameters.
+        """
+        description = {'stage': stage, 'files': [self.digest(f) for f in files], 'params': params}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def entry(self, stage, files=(), **params):
+        """
+        Returns the directory of the entry of a stage (it might not be computed yet).
+        """
+        return os.path.join(self.cache_dir, stage, self.key(stage, files, **params))
+
+    def is_complete(self, entry):
+        return os.path.isfile(os.path.join(entry, 'manifest.json'))
+
+    def cached(self, stage, files, compute, **params):
+        """
+        Returns the entry directory of a stage, calling compute(entry) to fill it if it is not cached yet.
+        compute must write its outputs inside the entry directory.
+        """
+        entry = self.entry(stage, files, **params)
+        if self.is_complete(entry):
+            return entry
+        # remove partial outputs of an interrupted computation
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.makedirs(entry)
+        compute(entry)
+        with open(os.path.join(entry, 'manifest.json'), 'w') as f:
+            json.dump({'stage': stage, 'files': [os.path.abspath(f) for f in files], 'params': params}, f, indent=2)
+        return entry